@@ -0,0 +1,329 @@
+""" Latency and throughput of the public API on seeded databases
+
+Usage:
+    python benchmarks/bench_api.py run [--sizes 10000,100000,1000000]
+                                       [-n 100] [--url mysql://...]
+                                       [-o results.json]
+    python benchmarks/bench_api.py compare baseline.json current.json
+                                           [--threshold 10] [--metric p50_ms]
+
+Without --url every size gets its own temporary SQLite database, filled by
+mailapi.testing.seed.  A database given with --url is seeded too, but only
+when it has no mailboxes yet; --no-seed benchmarks the data already there
+instead.  Writes (create_mailbox, delete_domain) are rolled back, so the
+data is the same for every operation.  --cache runs with the read-through
+cache of mailapi.cache.
+
+compare exits with status 1 when an operation got slower than the threshold
+allows, so it can gate a CI job.
+"""
+import argparse
+import json
+import math
+import platform
+import random
+import sys
+import os
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sqlalchemy  # noqa
+from sqlalchemy import func, select  # noqa
+
+from mailapi import testing  # noqa
+from mailapi.cache import Cache, set_cache  # noqa
+from mailapi.alias import get_aliases  # noqa
+from mailapi.client import MailApi  # noqa
+from mailapi.domain import create_domain, delete_domain  # noqa
+from mailapi.mailbox import (create_mailbox, get_all_mailboxes,  # noqa
+                             search_mailboxes)
+from mailapi.password import generate_md5_password  # noqa
+from mailapi.schema import domain, mailbox  # noqa
+from mailapi.used_quota import (get_sum_used_quota,  # noqa
+                                get_domain_sum_used_quota,
+                                get_domain_used_quota,
+                                get_mailbox_sum_used_quota,
+                                get_mailbox_used_quota)
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+
+# Mailboxes per seeded domain
+MAILBOXES_PER_DOMAIN = 100
+
+# Operations that read a large part of the database run this many times less
+HEAVY_DIVISOR = 20
+
+METRICS = ('mean_ms', 'p50_ms', 'p95_ms', 'p99_ms')
+
+
+def percentile(sorted_values, percent):
+    """ Nearest-rank percentile of an already sorted list """
+    rank = int(math.ceil(percent / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def summarize(latencies):
+    """ Dict of the statistics stored per operation
+
+    :param latencies: List of seconds, one per call
+    """
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    return {
+        'count': len(latencies),
+        'mean_ms': total / len(latencies) * 1000,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'ops_per_sec': len(latencies) / total if total else None,
+    }
+
+
+class Sample(object):
+    """ Existing domains and addresses the operations are called with
+    """
+
+    def __init__(self, client, rnd, domain_count=5):
+        with client.database.engine.connect() as connection:
+            self.mailbox_count = connection.execute(
+                select(func.count()).select_from(mailbox)).scalar()
+            domains = connection.execute(
+                select(domain.c.domain).order_by(domain.c.domain)).scalars().\
+                all()
+            self.domains = rnd.sample(domains, min(domain_count,
+                                                   len(domains)))
+            self.addresses = connection.execute(
+                select(mailbox.c.username).
+                where(mailbox.c.domain.in_(self.domains)).
+                order_by(mailbox.c.username)).scalars().all()
+
+        if not self.addresses:
+            raise SystemExit('The database has no mailboxes to benchmark')
+
+        self.rnd = rnd
+
+    def domain(self):
+        return self.rnd.choice(self.domains)
+
+    def address(self):
+        return self.rnd.choice(self.addresses)
+
+    def local_part(self):
+        return self.address().split('@')[0]
+
+
+def timed_calls(client, count, call, rollback=False, setup=None):
+    """ Runs @call @count times against @client, returns the latencies
+
+    The session is emptied between the calls, outside the timing, so a call
+    never finds its rows in the identity map of a previous one.  Whatever
+    the calls (and @setup) wrote is rolled back at the end.
+    """
+    latencies = []
+    with client.activate():
+        db_session = client.get_db_session()
+        if setup is not None:
+            setup()
+
+        for i in range(count):
+            start = time.perf_counter()
+            call(i)
+            latencies.append(time.perf_counter() - start)
+
+            if rollback:
+                db_session.rollback()
+            db_session.expunge_all()
+        client.remove_db_session()
+    return latencies
+
+
+def operations(sample):
+    """ (name, call(i), heavy, rollback, setup) of every operation """
+    # create_mailbox needs a domain of its own
+    bench_domain = 'bench-%d.lan' % os.getpid()
+
+    return [
+        ('md5crypt', lambda i: generate_md5_password('password1234'),
+         False, False, None),
+        ('create_mailbox', lambda i: create_mailbox(
+            'bench%d@%s' % (i, bench_domain), 'Bench', 'password1234'),
+         False, False, lambda: create_domain(bench_domain)),
+        ('delete_domain', lambda i: delete_domain(sample.domain()),
+         True, True, None),
+        ('search_mailboxes', lambda i: search_mailboxes(sample.local_part()),
+         True, False, None),
+        ('get_all_mailboxes', lambda i: get_all_mailboxes(),
+         True, False, None),
+        ('get_aliases', lambda i: get_aliases(sample.address()),
+         False, False, None),
+        ('get_sum_used_quota', lambda i: get_sum_used_quota(),
+         True, False, None),
+        ('get_domain_sum_used_quota',
+         lambda i: get_domain_sum_used_quota(sample.domain()),
+         False, False, None),
+        ('get_domain_used_quota',
+         lambda i: get_domain_used_quota(sample.domain()),
+         False, False, None),
+        ('get_mailbox_sum_used_quota',
+         lambda i: get_mailbox_sum_used_quota(sample.address()),
+         False, False, None),
+        ('get_mailbox_used_quota',
+         lambda i: get_mailbox_used_quota(sample.address()),
+         False, False, None),
+    ]
+
+
+def bench_database(client, count, random_seed):
+    """ Runs every operation against one database
+
+    :return: Dict of operation name => statistics, # of mailboxes
+    """
+    sample = Sample(client, random.Random(random_seed))
+
+    results = {}
+    for name, call, heavy, rollback, setup in operations(sample):
+        calls = max(count // HEAVY_DIVISOR, 3) if heavy else count
+        latencies = timed_calls(client, calls, call, rollback, setup)
+        results[name] = summarize(latencies)
+        print('  %-28s %5d calls %9.2fms p50 %9.2fms p99 %9.1f/s' % (
+            name, calls, results[name]['p50_ms'], results[name]['p99_ms'],
+            results[name]['ops_per_sec']))
+        sys.stdout.flush()
+
+    return results, sample.mailbox_count
+
+
+def run(args):
+    results = {}
+    meta = {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlalchemy': sqlalchemy.__version__,
+        'platform': platform.platform(),
+        'count': args.count,
+        'random_seed': args.random_seed,
+        'cache': args.cache,
+    }
+
+    if args.cache:
+        set_cache(Cache())
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    if args.url and len(sizes) > 1:
+        raise SystemExit('--url takes a single size')
+
+    for size in sizes:
+        if args.url:
+            url, options = args.url, {}
+        else:
+            url = testing.create_test_db(testing.temp_file_url())
+            options = {'schema': 'static'}
+
+        with MailApi(url, name='bench', **options) as client:
+            meta['backend'] = client.database.engine.dialect.name
+
+            with client.database.engine.connect() as connection:
+                existing = connection.execute(
+                    select(func.count()).select_from(mailbox)).scalar()
+
+            if not args.no_seed:
+                if existing:
+                    raise SystemExit('%s already has mailboxes, use --no-seed '
+                                     'to benchmark them' % client.name)
+                start = time.perf_counter()
+                testing.seed(client.database.engine,
+                             domains=max(size // MAILBOXES_PER_DOMAIN, 1),
+                             mailboxes=size, random_seed=args.random_seed)
+                print('%d mailboxes seeded in %.1fs' % (
+                    size, time.perf_counter() - start))
+
+            database_results, mailbox_count = bench_database(
+                client, args.count, args.random_seed)
+            results[str(mailbox_count)] = database_results
+
+    with open(args.output, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=2,
+                  sort_keys=True)
+    print('Results written to %s' % args.output)
+
+
+def compare_results(baseline, current, threshold, metric):
+    """ Compares two result files' operations
+
+    :param threshold: Percent an operation may get slower
+    :param metric: One of METRICS
+    :return: List of (size, operation, baseline, current, change percent,
+             regressed)
+    """
+    rows = []
+    for size, operations in sorted(current['results'].items(),
+                                   key=lambda item: int(item[0])):
+        for name, stats in sorted(operations.items()):
+            old = baseline['results'].get(size, {}).get(name)
+            if old is None or not old[metric]:
+                continue
+
+            change = (stats[metric] - old[metric]) / old[metric] * 100
+            rows.append((size, name, old[metric], stats[metric], change,
+                         change > threshold))
+    return rows
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+
+    rows = compare_results(baseline, current, args.threshold, args.metric)
+    if not rows:
+        raise SystemExit('The files have no size and operation in common')
+
+    for size, name, old, new, change, regressed in rows:
+        print('%8s %-28s %10.2fms %10.2fms %+8.1f%%%s' % (
+            size, name, old, new, change, '  REGRESSION' if regressed else ''))
+
+    regressions = sum(1 for row in rows if row[-1])
+    print('%d regression(s) over %.1f%% in %s' % (
+        regressions, args.threshold, args.metric))
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    run_parser = commands.add_parser('run', help='Run the benchmarks')
+    run_parser.add_argument(
+        '--sizes', default=','.join(str(size) for size in DEFAULT_SIZES),
+        help='Comma separated # of mailboxes of the seeded databases')
+    run_parser.add_argument('-n', '--count', type=int, default=100,
+                            help='Calls per operation')
+    run_parser.add_argument('--url', help='SQLAlchemy URL of a vmail database')
+    run_parser.add_argument('--no-seed', action='store_true',
+                            help='Benchmark the data --url already has')
+    run_parser.add_argument('--random-seed', type=int, default=0)
+    run_parser.add_argument('--cache', action='store_true',
+                            help='Use an in-process mailapi.cache.Cache')
+    run_parser.add_argument('-o', '--output', default='bench_api.json')
+
+    compare_parser = commands.add_parser(
+        'compare', help='Flag regressions between two result files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=10.0,
+                                help='Percent an operation may get slower')
+    compare_parser.add_argument('--metric', choices=METRICS, default='p50_ms')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+""" Throughput of maildir path generation for large imports
+
+Usage: python benchmarks/bench_maildir.py [-n 1000000]
+
+Compares calling generate_maildir_path once per address with the batch
+generate_maildir_paths.  No database is needed.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mailapi.maildir import generate_maildir_path, generate_maildir_paths  # noqa
+
+
+def addresses(count, domains=100):
+    return ['user%07d@domain%03d.lan' % (i, i % domains)
+            for i in range(count)]
+
+
+def bench(label, func, count):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print('%-28s %8.2fs %12.0f addresses/s' % (label, elapsed,
+                                                count / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--count', type=int, default=1000000)
+    args = parser.parse_args()
+
+    mails = addresses(args.count)
+
+    bench('generate_maildir_path',
+          lambda: [generate_maildir_path(m) for m in mails],
+          args.count)
+    bench('generate_maildir_paths',
+          lambda: generate_maildir_paths(mails),
+          args.count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+""" Measures snapshot export and import throughput and memory
+
+Usage: python benchmarks/bench_snapshot.py [--mailboxes 1000000]
+                                           [--max-growth 50]
+
+Seeds a SQLite database, exports it with mailapi.snapshot and imports the
+file into an empty one, printing rows/s and the process' RSS.  Exits with 1
+if the RSS grew by more than --max-growth MB over the export and import,
+i.e. if memory isn't bounded by the chunk size.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mailapi import snapshot, testing  # noqa
+from mailapi.client import MailApi  # noqa
+from soak_sessions import rss_mb  # noqa
+
+
+def timed(label, func, *args):
+    start = time.perf_counter()
+    counts = func(*args)
+    seconds = time.perf_counter() - start
+    rows = sum(counts.values())
+    print('%-7s %9d rows %7.1fs %9.0f rows/s %8.1fMB RSS' % (
+        label, rows, seconds, rows / seconds, rss_mb()))
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mailboxes', type=int, default=1000000)
+    parser.add_argument('--max-growth', type=float, default=50.0,
+                        help='MB the RSS may grow by')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='mailapi-snapshot-')
+    path = os.path.join(tmp_dir, 'vmail.snapshot.gz')
+    try:
+        source = MailApi(testing.create_test_db(testing.temp_file_url()),
+                         schema='static')
+        testing.seed(source.database.engine,
+                     domains=max(args.mailboxes // 100, 1),
+                     mailboxes=args.mailboxes)
+        target = MailApi(testing.create_test_db(testing.temp_file_url()),
+                         schema='static')
+
+        baseline = rss_mb()
+        with source.activate():
+            timed('export', snapshot.export, path)
+        print('%.1fMB snapshot' % (os.path.getsize(path) / 1024.0 ** 2))
+        with target.activate():
+            timed('import', snapshot.import_, path)
+        growth = rss_mb() - baseline
+
+        source.close()
+        target.close()
+    finally:
+        shutil.rmtree(tmp_dir, True)
+
+    print('RSS grew by %.1fMB' % growth)
+    sys.exit(1 if growth > args.max_growth else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+""" Time init_db takes in a fresh process for each schema source
+
+Usage: python benchmarks/bench_startup.py [-n 20] [--url mysql://...]
+
+Every run starts a new interpreter, so each measurement includes the catalog
+queries a short-lived cron job or CLI would pay.  Without --url a temporary
+SQLite database with the vmail tables is used.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+# Runs in the child process; prints the init_db time and # of statements
+CHILD = '''
+import json, sys, time
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+statements = []
+event.listen(Engine, 'before_cursor_execute',
+             lambda *args: statements.append(args[2]))
+import mailapi
+options = json.loads(sys.argv[2])
+start = time.perf_counter()
+mailapi.init_db(sys.argv[1], **options)
+print(json.dumps([time.perf_counter() - start, len(statements)]))
+'''
+
+
+def run_child(url, options):
+    output = subprocess.check_output(
+        [sys.executable, '-c', CHILD, url, json.dumps(options)], cwd=ROOT)
+    return json.loads(output)
+
+
+def bench(label, url, options, count):
+    timings = []
+    for _ in range(count):
+        elapsed, statements = run_child(url, options)
+        timings.append(elapsed)
+
+    print('%-22s %8.1fms median %8.1fms max %4d statements' % (
+        label,
+        statistics.median(timings) * 1000,
+        max(timings) * 1000,
+        statements,
+    ))
+
+
+def sqlite_url(tmp_dir):
+    from sqlalchemy import create_engine
+    from mailapi.schema import metadata
+
+    url = 'sqlite:///' + os.path.join(tmp_dir, 'vmail.db')
+    engine = create_engine(url)
+    metadata.create_all(engine)
+    engine.dispose()
+    return url
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--count', type=int, default=20)
+    parser.add_argument('--url', help='SQLAlchemy URL of a vmail database')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        url = args.url or sqlite_url(tmp_dir)
+        cache = os.path.join(tmp_dir, 'schema.cache')
+
+        bench('reflect', url, {}, args.count)
+
+        # The first run writes the cache, the rest load it
+        run_child(url, {'schema_cache': cache})
+        bench('reflect, cached', url, {'schema_cache': cache}, args.count)
+
+        bench('static', url, {'schema': 'static'}, args.count)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+""" Throughput of email address validation
+
+Usage: python benchmarks/bench_validators.py [-n 1000000]
+
+Compares the per-call is_email as it was up to 0.2.0 (re.compile and two sets
+built on every call) with the current is_email and the batch validate_emails.
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mailapi.validators import (  # noqa
+    is_email,
+    validate_emails,
+    email_re,
+    INVALID_EMAIL_CHARS,
+)
+
+
+def legacy_is_email(s):
+    s = str(s)
+    if len(set(s) & set(INVALID_EMAIL_CHARS)) > 0 \
+       or '.' not in s \
+       or s.count('@') != 1:
+        return False
+
+    re_comp_email = re.compile(email_re + '$', re.IGNORECASE)
+    if re_comp_email.match(s):
+        return True
+    else:
+        return False
+
+
+def addresses(count, invalid_every=100):
+    return ['user %d@domain.lan' % i if i % invalid_every == 0 else
+            'user%07d@domain%03d.lan' % (i, i % 100) for i in range(count)]
+
+
+def bench(label, func, count):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print('%-22s %8.2fs %12.0f addresses/s' % (label, elapsed,
+                                                count / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--count', type=int, default=1000000)
+    args = parser.parse_args()
+
+    mails = addresses(args.count)
+
+    bench('legacy is_email', lambda: [legacy_is_email(m) for m in mails],
+          args.count)
+    bench('is_email', lambda: [is_email(m) for m in mails], args.count)
+    bench('validate_emails', lambda: validate_emails(mails), args.count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+""" Checks that a long running process' memory stays flat
+
+Usage: python benchmarks/soak_sessions.py [-n 1000000] [--scope operation]
+                                          [--expunge-listings] [--max-growth 20]
+
+Makes -n API calls (get_mailbox, get_aliases, get_domain_used_quota,
+domain_exists, get_all_domains and get_all_mailboxes of a domain, round
+robin) from one thread against a seeded SQLite database, sampling the
+process' RSS along the way.  Exits with 1 if RSS grew by more than
+--max-growth MB after the first tenth of the calls, which is when the caches
+of SQLAlchemy and SQLite are warm.
+"""
+import argparse
+import os
+import random
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import select  # noqa
+
+from mailapi import testing  # noqa
+from mailapi.alias import get_aliases  # noqa
+from mailapi.client import MailApi  # noqa
+from mailapi.domain import domain_exists, get_all_domains  # noqa
+from mailapi.domain import get_all_mailboxes  # noqa
+from mailapi.mailbox import get_mailbox  # noqa
+from mailapi.schema import domain, mailbox  # noqa
+from mailapi.used_quota import get_domain_used_quota  # noqa
+
+
+def rss_mb():
+    """ Current resident set size; the peak where /proc isn't available """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 1024.0 ** 2
+    except (IOError, OSError):
+        # Kilobytes on Linux, bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss / (1024.0 ** 2 if sys.platform == 'darwin' else 1024.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--count', type=int, default=1000000)
+    parser.add_argument('--mailboxes', type=int, default=10000)
+    parser.add_argument('--scope', choices=('thread', 'operation'),
+                        default='operation')
+    parser.add_argument('--expunge-listings', action='store_true')
+    parser.add_argument('--max-growth', type=float, default=20.0,
+                        help='MB the RSS may grow by after the warm up')
+    args = parser.parse_args()
+
+    url = testing.create_test_db(testing.temp_file_url())
+    testing.seed(url, domains=max(args.mailboxes // 100, 1),
+                 mailboxes=args.mailboxes)
+
+    client = MailApi(url, schema='static', session_scope=args.scope,
+                     expunge_listings=args.expunge_listings)
+    with client.database.engine.connect() as connection:
+        domains = connection.execute(select(domain.c.domain)).scalars().all()
+        addresses = connection.execute(
+            select(mailbox.c.username)).scalars().all()
+
+    rnd = random.Random(0)
+    calls = [
+        lambda: get_mailbox(rnd.choice(addresses)),
+        lambda: get_aliases(rnd.choice(addresses)),
+        lambda: get_domain_used_quota(rnd.choice(domains)),
+        lambda: domain_exists(rnd.choice(domains)),
+        lambda: get_all_domains(),
+    ]
+    sample_every = max(args.count // 20, 1)
+    warm_up = max(args.count // 10, 1)
+    baseline = None
+    peak = 0.0
+    start = time.perf_counter()
+
+    with client.activate():
+        for i in range(1, args.count + 1):
+            calls[i % len(calls)]()
+
+            # A big listing now and then
+            if i % 1000 == 0:
+                get_all_mailboxes(rnd.choice(domains))
+
+            if i == warm_up:
+                baseline = rss_mb()
+            if i % sample_every == 0:
+                rss = rss_mb()
+                peak = max(peak, rss)
+                print('%9d calls %8.1fMB RSS %8.0f calls/s' % (
+                    i, rss, i / (time.perf_counter() - start)))
+                sys.stdout.flush()
+
+    client.close()
+
+    growth = peak - baseline
+    print('RSS grew by %.1fMB after the warm up (scope %s, expunge %s)' % (
+        growth, args.scope, args.expunge_listings))
+    sys.exit(1 if growth > args.max_growth else 0)
+
+
+if __name__ == '__main__':
+    main()
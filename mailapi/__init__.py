@@ -1,5 +1,69 @@
-from . import domain
-from . import mailbox
-from . import alias
-from . import exc
-from .db import init_db
+""" iRedMail administration API
+
+Submodules and the names below are imported on first access, so
+`import mailapi` alone doesn't load SQLAlchemy.  Callers that only need e.g.
+mailapi.validators or mailapi.maildir don't pay for the ORM.
+"""
+from importlib import import_module
+
+
+# Attribute name => submodule it comes from
+_LAZY_ATTRIBUTES = {
+    'MailApi': 'client',
+    'fan_out': 'client',
+    'init_db': 'db',
+    'pool_stats': 'db',
+    'query_budget': 'budget',
+    'reconcile': 'reconciler',
+    'transaction': 'db',
+}
+
+_SUBMODULES = (
+    'aio',
+    'alias',
+    'archive',
+    'budget',
+    'bulk',
+    'cache',
+    'changes',
+    'client',
+    'db',
+    'domain',
+    'exc',
+    'helpers',
+    'instrumentation',
+    'maildir',
+    'mailbox',
+    'md5crypt',
+    'models',
+    'password',
+    'placement',
+    'reconciler',
+    'replicas',
+    'schema',
+    'snapshot',
+    'storage',
+    'used_quota',
+    'validators',
+)
+
+__all__ = ['domain', 'mailbox', 'alias', 'exc'] + sorted(_LAZY_ATTRIBUTES)
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        value = getattr(import_module('.' + _LAZY_ATTRIBUTES[name], __name__),
+                        name)
+    elif name in _SUBMODULES:
+        value = import_module('.' + name, __name__)
+    else:
+        raise AttributeError('module %r has no attribute %r' %
+                             (__name__, name))
+
+    # Later lookups don't go through here again
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES) | set(_SUBMODULES))
@@ -0,0 +1,104 @@
+""" Coroutine versions of mailapi.alias
+"""
+from sqlalchemy import select, delete
+from sqlalchemy.exc import IntegrityError
+
+from .. import changes
+from ..models import Alias
+from ..alias import build_alias
+from ..validators import is_email
+from ..exc import AliasExists
+from .db import affected, get_db_session, record_changes, with_session
+
+
+@with_session
+async def add_alias(source, dest):
+    """ Create an alias for the given email address
+
+    :param source: Incoming email address
+    :param dest: Redirect to this mailbox
+    :return: Alias
+    :raises ValueError: if an invalid source or dest email address is provided
+    :raises AliasExists: If the given alias already exists
+    """
+
+    if not is_email(source):
+        raise ValueError('Invalid source email address provided: %s' % source)
+
+    if not is_email(dest):
+        raise ValueError('Invalid destination email address provided: %s' %
+                         dest)
+
+    local_part, domain = dest.split('@')
+
+    alias = await _save_alias(build_alias(source, dest, domain))
+    await record_changes(changes.ALIAS, changes.CREATE, [source])
+    return alias
+
+
+async def _save_alias(alias):
+    """ Adds the given Alias object to the database
+
+    :raises AliasExists: If the given alias already exists
+    """
+
+    db_session = get_db_session()
+
+    # A savepoint so a duplicate doesn't roll back the caller's other work
+    try:
+        async with db_session.begin_nested():
+            db_session.add(alias)
+        return alias
+    except IntegrityError:
+        raise AliasExists(alias.address, alias.goto)
+
+
+@with_session
+async def get_aliases(dest):
+    """ Get all aliases that redirect to the given @dest email address
+
+    :param email_address: String
+    :return: List of mailapi.models.Alias objects
+    """
+
+    result = await get_db_session().execute(
+        select(Alias).filter_by(goto=dest))
+    return list(result.scalars())
+
+
+@with_session
+async def delete_aliases(dest):
+    """ Deletes all aliases that redirect to the given email address except for
+    the self-referrential alias which must be explicitly deleted.
+
+    :param dest: The goto address
+    :return: True if success else False
+    """
+
+    db_session = get_db_session()
+    criteria = (Alias.goto == dest, Alias.address != dest)
+    deleted = await affected(select(Alias.address).where(*criteria))
+    result = await db_session.execute(delete(Alias).where(*criteria))
+    await db_session.flush()
+
+    await record_changes(changes.ALIAS, changes.DELETE, deleted)
+    return result.rowcount >= 1
+
+
+@with_session
+async def delete_alias(source, dest):
+    """ Delete an alias matching the given @source and @dest addresses
+
+    :param source: String
+    :param dest: String
+    :return: True if success
+    """
+
+    db_session = get_db_session()
+    result = await db_session.execute(
+        delete(Alias).where(Alias.address == source, Alias.goto == dest))
+    await db_session.flush()
+
+    if result.rowcount:
+        await record_changes(changes.ALIAS, changes.DELETE, [source])
+    return result.rowcount == 1
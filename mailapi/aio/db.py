@@ -0,0 +1,188 @@
+""" Async database operations
+
+Every API coroutine runs in a session taken from the current context.  When
+there is none (the common case) the coroutine opens one for the duration of
+the call and commits it at the end, so concurrent calls only hold a pooled
+connection while they actually run.  Use session_scope() to group several
+calls into one transaction.
+"""
+import contextvars
+import functools
+from contextlib import asynccontextmanager
+
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from .. import changes
+from ..models import map_models, models_mapped
+from ..schema import SCHEMA_REFLECT, load_metadata, reflect
+from ..exc import DbInitError
+
+
+# Don't use the session factory directly since it may not be initialized,
+# use session_scope() instead.
+_session_factory = None
+
+# The session of the enclosing session_scope(), if any
+_current_session = contextvars.ContextVar('mailapi_aio_session',
+                                          default=None)
+
+# init_db(change_outbox=...)
+_change_outbox = False
+
+
+async def init_db(conn_str, pool_size=None, max_overflow=None,
+                  pool_recycle=None, pool_pre_ping=None, pool_timeout=None,
+                  schema=SCHEMA_REFLECT, schema_cache=None,
+                  schema_version=None, change_outbox=False):
+    """ Initialize a connection to the database through an async driver
+
+    :param conn_str: SQLAlchemy database URL using an async driver, e.g.
+                     mysql+aiomysql://... or sqlite+aiosqlite:///...
+    :param pool_size: See mailapi.db.init_db
+    :param max_overflow: See mailapi.db.init_db
+    :param pool_recycle: See mailapi.db.init_db
+    :param pool_pre_ping: See mailapi.db.init_db
+    :param pool_timeout: See mailapi.db.init_db
+    :param schema: See mailapi.db.init_db
+    :param schema_cache: See mailapi.db.init_db
+    :param schema_version: See mailapi.db.init_db
+    :param change_outbox: See mailapi.db.init_db
+    :return:
+    """
+    global _session_factory, _change_outbox
+
+    pool_options = dict(
+        (name, value) for name, value in (
+            ('pool_size', pool_size),
+            ('max_overflow', max_overflow),
+            ('pool_recycle', pool_recycle),
+            ('pool_pre_ping', pool_pre_ping),
+            ('pool_timeout', pool_timeout),
+        ) if value is not None
+    )
+
+    url = make_url(conn_str)
+    engine = create_async_engine(url, **pool_options)
+
+    if not models_mapped():
+        tables = load_metadata(url, schema, schema_cache, schema_version)
+        if tables is None:
+            # Reflection is done on a sync connection under the hood
+            async with engine.connect() as connection:
+                tables = await connection.run_sync(
+                    reflect, url, schema_cache, schema_version)
+        map_models(tables)
+
+    if _session_factory is not None:
+        await _session_factory.kw['bind'].dispose()
+
+    # Objects stay usable after the call's session is committed and closed
+    _session_factory = async_sessionmaker(engine, expire_on_commit=False)
+    _change_outbox = change_outbox
+
+
+def get_engine():
+    """ Get the async engine init_db created
+
+    :return: SQLAlchemy AsyncEngine object
+    :raises DbInitError: If init_db has not been called
+    """
+    if _session_factory is None:
+        raise DbInitError()
+    return _session_factory.kw['bind']
+
+
+@asynccontextmanager
+async def session_scope():
+    """ Runs the API calls made within in one session and transaction
+
+    The transaction is committed when the block exits and rolled back if it
+    raises.  Nested blocks join the outer one.  Don't share a scope between
+    concurrently running tasks, an AsyncSession is not safe for that.
+
+        async with session_scope():
+            await mailapi.aio.domain.create_domain('example.com')
+            await mailapi.aio.mailbox.create_mailbox('jdoe@example.com', ...)
+
+    :return: SQLAlchemy AsyncSession object
+    :raises DbInitError: If init_db has not been called
+    """
+    session = _current_session.get()
+    if session is not None:
+        yield session
+        return
+
+    if _session_factory is None:
+        raise DbInitError()
+
+    session = _session_factory()
+    token = _current_session.set(session)
+    try:
+        yield session
+        await session.commit()
+    except BaseException:
+        await session.rollback()
+        raise
+    finally:
+        _current_session.reset(token)
+        await session.close()
+
+
+def get_db_session():
+    """ Get the session of the current scope
+
+    :return: SQLAlchemy AsyncSession object
+    :raises RuntimeError: If called outside of session_scope()
+    """
+    session = _current_session.get()
+    if session is None:
+        raise RuntimeError('No session in this context, use session_scope().')
+    return session
+
+
+def with_session(coroutine_function):
+    """ Runs the decorated API coroutine in the current session or, without
+    one, in a session_scope() of its own
+    """
+
+    @functools.wraps(coroutine_function)
+    async def wrapper(*args, **kwargs):
+        if _current_session.get() is not None:
+            return await coroutine_function(*args, **kwargs)
+
+        async with session_scope():
+            return await coroutine_function(*args, **kwargs)
+
+    return wrapper
+
+
+def changes_active():
+    """ Whether changes are being recorded, see mailapi.changes.active """
+    return changes.active(_change_outbox)
+
+
+async def record_changes(entity, op, keys):
+    """ mailapi.changes.record in the current session
+
+    :param entity: DOMAIN, MAILBOX, ALIAS or USED_QUOTA
+    :param op: CREATE, UPDATE or DELETE
+    :param keys: Iterable of the changed rows' keys
+    """
+    if changes_active():
+        keys = list(keys)
+        await get_db_session().run_sync(
+            lambda s: changes.record(entity, op, keys, s, _change_outbox))
+
+
+async def affected(statement):
+    """ Keys of the rows a bulk update or delete is about to change, see
+    mailapi.changes.affected
+
+    :param statement: SELECT of the key column
+    :return: List of keys, empty (without querying) when nothing's recorded
+    """
+    if not changes_active():
+        return []
+    result = await get_db_session().execute(statement)
+    return list(result.scalars())
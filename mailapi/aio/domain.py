@@ -0,0 +1,171 @@
+""" Coroutine versions of mailapi.domain
+"""
+from datetime import datetime
+
+from sqlalchemy import select, delete
+
+from .. import changes
+from ..cache import forget_all, forget_domain
+from ..models import Domain, Mailbox, Alias, UsedQuota
+from ..validators import is_domain
+from ..exc import NoSuchDomain, DomainExists
+from .db import affected, get_db_session, record_changes, with_session
+
+
+@with_session
+async def create_domain(domain_name, description=''):
+    """ Adds domain name to the database
+
+    :param domain_name: A valid domain name
+    :param description: A description of the domain
+    :return: Domain model object
+    :raises DomainExists: if the given domain already exists
+    :raises ValueError: if the domain name is not a domain name
+    """
+
+    if not is_domain(domain_name):
+        raise ValueError('Invalid domain name supplied: %s' % domain_name)
+
+    if await domain_exists(domain_name):
+        raise DomainExists(domain_name)
+
+    db_session = get_db_session()
+    now = datetime.now()
+    d = Domain(domain=domain_name, description=description, created=now,
+               modified=now)
+    db_session.add(d)
+    await db_session.flush()
+
+    forget_domain(domain_name, db_session.sync_session)
+    await record_changes(changes.DOMAIN, changes.CREATE, [domain_name])
+    return d
+
+
+@with_session
+async def get_domain(domain_name: str):
+    """ Gets a domain with the given name from the db
+
+    :param domain_name: String
+    :return: Domain or None
+    """
+
+    result = await get_db_session().execute(
+        select(Domain).filter_by(domain=domain_name))
+    return result.scalars().one_or_none()
+
+
+@with_session
+async def get_all_mailboxes(domain_name):
+    """ Gets a list of all mailboxes associated with the given domain
+
+    :param domain_name: String
+    :return: Listof Mailbox objects
+    """
+
+    if not await domain_exists(domain_name):
+        raise NoSuchDomain(domain_name)
+
+    result = await get_db_session().execute(
+        select(Mailbox).filter_by(domain=domain_name))
+    return list(result.scalars())
+
+
+@with_session
+async def get_all_domains():
+    """ Fetches all domains from the database
+
+    :return: List of domains
+    """
+
+    result = await get_db_session().execute(select(Domain))
+    return list(result.scalars())
+
+
+@with_session
+async def delete_domain(domain_name):
+    """ Deletes the given domain name from the database
+
+    :param domain_name: String
+    :return: True if success
+    :raises NoSuchDomain: If the given domain name doesn't exist
+    """
+
+    if not await domain_exists(domain_name):
+        raise NoSuchDomain(domain_name)
+
+    await _delete_rows(Alias, Alias.address, changes.ALIAS, domain_name)
+    await _delete_rows(Mailbox, Mailbox.username, changes.MAILBOX,
+                       domain_name)
+    await _delete_rows(UsedQuota, UsedQuota.username, changes.USED_QUOTA,
+                       domain_name)
+
+    db_session = get_db_session()
+    result = await db_session.execute(
+        delete(Domain).filter_by(domain=domain_name))
+    await db_session.flush()
+
+    forget_domain(domain_name, db_session.sync_session)
+    if result.rowcount:
+        await record_changes(changes.DOMAIN, changes.DELETE, [domain_name])
+    return result.rowcount == 1
+
+
+async def _delete_rows(model, key, entity, domain_name):
+    """ Deletes the rows of a table in the given domain
+
+    :return: # of rows deleted
+    """
+    deleted = await affected(select(key).filter_by(domain=domain_name))
+    result = await get_db_session().execute(
+        delete(model).filter_by(domain=domain_name))
+
+    if model is Mailbox:
+        # The cache can't tell which of its mailboxes were in the domain
+        forget_all(get_db_session().sync_session)
+    await record_changes(entity, changes.DELETE, deleted)
+    return result.rowcount
+
+
+@with_session
+async def delete_aliases(domain_name):
+    """ Deletes all aliases in the given domain
+
+    :param domain_name: String
+    :return: True if success else False
+    :raises NoSuchDomain: If the given domain does not exist
+    """
+
+    if not await domain_exists(domain_name):
+        raise NoSuchDomain(domain_name)
+
+    return await _delete_rows(Alias, Alias.address, changes.ALIAS,
+                              domain_name) >= 1
+
+
+@with_session
+async def delete_mailboxes(domain_name):
+    """ Deletes all mailboxes (and their aliases) in the given domain
+
+    :param domain_name: String
+    :return: True if success else False
+    :raises NoSuchDomain: If the given domain does not exist
+    """
+
+    if not await domain_exists(domain_name):
+        raise NoSuchDomain(domain_name)
+
+    return await _delete_rows(Mailbox, Mailbox.username, changes.MAILBOX,
+                              domain_name) >= 1
+
+
+@with_session
+async def domain_exists(domain_name):
+    """ Checks if the given domain name exists in the database
+
+    :param domain_name: String
+    :return: True if domain exists else False
+    """
+
+    result = await get_db_session().execute(
+        select(Domain.domain).filter_by(domain=domain_name))
+    return result.first() is not None
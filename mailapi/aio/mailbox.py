@@ -0,0 +1,391 @@
+""" Coroutine versions of mailapi.mailbox
+
+Filesystem work (maildir provisioning, archiving) and password hashing run in
+the event loop's default executor so they don't block the loop.
+"""
+import asyncio
+from datetime import datetime
+
+from sqlalchemy import select, delete
+
+from .. import changes
+from ..cache import forget_mailboxes
+from ..models import Mailbox, Domain, Alias
+from ..helpers import parse_email_domain
+from ..maildir import generate_maildir_path, generate_unused_maildir_paths
+from ..password import generate_md5_password
+from ..storage import get_storage_backend, maildir_location, trash_on_commit
+from ..archive import archive_maildir, archive_path
+from ..alias import build_alias
+from ..mailbox import (
+    IN_CLAUSE_CHUNK_SIZE,
+    _build_mailbox,
+    _maildirs_in_use,
+    _parse_mailbox_records,
+    _place_mailboxes,
+    _release_mailboxes,
+)
+from ..exc import NoSuchDomain, MailboxExists, NoSuchMailbox
+from .alias import _save_alias, delete_aliases, delete_alias
+from .domain import domain_exists
+from .db import affected, get_db_session, record_changes, with_session
+
+
+async def _run_blocking(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+@with_session
+async def create_mailbox(email_address,
+                         full_name,
+                         plain_password,
+                         quota=0,
+                         language='en_US',
+                         storage_base_dir='/var/vmail',
+                         storage_node=None):
+    """ Creates a new mailbox
+
+    See mailapi.mailbox.create_mailbox
+
+    :return: Mailbox object
+    """
+
+    # Get domain and user; Possible ValueError
+    local_part, domain_part = parse_email_domain(email_address)
+
+    if not await domain_exists(domain_part):
+        raise NoSuchDomain(domain_part)
+
+    if await mailbox_exists(email_address):
+        raise MailboxExists(email_address)
+
+    db_session = get_db_session()
+
+    placed = []
+    if storage_node is None:
+        storage_node = (await db_session.run_sync(
+            lambda s: _place_mailboxes([quota], s)))[0]
+        placed.append(storage_node)
+
+    try:
+        # md5crypt takes a while
+        mailbox = await _run_blocking(
+            _build_mailbox, email_address, local_part, domain_part, full_name,
+            plain_password, quota, language, storage_base_dir, storage_node,
+            generate_maildir_path(email_address, validate=False))
+
+        # The self-referrential alias, see mailapi.mailbox.create_mailbox
+        await _save_alias(build_alias(email_address, email_address,
+                                      domain_part))
+
+        db_session.add(mailbox)
+        await db_session.flush()
+
+        forget_mailboxes([email_address], db_session.sync_session)
+        await record_changes(changes.ALIAS, changes.CREATE, [email_address])
+        await record_changes(changes.MAILBOX, changes.CREATE, [email_address])
+
+        storage_backend = get_storage_backend()
+        if storage_backend is not None:
+            await _run_blocking(storage_backend.provision, [mailbox])
+    except BaseException:
+        _release_mailboxes(placed, [quota], db_session.sync_session)
+        raise
+
+    return mailbox
+
+
+@with_session
+async def create_mailboxes(mailboxes,
+                           storage_base_dir='/var/vmail',
+                           storage_node=None):
+    """ Creates many mailboxes at once
+
+    See mailapi.mailbox.create_mailboxes
+
+    :return: List of Mailbox objects
+    """
+
+    addresses, parsed = _parse_mailbox_records(mailboxes)
+    if not parsed:
+        return []
+
+    db_session = get_db_session()
+
+    domain_names = set(domain_part for _, _, domain_part in parsed)
+    result = await db_session.execute(
+        select(Domain.domain).where(Domain.domain.in_(domain_names)))
+    missing_domains = domain_names - set(result.scalars())
+    if missing_domains:
+        raise NoSuchDomain(sorted(missing_domains)[0])
+
+    unique_addresses = sorted(addresses)
+    for i in range(0, len(unique_addresses), IN_CLAUSE_CHUNK_SIZE):
+        chunk = unique_addresses[i:i + IN_CLAUSE_CHUNK_SIZE]
+        result = await db_session.execute(
+            select(Mailbox.username).where(Mailbox.username.in_(chunk)))
+        existing = result.first()
+        if existing is not None:
+            raise MailboxExists(existing.username)
+
+    # Records without a storage node are spread over the nodes in one go
+    nodes = [record.get('storage_node', storage_node)
+             for record, _, _ in parsed]
+    unplaced = [i for i, node in enumerate(nodes) if node is None]
+    quotas = [parsed[i][0].get('quota', 0) for i in unplaced]
+    placed = await db_session.run_sync(lambda s: _place_mailboxes(quotas, s))
+    for i, node in zip(unplaced, placed):
+        nodes[i] = node
+
+    try:
+        maildirs = await db_session.run_sync(
+            lambda s: generate_unused_maildir_paths(
+                addresses, lambda paths: _maildirs_in_use(paths, s),
+                validate=False))
+
+        def build():
+            return [_build_mailbox(
+                record['email_address'],
+                local_part,
+                domain_part,
+                record['full_name'],
+                record['plain_password'],
+                record.get('quota', 0),
+                record.get('language', 'en_US'),
+                record.get('storage_base_dir', storage_base_dir),
+                node,
+                maildir,
+            ) for (record, local_part, domain_part), node, maildir in
+                zip(parsed, nodes, maildirs)]
+
+        # One md5crypt per mailbox, off the loop
+        created = await _run_blocking(build)
+        for mailbox in created:
+            db_session.add(build_alias(mailbox.username, mailbox.username,
+                                       mailbox.domain))
+            db_session.add(mailbox)
+
+        await db_session.flush()
+
+        forget_mailboxes(addresses, db_session.sync_session)
+        await record_changes(changes.ALIAS, changes.CREATE, addresses)
+        await record_changes(changes.MAILBOX, changes.CREATE, addresses)
+
+        storage_backend = get_storage_backend()
+        if storage_backend is not None:
+            await _run_blocking(storage_backend.provision, created)
+    except BaseException:
+        _release_mailboxes(placed, quotas, db_session.sync_session)
+        raise
+
+    return created
+
+
+@with_session
+async def generate_unique_maildir_paths(email_addresses, **kwargs):
+    """ See mailapi.mailbox.generate_unique_maildir_paths
+
+    :return: List of maildir paths, in the same order as @email_addresses
+    """
+
+    return await get_db_session().run_sync(
+        lambda s: generate_unused_maildir_paths(
+            email_addresses, lambda paths: _maildirs_in_use(paths, s),
+            **kwargs))
+
+
+@with_session
+async def mailbox_exists(email_address):
+    """ Determines if a mailbox with the given email address exists in the DB
+
+    :param email_address: String
+    :return: True if the mailbox exists else False
+    """
+
+    result = await get_db_session().execute(
+        select(Mailbox.username).filter_by(username=email_address))
+    return result.first() is not None
+
+
+@with_session
+async def delete_mailbox(email_address, archive_to=None):
+    """ Deletes the mailbox from the database by the given email address.
+
+    See mailapi.mailbox.delete_mailbox
+
+    :return: True if success else False
+    """
+
+    if not await mailbox_exists(email_address):
+        raise NoSuchMailbox(email_address)
+
+    # The row is needed to locate the maildir once it's gone from the db
+    storage_backend = get_storage_backend()
+    mailbox = None
+    if storage_backend is not None or archive_to is not None:
+        mailbox = await get_mailbox(email_address)
+
+    if archive_to is not None:
+        await _run_blocking(archive_maildir,
+                            maildir_location(mailbox),
+                            archive_path(archive_to, email_address))
+
+    await delete_aliases(email_address)
+    await delete_alias(email_address, email_address)
+    db_session = get_db_session()
+    result = await db_session.execute(
+        delete(Mailbox).filter_by(username=email_address))
+
+    forget_mailboxes([email_address], db_session.sync_session)
+    if result.rowcount:
+        await record_changes(changes.MAILBOX, changes.DELETE,
+                             [email_address])
+
+    if storage_backend is not None:
+        trash_on_commit(db_session.sync_session, [mailbox])
+
+    return result.rowcount == 1
+
+
+@with_session
+async def delete_mailboxes(email_addresses, archive_to=None):
+    """ Deletes many mailboxes (and their aliases) at once
+
+    See mailapi.mailbox.delete_mailboxes; the archives are written
+    concurrently in the loop's default executor.  If an archive fails, the
+    session is committed before the error is raised (anything else pending
+    in it goes along), so the other mailboxes stay deleted.
+
+    :return: Dict of email address => archive path (None when not archived)
+    """
+
+    email_addresses = list(email_addresses)
+    db_session = get_db_session()
+
+    mailboxes = {}
+    for i in range(0, len(email_addresses), IN_CLAUSE_CHUNK_SIZE):
+        chunk = email_addresses[i:i + IN_CLAUSE_CHUNK_SIZE]
+        result = await db_session.execute(
+            select(Mailbox).where(Mailbox.username.in_(chunk)))
+        for mailbox in result.scalars():
+            mailboxes[mailbox.username] = mailbox
+
+    for email_address in email_addresses:
+        if email_address not in mailboxes:
+            raise NoSuchMailbox(email_address)
+
+    archives = dict((email_address, None) for email_address in mailboxes)
+    error = None
+
+    if archive_to is not None:
+        usernames = list(mailboxes)
+        results = await asyncio.gather(*[
+            _run_blocking(archive_maildir,
+                          maildir_location(mailboxes[username]),
+                          archive_path(archive_to, username))
+            for username in usernames
+        ], return_exceptions=True)
+
+        for username, result in zip(usernames, results):
+            if isinstance(result, Exception):
+                error = error or result
+                del archives[username]
+            else:
+                archives[username] = result
+
+    deleted = sorted(archives)
+    for i in range(0, len(deleted), IN_CLAUSE_CHUNK_SIZE):
+        chunk = deleted[i:i + IN_CLAUSE_CHUNK_SIZE]
+
+        # Every alias pointing at the mailbox, the self-referrential included
+        await record_changes(changes.ALIAS, changes.DELETE, await affected(
+            select(Alias.address).where(Alias.goto.in_(chunk))))
+        await db_session.execute(delete(Alias).where(Alias.goto.in_(chunk)))
+        await db_session.execute(
+            delete(Mailbox).where(Mailbox.username.in_(chunk)))
+
+    await db_session.flush()
+    forget_mailboxes(deleted, db_session.sync_session)
+    await record_changes(changes.MAILBOX, changes.DELETE, deleted)
+
+    trash_on_commit(db_session.sync_session,
+                    [mailboxes[a] for a in deleted])
+
+    if error is not None:
+        # The scope rolls back on the way out, keep what was deleted
+        await db_session.commit()
+        raise error
+
+    return archives
+
+
+@with_session
+async def get_all_mailboxes():
+    """ Gets a list of all mailboxes defined in the database
+
+    :return: List of Mailbox objects
+    """
+
+    result = await get_db_session().execute(
+        select(Mailbox).order_by(Mailbox.username))
+    return list(result.scalars())
+
+
+@with_session
+async def get_mailbox(email_address):
+    """ Gets the mailbox by the given email address
+
+    :param email_address: String
+    :return: Mailbox or None
+    """
+
+    result = await get_db_session().execute(
+        select(Mailbox).filter_by(username=email_address))
+    return result.scalars().one_or_none()
+
+
+@with_session
+async def reset_mailbox_password(email_address, plain_password):
+    """ Sets the password for the given email address to the given password
+
+    :param email_address: Email address
+    :param plain_password: The new desired password in plain text form
+    :return: True if success
+    :raises NoSuchMailbox: If the given email address does not exist
+    """
+
+    mailbox = await get_mailbox(email_address)
+    if mailbox is None:
+        raise NoSuchMailbox(email_address)
+
+    mailbox.password = await _run_blocking(generate_md5_password,
+                                           plain_password)
+    mailbox.modified = datetime.now()
+    mailbox.passwordlastchanged = datetime.now()
+
+    db_session = get_db_session()
+    db_session.add(mailbox)
+    await db_session.flush()
+
+    forget_mailboxes([email_address], db_session.sync_session)
+    await record_changes(changes.MAILBOX, changes.UPDATE, [email_address])
+
+    return True
+
+
+@with_session
+async def search_mailboxes(search_string):
+    """ Returns a list of mailboxes with their email address or name like the
+    search string.
+
+    :param search_string: String
+    :return: List of Mailbox objects
+    """
+
+    fuzzy_search_string = '%' + search_string + '%'
+
+    result = await get_db_session().execute(select(Mailbox).where(
+        Mailbox.name.like(fuzzy_search_string) |
+        Mailbox.username.like(fuzzy_search_string)))
+
+    return list(result.scalars())
@@ -0,0 +1,94 @@
+""" Coroutine versions of mailapi.used_quota
+"""
+from sqlalchemy import select, delete, func
+
+from .. import changes
+from ..models import UsedQuota
+from ..exc import NoSuchDomain, NoSuchMailbox
+from .domain import domain_exists
+from .mailbox import mailbox_exists
+from .db import get_db_session, record_changes, with_session
+
+
+@with_session
+async def get_domain_sum_used_quota(domain: str):
+    if not await domain_exists(domain):
+        raise NoSuchDomain(domain)
+
+    result = await get_db_session().execute(select(
+        func.sum(UsedQuota.bytes).label('bytes'),
+        func.sum(UsedQuota.messages).label('messages'),
+    ).filter_by(domain=domain))
+    return result.one()
+
+
+@with_session
+async def get_mailbox_sum_used_quota(email_address: str):
+    if not await mailbox_exists(email_address):
+        raise NoSuchMailbox(email_address)
+
+    result = await get_db_session().execute(select(
+        UsedQuota.bytes, UsedQuota.messages
+    ).filter_by(username=email_address))
+    return result.one()
+
+
+@with_session
+async def get_domain_used_quota(domain: str):
+    if not await domain_exists(domain):
+        raise NoSuchDomain(domain)
+
+    result = await get_db_session().execute(
+        select(UsedQuota).filter_by(domain=domain))
+    return list(result.scalars())
+
+
+@with_session
+async def get_mailbox_used_quota(email_address: str):
+    if not await mailbox_exists(email_address):
+        raise NoSuchMailbox(email_address)
+
+    result = await get_db_session().execute(
+        select(UsedQuota).filter_by(username=email_address))
+    return result.scalars().one()
+
+
+@with_session
+async def delete_used_quota_mailbox(email_address):
+    """ Deletes the used quota of the mailbox by the given email address.
+
+    :param email_address: String
+    :return: True if success else False
+    """
+
+    if not await mailbox_exists(email_address):
+        raise NoSuchMailbox(email_address)
+
+    result = await get_db_session().execute(
+        delete(UsedQuota).filter_by(username=email_address))
+
+    if result.rowcount:
+        await record_changes(changes.USED_QUOTA, changes.DELETE,
+                             [email_address])
+    return result.rowcount == 1
+
+
+@with_session
+async def reset_mailbox_used_quota(email_address):
+    """ Sets the used bytes and messages of the given mailbox to 0
+
+    :param email_address: Email address
+    :return: True if success
+    :raises NoSuchMailbox: If the given email address does not exist
+    """
+
+    used_quota = await get_mailbox_used_quota(email_address)
+    used_quota.bytes = 0
+    used_quota.messages = 0
+
+    db_session = get_db_session()
+    db_session.add(used_quota)
+    await db_session.flush()
+
+    await record_changes(changes.USED_QUOTA, changes.UPDATE, [email_address])
+    return True
@@ -1,12 +1,22 @@
+from datetime import datetime
+
+from sqlalchemy import or_, select, update
 from sqlalchemy.exc import IntegrityError
 
 from .models import Alias
 from .helpers import parse_email_domain
-from .db import get_db_session
+from .db import (get_db_session, changed_since, flush, in_transaction,
+                 iter_changed, listing, read_only, writes)
 from .validators import is_email
+from . import changes
 from .exc import AliasExists
 
 
+# Rows per executemany of _rewrite_gotos
+UPDATE_BATCH_SIZE = 1000
+
+
+@writes
 def add_alias(source, dest):
     """ Create an alias for the given email address
 
@@ -24,23 +34,94 @@ def add_alias(source, dest):
         raise ValueError('Invalid destination email address provided: %s' %
                          dest)
 
-    local_part, domain = parse_email_domain(dest)
+    local_part, domain = dest.split('@')
+
+    alias = _save_alias(build_alias(source, dest, domain))
+    changes.record(changes.ALIAS, changes.CREATE, [source])
+    return alias
+
+
+def _save_alias(alias):
+    """ Adds the given Alias object to the database
+
+    :raises AliasExists: If the given alias already exists (outside of a
+                         transaction() block, inside one the duplicate shows
+                         up as an IntegrityError once the alias is flushed)
+    """
+
+    db_session = get_db_session()
+
+    # Batched with the other writes of the enclosing transaction() block
+    if in_transaction(db_session):
+        db_session.add(alias)
+        return alias
+
+    # A savepoint so a duplicate doesn't roll back the caller's other work
+    try:
+        with db_session.begin_nested():
+            db_session.add(alias)
+        return alias
+    except IntegrityError:
+        raise AliasExists(alias.address, alias.goto)
+
+
+def build_alias(source, dest, domain=None):
+    """ Creates an (unsaved) Alias object for the given addresses
+
+    :param source: Incoming email address
+    :param dest: Redirect to this mailbox
+    :param domain: Domain of @dest if the caller already parsed it
+    :return: Alias
+    :raises ValueError: if an invalid dest email address is provided
+    """
+
+    if domain is None:
+        local_part, domain = parse_email_domain(dest)
 
     alias = Alias()
     alias.address = source
     alias.goto = dest
     alias.domain = domain
+    alias.created = alias.modified = datetime.now()
+
+    return alias
+
+
+def _rewrite_gotos(domains, rename, now):
+    """ Points the aliases at the new addresses of renamed mailboxes
+
+    Comma separated destinations can't be rewritten portably in SQL: the
+    aliases mentioning one of @domains are read with one query and the
+    changed ones written back with executemany UPDATEs by primary key.
+
+    :param domains: Domain names of the renamed addresses
+    :param rename: Callable returning the new address of an address, None if
+                   it isn't renamed
+    :param now: datetime the aliases are modified at
+    :return: Addresses of the aliases whose goto changed
+    """
 
     db_session = get_db_session()
-    try:
-        db_session.add(alias)
-        db_session.flush()
-        return alias
-    except IntegrityError:
-        db_session.rollback()
-        raise AliasExists(source, dest)
+    mentions = or_(*[Alias.goto.contains('@' + domain, autoescape=True)
+                     for domain in domains])
+
+    rows = []
+    for address, goto in db_session.execute(
+            select(Alias.address, Alias.goto).where(mentions)):
+        targets = goto.split(',')
+        renamed = [rename(target.strip()) or target for target in targets]
+        if renamed != targets:
+            rows.append({'address': address, 'goto': ','.join(renamed),
+                         'modified': now})
 
+    for i in range(0, len(rows), UPDATE_BATCH_SIZE):
+        db_session.execute(update(Alias), rows[i:i + UPDATE_BATCH_SIZE])
 
+    return [row['address'] for row in rows]
+
+
+@read_only
+@listing
 def get_aliases(dest):
     """ Get all aliases that redirect to the given @dest email address
 
@@ -51,6 +132,38 @@ def get_aliases(dest):
     return get_db_session().query(Alias).filter_by(goto=dest).all()
 
 
+@read_only
+@listing
+def get_aliases_changed_since(timestamp, cursor=None, limit=500):
+    """ A page of the aliases modified at or after the given time, by
+    (modified, address)
+
+    :param timestamp: datetime
+    :param cursor: (modified, address) of the last alias of the previous
+                   page, @timestamp is ignored then
+    :param limit: Max # of aliases returned
+    :return: List of mailapi.models.Alias objects
+    """
+
+    return changed_since(get_db_session().query(Alias), Alias.modified,
+                         Alias.address, timestamp, cursor).limit(limit).all()
+
+
+def iter_changed_since(timestamp, cursor=None, batch_size=500):
+    """ Streams the aliases modified at or after the given time, by
+    (modified, address), see mailbox.iter_changed_since
+
+    :param timestamp: datetime
+    :param cursor: (modified, address) to continue after
+    :param batch_size: # of aliases read per query
+    :return: Generator of mailapi.models.Alias objects
+    """
+
+    return iter_changed(get_aliases_changed_since, 'address', timestamp,
+                        cursor, batch_size)
+
+
+@writes
 def delete_aliases(dest):
     """ Deletes all aliases that redirect to the given email address except for
     the self-referrential alias which must be explicitly deleted.
@@ -60,15 +173,18 @@ def delete_aliases(dest):
     """
 
     db_session = get_db_session()
-    num_deleted = db_session.query(Alias).\
+    query = db_session.query(Alias).\
         filter(Alias.goto == dest).\
-        filter(Alias.address != dest).\
-        delete()
-    db_session.flush()
+        filter(Alias.address != dest)
+    deleted = changes.affected(query, Alias.address)
+    num_deleted = query.delete()
+    flush(db_session)
 
+    changes.record(changes.ALIAS, changes.DELETE, deleted)
     return num_deleted >= 1
 
 
+@writes
 def delete_alias(source, dest):
     """ Delete an alias matching the given @source and @dest addresses
 
@@ -82,6 +198,8 @@ def delete_alias(source, dest):
         filter(Alias.address == source,
                Alias.goto == dest).\
         delete()
-    db_session.flush()
+    flush(db_session)
 
+    if num_deleted:
+        changes.record(changes.ALIAS, changes.DELETE, [source])
     return num_deleted == 1
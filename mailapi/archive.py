@@ -0,0 +1,109 @@
+""" Compressed archives of maildirs
+
+Used by mailapi.mailbox when a mailbox is deleted with archive_to=... so the
+maildir is kept around as a single .tar.gz file.
+"""
+import os
+import tarfile
+import time
+import uuid
+
+
+# Files are copied into the archive this many bytes at a time; messages are
+# never read into memory as a whole.
+CHUNK_SIZE = 1024 * 1024
+
+ARCHIVE_EXTENSION = '.tar.gz'
+
+
+def archive_path(archive_dir, email_address):
+    """ Path of the archive for the given mailbox within @archive_dir
+
+    A timestamp is part of the name so an address that is re-created and
+    deleted again doesn't overwrite its previous archive; when the name is
+    taken all the same (within the same second) a counter is appended:
+    <name>-2.tar.gz, <name>-3.tar.gz...
+
+    :param archive_dir: String
+    :param email_address: String
+    :return: String
+    """
+    base = os.path.join(archive_dir, '%s-%s' % (
+        email_address.lower(),
+        time.strftime('%Y.%m.%d.%H.%M.%S'),
+    ))
+
+    path = base + ARCHIVE_EXTENSION
+    counter = 2
+    while os.path.exists(path):
+        path = '%s-%d%s' % (base, counter, ARCHIVE_EXTENSION)
+        counter += 1
+
+    return path
+
+
+def archive_maildir(maildir, destination, chunk_size=CHUNK_SIZE,
+                    compress_level=6):
+    """ Streams the given maildir into a gzip compressed tar file
+
+    The archive is written to a temporary name, fsynced and then linked into
+    place, so once this returns the archive is durable.  An existing file at
+    @destination is never replaced.
+
+    :param maildir: Absolute path of the maildir
+    :param destination: Path of the .tar.gz file to create
+    :param chunk_size: Int, # of bytes copied at a time
+    :param compress_level: Int, gzip compression level (1-9)
+    :return: destination
+    :raises FileNotFoundError: If the maildir doesn't exist
+    :raises FileExistsError: If @destination already exists
+    """
+
+    maildir = maildir.rstrip(os.sep)
+    if not os.path.isdir(maildir):
+        raise FileNotFoundError('No such maildir: %s' % maildir)
+
+    destination_dir = os.path.dirname(os.path.abspath(destination))
+    os.makedirs(destination_dir, exist_ok=True)
+
+    # Unique, two archives racing for @destination don't share it
+    partial = '%s.%s.part' % (destination, uuid.uuid4().hex)
+    try:
+        with open(partial, 'wb') as raw:
+            with tarfile.open(fileobj=raw,
+                              mode='w:gz',
+                              compresslevel=compress_level,
+                              copybufsize=chunk_size) as tar:
+                # Entries are relative to the maildir's name, e.g. user/cur/..
+                tar.add(maildir, arcname=os.path.basename(maildir))
+
+            raw.flush()
+            os.fsync(raw.fileno())
+
+        # Unlike a rename, linking fails when @destination exists
+        os.link(partial, destination)
+        os.unlink(partial)
+    except BaseException:
+        if os.path.exists(partial):
+            os.unlink(partial)
+        raise
+
+    # Makes the link itself durable
+    _fsync_dir(destination_dir)
+
+    return destination
+
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # Not every platform lets you open a directory
+        return
+
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
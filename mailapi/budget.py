@@ -0,0 +1,160 @@
+""" Statement budgets and N+1 detection
+
+    with mailapi.query_budget(max_statements=2, max_repeats=1):
+        for d in mailapi.domain.get_all_domains():
+            mailapi.used_quota.get_domain_sum_used_quota(d.domain)
+
+raises QueryBudgetExceeded once the block exits: it sent one statement per
+domain, all of the same shape.  The statements are counted per context
+(thread or task), so concurrent calls elsewhere in the process don't count
+against a budget.
+"""
+import re
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .exc import QueryBudgetExceeded
+
+
+# Budgets open in this context, innermost last
+_budgets = ContextVar('mailapi_query_budgets', default=())
+
+# # of open budgets in the process; the event listener is attached while
+# there is any
+_open = 0
+_lock = threading.Lock()
+
+# Only sent as a statement by some drivers (pysqlite, when mailapi opens a
+# transaction for a savepoint), so never counted
+_UNCOUNTED = ('BEGIN',)
+
+# Transaction control statements, expected to repeat
+_CONTROL_RE = re.compile(r'^\s*(BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE)\b',
+                         re.IGNORECASE)
+
+# A parenthesized list of bind parameters, (?, ?, ?) or (%s, %s) or
+# (:a, :b), and runs of those as in multi-row VALUES
+_PARAMS_RE = re.compile(
+    r'\(\s*(?:\?|%s|%\(\w+\)s|:\w+)(?:\s*,\s*(?:\?|%s|%\(\w+\)s|:\w+))*\s*\)'
+    r'(?:\s*,\s*\(\s*(?:\?|%s|%\(\w+\)s|:\w+)'
+    r'(?:\s*,\s*(?:\?|%s|%\(\w+\)s|:\w+))*\s*\))*')
+
+
+def statement_shape(statement):
+    """ The statement with its IN lists and multi-row VALUES collapsed
+
+    Two statements of the same shape differ in their parameters only, e.g.
+    IN (?, ?) and IN (?, ?, ?) are both IN (...).
+
+    :param statement: SQL string as sent to the driver
+    :return: String
+    """
+    return ' '.join(_PARAMS_RE.sub('(...)', statement).split())
+
+
+class QueryBudget(object):
+    """ Handle returned by query_budget()
+
+    :ivar statements: SQL of every statement issued within the block so far
+    """
+
+    def __init__(self, max_statements=None, max_repeats=None):
+        self.max_statements = max_statements
+        self.max_repeats = max_repeats
+        self.statements = []
+
+    @property
+    def count(self):
+        """ # of statements issued within the block so far """
+        return len(self.statements)
+
+    def repeated(self, max_repeats=None):
+        """ Statement shapes issued more than @max_repeats times, not counting
+        transaction control statements
+
+        :param max_repeats: Defaults to the budget's max_repeats, or 1
+        :return: Dict of shape => # of times it was issued
+        """
+        if max_repeats is None:
+            max_repeats = self.max_repeats or 1
+
+        shapes = Counter(statement_shape(statement)
+                         for statement in self.statements
+                         if not _CONTROL_RE.match(statement))
+        return dict((shape, count) for shape, count in shapes.items()
+                    if count > max_repeats)
+
+    def problems(self):
+        """ Why the block is over budget
+
+        :return: List of strings, empty if it's within budget
+        """
+        problems = []
+        if self.max_statements is not None and \
+           self.count > self.max_statements:
+            problems.append('%d statements issued, %d allowed' % (
+                self.count, self.max_statements))
+
+        if self.max_repeats is not None:
+            for shape, count in sorted(self.repeated().items()):
+                problems.append('Issued %d times (N+1?): %s' % (count, shape))
+
+        return problems
+
+    def check(self):
+        """ Raises QueryBudgetExceeded if the block is over budget """
+        problems = self.problems()
+        if problems:
+            raise QueryBudgetExceeded(problems, self.statements)
+
+
+def _count_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    budgets = _budgets.get()
+    if budgets and statement.strip().upper() not in _UNCOUNTED:
+        for budget in budgets:
+            budget.statements.append(statement)
+
+
+@contextmanager
+def query_budget(max_statements=None, max_repeats=None):
+    """ Counts the statements sent to the database within the block
+
+    Budgets nest, a statement counts against every open one.  Nothing is
+    raised while the block runs, so the session is never left half way
+    through a call.
+
+    :param max_statements: Most statements the block may issue
+    :param max_repeats: Most times the block may issue statements of the same
+                        shape (see statement_shape), None doesn't check
+    :return: QueryBudget
+    :raises QueryBudgetExceeded: When the block exits over budget, unless it
+                                 raised itself
+    """
+    global _open
+
+    budget = QueryBudget(max_statements, max_repeats)
+
+    with _lock:
+        if not _open:
+            event.listen(Engine, 'before_cursor_execute', _count_statement)
+        _open += 1
+
+    token = _budgets.set(_budgets.get() + (budget,))
+    try:
+        yield budget
+    finally:
+        _budgets.reset(token)
+
+        with _lock:
+            _open -= 1
+            if not _open:
+                event.remove(Engine, 'before_cursor_execute',
+                             _count_statement)
+
+    budget.check()
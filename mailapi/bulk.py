@@ -0,0 +1,60 @@
+""" Fast executemany() INSERTs of plain tuples
+
+    inserter = BulkInsert(connection, schema.alias, ('address', 'goto',
+                                                     'domain'))
+    inserter.rows.append(('info@example.com', 'jdoe@example.com',
+                          'example.com'))
+    inserter.flush()
+
+Used to seed test databases and to restore snapshots, where millions of rows
+go in without any model objects.
+"""
+import operator
+
+from sqlalchemy import insert
+
+
+class BulkInsert(object):
+    """ executemany() of tuples into one table
+
+    With a positional paramstyle (sqlite3, pymysql, mysqlclient) the tuples go
+    to the driver as they are, skipping SQLAlchemy's per row parameter
+    processing; that's what makes seeding millions of rows practical.
+    """
+
+    def __init__(self, connection, table, columns):
+        self.connection = connection
+        self.table = table
+        self.columns = columns
+        self.rows = []
+        self.count = 0
+
+        compiled = insert(table).compile(dialect=connection.dialect,
+                                         column_keys=list(columns))
+        self.sql = None
+        self.reorder = None
+        if connection.dialect.positional and \
+           sorted(compiled.positiontup) == sorted(columns):
+            self.sql = str(compiled)
+
+            # The statement lists the columns in the table's order
+            if tuple(compiled.positiontup) != tuple(columns):
+                self.reorder = operator.itemgetter(
+                    *[columns.index(key) for key in compiled.positiontup])
+
+    def flush(self):
+        """ Sends the pending rows, if any """
+        if not self.rows:
+            return
+
+        if self.sql is not None:
+            rows = self.rows
+            if self.reorder is not None:
+                rows = list(map(self.reorder, rows))
+            self.connection.exec_driver_sql(self.sql, rows)
+        else:
+            self.connection.execute(insert(self.table), [
+                dict(zip(self.columns, row)) for row in self.rows])
+
+        self.count += len(self.rows)
+        self.rows = []
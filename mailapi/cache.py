@@ -0,0 +1,404 @@
+""" Read-through cache of domain and mailbox lookups
+
+domain_exists, get_domain, mailbox_exists and get_mailbox run inside nearly
+every API call.  With a cache configured their results are kept for a while
+instead of being read from the database each time:
+
+    from mailapi.cache import Cache, SQLiteBackend, set_cache
+
+    set_cache(Cache(ttl=60))                                  # per process
+    set_cache(Cache(SQLiteBackend('/run/mailapi/cache.db')))  # per host
+
+The library's own writes (create_domain, delete_domain, create_mailbox(es),
+delete_mailbox(es), reset_mailbox_password...) drop the entries they make
+stale, once when they run and again when their transaction commits.  Changes
+made by anything else, another host included, show up once the entries
+expire.  Nothing read by a session with uncommitted writes is cached.
+"""
+import functools
+import inspect
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.orm.base import instance_state
+
+from .db import _WRITING, get_database, get_db_session
+
+
+# What a backend returns for keys it doesn't have (None is a valid value)
+MISSING = object()
+
+# Session.info key holding the keys to drop again once the session commits
+_STALE = 'mailapi.cache_stale'
+_STALE_ALL = '*'
+
+# The cache the API functions use, None means "no caching".  Use set_cache()
+# to change it.
+_cache = None
+
+
+class MemoryBackend(object):
+    """ Least recently used entries of one process
+    """
+
+    def __init__(self, max_size=10000):
+        """
+        :param max_size: # of entries kept, the least recently used ones are
+                         evicted first
+        """
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return MISSING
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteBackend(object):
+    """ Entries in a SQLite file, shared by every process of the host
+
+    Reads don't write: how recently an entry was used is only updated once
+    a second, so eviction is roughly least recently used.
+    """
+
+    # Sets between two evictions
+    EVICT_EVERY = 100
+
+    def __init__(self, path, max_size=100000, timeout=5.0):
+        """
+        :param path: Database file, created if need be
+        :param max_size: # of entries kept
+        :param timeout: Seconds to wait for another process' write
+        """
+        self.path = path
+        self.max_size = max_size
+        self.timeout = timeout
+        self._local = threading.local()
+        self._sets = 0
+
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS cache ('
+            'key TEXT PRIMARY KEY, value BLOB NOT NULL, '
+            'expires REAL NOT NULL, used REAL NOT NULL)')
+
+    def _connection(self):
+        # One connection per thread and process, sqlite3 connections can't be
+        # shared by either
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get(self, key):
+        connection = self._connection()
+        row = connection.execute(
+            'SELECT value, expires, used FROM cache WHERE key = ?',
+            (key,)).fetchone()
+        if row is None:
+            return MISSING
+
+        value, expires, used = row
+        now = time.time()
+        if expires < now:
+            connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+            return MISSING
+
+        if now - used > 1:
+            connection.execute('UPDATE cache SET used = ? WHERE key = ?',
+                               (now, key))
+        return pickle.loads(value)
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        connection = self._connection()
+        connection.execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires, used) '
+            'VALUES (?, ?, ?, ?)',
+            (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), now + ttl,
+             now))
+
+        self._sets += 1
+        if self._sets % self.EVICT_EVERY == 0:
+            self.evict()
+
+    def evict(self):
+        """ Removes expired entries and the least recently used ones above
+        max_size
+        """
+        connection = self._connection()
+        connection.execute('DELETE FROM cache WHERE expires < ?',
+                           (time.time(),))
+        connection.execute(
+            'DELETE FROM cache WHERE key IN (SELECT key FROM cache '
+            'ORDER BY used DESC LIMIT -1 OFFSET ?)', (self.max_size,))
+
+    def delete(self, keys):
+        keys = list(keys)
+        if keys:
+            self._connection().execute(
+                'DELETE FROM cache WHERE key IN (%s)' %
+                ', '.join('?' * len(keys)), keys)
+
+    def clear(self):
+        self._connection().execute('DELETE FROM cache')
+
+    def __len__(self):
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM cache').fetchone()[0]
+
+
+class Cache(object):
+    """ A backend plus how long its entries are good for
+    """
+
+    def __init__(self, backend=None, ttl=60):
+        """
+        :param backend: MemoryBackend (the default), SQLiteBackend or any
+                        object with their get/set/delete/clear methods
+        :param ttl: Seconds an entry is used for
+        """
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value, self.ttl)
+
+    def delete(self, keys):
+        self.backend.delete(keys)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        """ Dict of hits, misses and hit ratio since the cache was created """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / lookups if lookups else None,
+        }
+
+
+def set_cache(cache):
+    """ Sets the cache of the domain and mailbox lookups
+
+    :param cache: Cache object or None to disable caching
+    :return: The previous cache
+    """
+    global _cache
+
+    if cache is not None and \
+       not event.contains(Session, 'after_commit', _drop_stale):
+        event.listen(Session, 'after_commit', _drop_stale)
+
+    previous = _cache
+    _cache = cache
+    return previous
+
+
+def get_cache():
+    """ Gets the configured cache
+
+    :return: Cache or None
+    """
+    return _cache
+
+
+# Database => (its URL, the namespace of its keys)
+_namespaces = weakref.WeakKeyDictionary()
+
+
+def _key(kind, value):
+    # Each database (see mailapi.client) has keys of its own
+    database = get_database()
+    url, namespace = _namespaces.get(database, (None, None))
+    if url is not database.url:
+        namespace = database.url.render_as_string(hide_password=True)
+        _namespaces[database] = (database.url, namespace)
+
+    return '%s|%s|%s' % (namespace, kind, value)
+
+
+def _to_row(instance):
+    if instance is None:
+        return None
+    return dict((attribute.key, getattr(instance, attribute.key))
+                for attribute in
+                instance_state(instance).mapper.column_attrs)
+
+
+def _from_row(model, row, db_session):
+    """ The instance @row was made from, in @db_session without a query """
+    if row is None:
+        return None
+
+    instance = model(**row)
+    make_transient_to_detached(instance)
+
+    # Whatever the session already has wins, it may have unflushed changes
+    existing = db_session.identity_map.get(
+        instance_state(instance).key)
+    if existing is not None:
+        return existing
+
+    return db_session.merge(instance, load=False)
+
+
+def cached(kind, model=None):
+    """ Decorates a lookup by a single key with the read-through cache
+
+    :param kind: Name of the lookup, part of the cache key
+    :param model: Model class the lookup returns (or None) instances of,
+                  None for lookups returning plain values
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            cache = _cache
+            if cache is None:
+                return func(*args, **kwargs)
+
+            # The key, whether it's passed by position or by name
+            bound = signature.bind(*args, **kwargs)
+            value = next(iter(bound.arguments.values()))
+
+            key = _key(kind, value)
+            db_session = get_db_session()
+
+            result = cache.get(key)
+            if result is not MISSING:
+                if model is not None:
+                    return _from_row(model, result, db_session)
+                return result
+
+            result = func(*args, **kwargs)
+
+            # Uncommitted writes may still be rolled back
+            if not db_session.info.get(_WRITING) and \
+               not (db_session.new or db_session.dirty or db_session.deleted):
+                cache.set(key, _to_row(result) if model is not None
+                          else result)
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def _forget(keys, db_session=None):
+    cache = _cache
+    if cache is None:
+        return
+
+    cache.delete(keys)
+
+    # Until the transaction commits other sessions still read the old rows
+    # and may cache them again
+    db_session = db_session or get_db_session()
+    db_session.info.setdefault(_STALE, set()).update(keys)
+
+
+def forget_domain(domain_name, db_session=None):
+    """ Drops the cached lookups of a domain
+
+    :param domain_name: String
+    :param db_session: Session whose commit drops them again, the calling
+                       thread's by default (the sync_session of an
+                       AsyncSession for mailapi.aio)
+    """
+    if _cache is not None:
+        _forget([_key('domain_exists', domain_name),
+                 _key('get_domain', domain_name)], db_session)
+
+
+def forget_mailboxes(email_addresses, db_session=None):
+    """ Drops the cached lookups of mailboxes
+
+    :param email_addresses: Iterable of Strings
+    :param db_session: See forget_domain
+    """
+    if _cache is not None:
+        _forget([_key(kind, address) for address in email_addresses
+                 for kind in ('mailbox_exists', 'get_mailbox')], db_session)
+
+
+def forget_all(db_session=None):
+    """ Drops every cached lookup, of every database
+
+    :param db_session: See forget_domain
+    """
+    cache = _cache
+    if cache is None:
+        return
+
+    cache.clear()
+    db_session = db_session or get_db_session()
+    db_session.info.setdefault(_STALE, set()).add(_STALE_ALL)
+
+
+def _drop_stale(session):
+    keys = session.info.pop(_STALE, None)
+    cache = _cache
+    if not keys or cache is None:
+        return
+
+    if _STALE_ALL in keys:
+        cache.clear()
+    else:
+        cache.delete(keys)
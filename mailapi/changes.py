@@ -0,0 +1,286 @@
+""" Feed of the changes made through the API
+
+The write functions of mailapi.domain, mailapi.mailbox, mailapi.alias and
+mailapi.used_quota record what they changed as Change events, in order: the
+entity ('domain', 'mailbox', 'alias' or 'used_quota'), its key (the domain
+name, email address or alias address), the operation ('create', 'update' or
+'delete') and a sequence number.  Consumers get them in one of two ways:
+
+- In process: subscribe(callback) calls callback(changes) with the changes
+  of each transaction once it committed.  Their seq counts up per process.
+
+- Through the database: with init_db(..., change_outbox=True) (or
+  MailApi(..., change_outbox=True)) the changes are inserted into the
+  mailapi_changes table as they're made, within the same transaction, seq
+  being the table's autoincrementing key.  create_outbox() creates the
+  table.  A consumer keeps the seq of the last change it processed and asks
+  read_outbox(since=seq) for the ones after it; prune_outbox() deletes what
+  every consumer has seen.
+
+mailapi.aio records the same changes (aio.init_db(..., change_outbox=True)).
+
+Changes of transactions (and savepoints) that are rolled back are dropped.
+Transactions committing concurrently on several connections can make a lower
+outbox seq visible after a higher one; consumers that can't afford to miss a
+change re-read a few seq behind their checkpoint and skip the ones they
+processed.
+
+Nothing is recorded, and the bulk deletes don't look up the keys they
+delete, while there are no subscribers and the database has no outbox.
+"""
+import itertools
+import logging
+from datetime import datetime
+
+from sqlalchemy import (BigInteger, Column, DateTime, Integer, MetaData,
+                        String, Table, event, insert)
+from sqlalchemy.orm import Session
+
+from .db import get_database, get_db_session, flush, read_only, writes
+
+
+logger = logging.getLogger(__name__)
+
+# Entities and operations
+DOMAIN = 'domain'
+MAILBOX = 'mailbox'
+ALIAS = 'alias'
+USED_QUOTA = 'used_quota'
+
+CREATE = 'create'
+UPDATE = 'update'
+DELETE = 'delete'
+
+# Session.info key holding the changes to publish once the session commits,
+# as (SessionTransaction they were recorded in, Change) tuples
+_PENDING = 'mailapi.changes_pending'
+
+# Callables called with the list of changes of each committed transaction
+_subscribers = []
+
+# Sequence numbers of the changes handed to subscribers
+_sequence = itertools.count(1)
+
+
+outbox_metadata = MetaData()
+
+outbox = Table(
+    'mailapi_changes', outbox_metadata,
+    Column('seq', BigInteger().with_variant(Integer, 'sqlite'),
+           primary_key=True, autoincrement=True),
+    Column('entity', String(32), nullable=False),
+    Column('entity_key', String(255), nullable=False),
+    Column('op', String(16), nullable=False),
+    Column('changed', DateTime, nullable=False),
+)
+
+
+class Change(object):
+    """ A row created, updated or deleted
+    """
+
+    __slots__ = ('seq', 'entity', 'key', 'op', 'changed')
+
+    def __init__(self, entity, key, op, changed=None, seq=None):
+        #: Position in the feed, set once the transaction committed
+        self.seq = seq
+        #: 'domain', 'mailbox', 'alias' or 'used_quota'
+        self.entity = entity
+        #: Primary key of the row
+        self.key = key
+        #: 'create', 'update' or 'delete'
+        self.op = op
+        #: When the change was made
+        self.changed = changed or datetime.now()
+
+    def __eq__(self, other):
+        return isinstance(other, Change) and \
+            (self.seq, self.entity, self.key, self.op) == \
+            (other.seq, other.entity, other.key, other.op)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.seq, self.entity, self.key, self.op))
+
+    def __repr__(self):
+        return '<Change %s %s %s %s>' % (self.seq, self.op, self.entity,
+                                         self.key)
+
+
+def subscribe(callback):
+    """ Calls @callback with the changes of every committed transaction
+
+    :param callback: Callable taking a list of Change objects, called in the
+                     committing thread right after the commit; exceptions it
+                     raises are logged, not raised
+    :return: @callback, so this can be used as a decorator
+    """
+    _listen()
+    _subscribers.append(callback)
+    return callback
+
+
+def unsubscribe(callback):
+    """ Stops calling a callback subscribe() was given
+
+    :param callback: The callable
+    """
+    try:
+        _subscribers.remove(callback)
+    except ValueError:
+        pass
+
+
+def create_outbox(bind):
+    """ Creates the mailapi_changes table if it doesn't exist yet
+
+    :param bind: Engine or Connection
+    """
+    outbox_metadata.create_all(bind)
+
+
+def active(outbox_enabled=None):
+    """ Whether changes are being recorded in the calling context
+
+    :param outbox_enabled: Whether the database has an outbox, defaults to
+                           the setting of the calling thread's database
+    :return: True if there are subscribers or the database has an outbox
+    """
+    if outbox_enabled is None:
+        outbox_enabled = get_database().change_outbox
+    return bool(_subscribers) or outbox_enabled
+
+
+def record(entity, op, keys, db_session=None, outbox_enabled=None):
+    """ Records changes in the calling thread's transaction
+
+    :param entity: DOMAIN, MAILBOX, ALIAS or USED_QUOTA
+    :param op: CREATE, UPDATE or DELETE
+    :param keys: Iterable of the changed rows' keys
+    :param db_session: (Sync) session to record them in, defaults to the
+                       calling thread's; mailapi.aio passes its own
+    :param outbox_enabled: Whether the database has an outbox, defaults to
+                           the setting of the calling thread's database
+    """
+    if outbox_enabled is None:
+        outbox_enabled = get_database().change_outbox
+    if not active(outbox_enabled):
+        return
+
+    db_session = db_session or get_db_session()
+    changed = datetime.now()
+    recorded = [Change(entity, key, op, changed) for key in keys]
+    if not recorded:
+        return
+
+    if outbox_enabled:
+        # Savepoints and transactions that are rolled back take these along
+        db_session.execute(insert(outbox), [
+            {'entity': change.entity, 'entity_key': change.key,
+             'op': change.op, 'changed': change.changed}
+            for change in recorded
+        ])
+
+    if _subscribers:
+        _listen()
+        transaction = db_session.get_nested_transaction() or \
+            db_session.get_transaction()
+        db_session.info.setdefault(_PENDING, []).extend(
+            (transaction, change) for change in recorded)
+
+
+def affected(query, column):
+    """ Keys of the rows a bulk update or delete is about to change
+
+    :param query: The Query that's about to be updated or deleted
+    :param column: The key's column
+    :return: List of keys, empty (without querying) when nothing's recorded
+    """
+    if not active():
+        return []
+    return [row[0] for row in query.with_entities(column)]
+
+
+@read_only
+def read_outbox(since=0, limit=1000):
+    """ Changes of the outbox after the given sequence number
+
+    :param since: seq of the last change already processed, 0 for all
+    :param limit: Max # of changes returned
+    :return: List of Change objects, by seq
+    """
+    rows = get_db_session().execute(
+        outbox.select().
+        where(outbox.c.seq > since).
+        order_by(outbox.c.seq).
+        limit(limit))
+
+    return [Change(row.entity, row.entity_key, row.op, row.changed, row.seq)
+            for row in rows]
+
+
+@writes
+def prune_outbox(up_to):
+    """ Deletes the changes of the outbox up to a sequence number
+
+    :param up_to: seq of the last change to delete
+    :return: # of changes deleted
+    """
+    db_session = get_db_session()
+    result = db_session.execute(outbox.delete().where(outbox.c.seq <= up_to))
+    flush(db_session)
+
+    return result.rowcount
+
+
+def _listen():
+    if not event.contains(Session, 'after_commit', _publish):
+        event.listen(Session, 'after_commit', _publish)
+        event.listen(Session, 'after_soft_rollback', _discard_rolled_back)
+        event.listen(Session, 'after_transaction_end', _discard)
+
+
+def _publish(session):
+    # Released savepoints commit too
+    if session.in_nested_transaction():
+        return
+
+    pending = session.info.pop(_PENDING, None)
+    if not pending or not _subscribers:
+        return
+
+    changes = []
+    for _, change in pending:
+        change.seq = next(_sequence)
+        changes.append(change)
+
+    for callback in list(_subscribers):
+        try:
+            callback(changes)
+        except Exception:
+            logger.exception('Change subscriber %r failed', callback)
+
+
+def _within(transaction, ancestor):
+    while transaction is not None:
+        if transaction is ancestor:
+            return True
+        transaction = transaction.parent
+    return False
+
+
+def _discard_rolled_back(session, previous_transaction):
+    # A savepoint rolled back, its changes (and its savepoints') are undone
+    pending = session.info.get(_PENDING)
+    if pending and previous_transaction.parent is not None:
+        pending[:] = [(transaction, change)
+                      for transaction, change in pending
+                      if not _within(transaction, previous_transaction)]
+
+
+def _discard(session, transaction):
+    # Whatever's left once the outermost transaction ended without a commit
+    if transaction.parent is None:
+        session.info.pop(_PENDING, None)
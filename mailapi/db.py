@@ -3,49 +3,673 @@
 See: http://docs.sqlalchemy.org/en/rel_0_9/orm/extensions/declarative.html#using-reflection-with-declarative # noqa
 See: http://docs.sqlalchemy.org/en/rel_0_9/orm/extensions/declarative.html#sqlalchemy.ext.declarative.DeferredReflection # noqa
 """
-from sqlalchemy import create_engine
-from sqlalchemy import MetaData
-from sqlalchemy.orm import Session
-from sqlalchemy.ext.declarative import DeferredReflection
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
 
-from .models import Base
+from sqlalchemy import and_, create_engine, event, or_
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.orm.base import instance_state
+
+from .models import map_models, models_mapped
+from .schema import SCHEMA_REFLECT, load_metadata, reflect
+from .replicas import ROUND_ROBIN, get_policy
 from .exc import DbInitError
+from . import instrumentation
+
+
+# Key in Session.info holding how many transaction() blocks are open
+_TRANSACTION_DEPTH = 'mailapi.transaction_depth'
+
+# Session.info keys: whether the session's transaction wrote anything and
+# when (time.monotonic()) the session last committed a write
+_WRITING = 'mailapi.writing'
+_LAST_WRITE = 'mailapi.last_write'
+
+# How long a session lives: the thread's (or scopefunc's) lifetime, or one
+# API call or transaction() block
+SESSION_THREAD = 'thread'
+SESSION_OPERATION = 'operation'
+
+# Whether an API call is running in this context, see _operation()
+_in_operation = ContextVar('mailapi_in_operation', default=False)
+
+# What the current call is routed to, see read_only() and writes()
+_READ = 'read'
+_WRITE = 'write'
+_route = ContextVar('mailapi_route', default=None)
+
+
+# The database init_db configures; MailApi clients bring their own and make
+# it the current one while their calls run.
+_current_database = ContextVar('mailapi_database', default=None)
+
+
+class PoolWaitStats(object):
+    """ How long checking out a connection from the pool took
+
+    Includes the time spent opening a new connection when the pool had to.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    @property
+    def average(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class _PoolWaitTimer(object):
+    """ Pool mixin timing every checkout into the class' wait_stats
+    """
+
+    wait_stats = None
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super(_PoolWaitTimer, self).connect()
+        finally:
+            self.wait_stats.record(time.perf_counter() - start)
+
+
+def _timed_pool_class(url):
+    """ The dialect's default pool class with checkouts being timed
+
+    A class per engine, so the stats survive the pool being recreated (e.g.
+    after a disconnect) but aren't shared between engines.
+    """
+    pool_class = url.get_dialect().get_pool_class(url)
+    return type('Timed' + pool_class.__name__,
+                (_PoolWaitTimer, pool_class),
+                {'wait_stats': PoolWaitStats()})
+
+
+def _sqlite_savepoints(engine):
+    """ Makes savepoints on pysqlite nest inside a real transaction
+
+    pysqlite only emits BEGIN before INSERT/UPDATE/DELETE, so a SAVEPOINT
+    issued before any of those opens a transaction of its own which RELEASE
+    then commits, rollback() or not.  See:
+    https://docs.sqlalchemy.org/en/latest/dialects/sqlite.html#serializable-isolation-savepoints-transactional-ddl # noqa
+
+    :param engine: SQLAlchemy Engine (the sync_engine of an async one)
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'savepoint')
+    def savepoint(connection, name):
+        dbapi_connection = connection.connection.dbapi_connection
+        if not getattr(dbapi_connection, 'in_transaction', True):
+            connection.exec_driver_sql('BEGIN')
+
+
+class Database(object):
+    """ An engine (plus replicas) and the sessions handed out for it
+
+    init_db configures the package's default database, see
+    mailapi.client.MailApi for talking to several at once.
+    """
+
+    def __init__(self):
+        # URL of the primary, set by configure()
+        self.url = None
+
+        # Registry handing out one session per thread (or per whatever
+        # scopefunc was given).  Use get_session(), the registry isn't bound
+        # until configure() was called.
+        self.session = scoped_session(sessionmaker())
+
+        # Sessions of the read-only calls, bound to a replica per call
+        self.replica_session = scoped_session(
+            sessionmaker(expire_on_commit=False))
+
+        # Replica engines, the policy picking one of them per call and how
+        # many seconds reads stick to the primary after a thread committed a
+        # write
+        self.replicas = []
+        self.replica_policy = None
+        self.read_your_writes = 0.0
 
+        # See init_db
+        self.session_scope = SESSION_THREAD
+        self.expunge_listings = False
+        self.change_outbox = False
 
-# Don't use the DBSession directly since it may not be initialized, use the
-# factory method instead.
-_DBSession = Session()
+    def configure(self, conn_str, scopefunc=None, pool_size=None,
+                  max_overflow=None, pool_recycle=None, pool_pre_ping=None,
+                  pool_timeout=None, schema=SCHEMA_REFLECT, schema_cache=None,
+                  schema_version=None, replicas=None,
+                  replica_policy=ROUND_ROBIN, read_your_writes=0,
+                  session_scope=SESSION_THREAD, expunge_listings=False,
+                  change_outbox=False):
+        """ Creates the engines and session registries, see init_db for the
+        parameters
+        """
 
+        if session_scope not in (SESSION_THREAD, SESSION_OPERATION):
+            raise ValueError('Unknown session scope: %r' % (session_scope,))
 
-def init_db(conn_str):
+        url = make_url(conn_str)
+        pool_options = dict(
+            (name, value) for name, value in (
+                ('pool_size', pool_size),
+                ('max_overflow', max_overflow),
+                ('pool_recycle', pool_recycle),
+                ('pool_pre_ping', pool_pre_ping),
+                ('pool_timeout', pool_timeout),
+            ) if value is not None
+        )
+
+        engine = create_engine(url, poolclass=_timed_pool_class(url),
+                               **pool_options)
+        _sqlite_savepoints(engine)
+
+        replica_engines = []
+        for replica in replicas or ():
+            replica_url = make_url(replica)
+            replica_engine = create_engine(
+                replica_url, poolclass=_timed_pool_class(replica_url),
+                **pool_options)
+            _sqlite_savepoints(replica_engine)
+            replica_engines.append(replica_engine)
+
+        # Objects outlive the operation's session, they keep what they loaded
+        session_factory = sessionmaker(
+            bind=engine,
+            expire_on_commit=session_scope != SESSION_OPERATION)
+        event.listen(session_factory, 'after_flush', _track_flush)
+        event.listen(session_factory, 'do_orm_execute', _track_bulk_write)
+        event.listen(session_factory, 'after_commit', _track_commit)
+        event.listen(session_factory, 'after_transaction_end',
+                     _track_transaction_end)
+
+        self.remove_session()
+        self.url = url
+        self.session = scoped_session(session_factory, scopefunc=scopefunc)
+        self.replica_session = scoped_session(
+            sessionmaker(expire_on_commit=False), scopefunc=scopefunc)
+        self.replicas = replica_engines
+        self.replica_policy = get_policy(replica_policy)
+        self.read_your_writes = read_your_writes
+        self.session_scope = session_scope
+        self.expunge_listings = expunge_listings
+        self.change_outbox = change_outbox
+
+        # The models are mapped once, by the first database configured in
+        # the process
+        if not models_mapped():
+            tables = load_metadata(url, schema, schema_cache, schema_version)
+            if tables is None:
+                tables = reflect(engine, url, schema_cache, schema_version)
+            map_models(tables)
+
+    @property
+    def engine(self):
+        """ The primary's engine, None until configure() was called """
+        return self.session.session_factory.kw.get('bind')
+
+    def get_session(self):
+        """ The calling thread's session for the current call
+
+        :return: SQLAlchemy ORM Session object
+        :raises DbInitError: If configure() has not been called
+        """
+        if self.engine is None:
+            raise DbInitError()
+        elif _route.get() == _READ:
+            return self.replica_session()
+        else:
+            return self.session()
+
+    def remove_session(self):
+        """ Closes the calling thread's sessions """
+        self.session.remove()
+        self.replica_session.remove()
+
+    def end_operation(self):
+        """ Closes the calling thread's session once an API call or
+        transaction() block is over, unless it holds uncommitted writes
+        (outside of a transaction() block, committing is up to the caller)
+        """
+        db_session = self.session()
+        info = db_session.info
+        if info.get(_TRANSACTION_DEPTH) or info.get(_WRITING) or \
+           db_session.new or db_session.dirty or db_session.deleted:
+            return
+
+        self.session.remove()
+
+    def primary_required(self):
+        """ Whether the calling thread's reads have to go to the primary """
+        db_session = self.session()
+        info = db_session.info
+
+        # Reads within a write transaction must see its changes
+        if info.get(_TRANSACTION_DEPTH) or info.get(_WRITING) or \
+           db_session.new or db_session.dirty or db_session.deleted:
+            return True
+
+        last_write = info.get(_LAST_WRITE)
+        return last_write is not None and \
+            time.monotonic() - last_write < self.read_your_writes
+
+    def dispose(self):
+        """ Closes the calling thread's sessions and every pooled connection
+        """
+        self.remove_session()
+        for engine in [self.engine] + self.replicas:
+            if engine is not None:
+                engine.dispose()
+
+
+_default_database = Database()
+
+
+def get_database():
+    """ The database the calling context's API calls use
+
+    :return: Database, the default one unless a MailApi client is active
+    """
+    return _current_database.get() or _default_database
+
+
+def init_db(conn_str, scopefunc=None, pool_size=None, max_overflow=None,
+            pool_recycle=None, pool_pre_ping=None, pool_timeout=None,
+            schema=SCHEMA_REFLECT, schema_cache=None, schema_version=None,
+            replicas=None, replica_policy=ROUND_ROBIN, read_your_writes=0,
+            session_scope=SESSION_THREAD, expunge_listings=False,
+            change_outbox=False):
     """ Initialize a connection to the database
 
+    Every thread gets its own session (and connection from the engine's pool)
+    so API calls can be made from several threads at once.  Size the pool to
+    the number of worker threads; pool_stats() tells whether they're waiting
+    for connections.
+
+    The pool options are passed on to create_engine as is, those left as None
+    keep SQLAlchemy's defaults.  See:
+    http://docs.sqlalchemy.org/en/latest/core/pooling.html
+
     :param conn_str: SQLAlchemy database URL
+    :param scopefunc: Optional callable returning the key of the current
+                      scope, e.g. the current asyncio task or request; the
+                      default is one session per thread
+    :param pool_size: # of connections kept open
+    :param max_overflow: # of connections opened on top of pool_size at peaks
+    :param pool_recycle: Seconds after which a connection is replaced, keep it
+                         below MySQL's wait_timeout
+    :param pool_pre_ping: True tests connections on checkout so ones killed by
+                          the server are replaced transparently
+    :param pool_timeout: Seconds to wait for a connection before giving up
+    :param schema: 'reflect' to reflect the tables from the database or
+                   'static' to use mailapi.schema's definitions, which makes
+                   no catalog queries
+    :param schema_cache: Path of a file caching the reflected tables, see
+                         mailapi.schema
+    :param schema_version: Part of the cache's fingerprint, change it when the
+                           schema changes
+    :param replicas: Optional list of database URLs of read replicas, the
+                     read-only API calls are sent to them.  The pool options
+                     apply to each replica as well.
+    :param replica_policy: 'round_robin', 'random' or a callable picking one
+                           of the replica engines it's given, see
+                           mailapi.replicas
+    :param read_your_writes: Seconds a thread keeps reading from the primary
+                             after it committed a write, so it sees its own
+                             changes despite replication lag
+    :param session_scope: 'thread' keeps a session per thread (or scopefunc
+                          scope) until remove_db_session(); 'operation' closes
+                          it after every API call and transaction() block, so
+                          long running processes don't hold on to connections
+                          and loaded objects.  Returned objects are detached
+                          then and aren't expired on commit; uncommitted
+                          writes made outside of transaction() keep the
+                          session open until committed or rolled back.
+    :param expunge_listings: True detaches the objects returned by the
+                             functions listing many rows (get_all_mailboxes,
+                             get_aliases, get_domain_used_quota...) from the
+                             session right away
     :return:
     """
+    _default_database.configure(
+        conn_str, scopefunc, pool_size, max_overflow, pool_recycle,
+        pool_pre_ping, pool_timeout, schema, schema_cache, schema_version,
+        replicas, replica_policy, read_your_writes, session_scope,
+        expunge_listings, change_outbox)
 
-    engine = create_engine(conn_str)
-    _DBSession.bind = engine
-    Base.metadata.bind = engine
 
-    # we can reflect it ourselves from a database, using options
-    # such as 'only' to limit what tables we look at...
-    metadata = MetaData()
-    metadata.reflect(engine, only=['domain', 'mailbox', 'alias'])
+def get_engine():
+    """ Get the engine init_db created
 
-    # calling prepare() just sets up mapped classes and relationships.
-    DeferredReflection.prepare(engine)
-    Base.prepare(engine)
+    :return: SQLAlchemy Engine object
+    :raises DbInitError: If init_db has not been called
+    """
+    engine = get_database().engine
+    if engine is None:
+        raise DbInitError()
+    return engine
+
+
+def pool_stats():
+    """ Current state of the connection pool
+
+    Keys that don't apply to the pool in use (e.g. overflow for SQLite's
+    single connection pools) are None.
+
+    :return: Dict with size, checked_out, checked_in, overflow, wait_count,
+             wait_time_total, wait_time_avg and wait_time_max (seconds)
+    :raises DbInitError: If init_db has not been called
+    """
+    pool = get_engine().pool
+
+    def call(name):
+        method = getattr(pool, name, None)
+        return method() if method is not None else None
+
+    wait_stats = getattr(pool, 'wait_stats', None) or PoolWaitStats()
+
+    return {
+        'size': call('size'),
+        'checked_out': call('checkedout'),
+        'checked_in': call('checkedin'),
+        'overflow': call('overflow'),
+        'wait_count': wait_stats.count,
+        'wait_time_total': wait_stats.total,
+        'wait_time_avg': wait_stats.average,
+        'wait_time_max': wait_stats.max,
+    }
 
 
 def get_db_session():
-    """ Get the database session object as long as it's bound to an engine
+    """ Get the calling thread's database session as long as it's bound to an
+    engine
 
     :return: SQLAlchemy ORM Session object
     :raises DbInitError: If the session is not bound to an engine
     """
-    if not _DBSession.bind:
-        raise DbInitError('You must initialize the database connection before'
-                          ' attempting to use it.')
+    return get_database().get_session()
+
+
+def remove_db_session():
+    """ Closes the calling thread's session and returns its connection to the
+    pool.  Worker threads should call this when they're done.
+
+    Any changes that weren't committed are rolled back.
+    """
+    get_database().remove_session()
+
+
+def get_replica_engines():
+    """ Get the replica engines init_db created
+
+    :return: List of SQLAlchemy Engine objects, empty without replicas
+    """
+    return list(get_database().replicas)
+
+
+def _track_flush(session, flush_context):
+    session.info[_WRITING] = True
+
+
+def _track_bulk_write(orm_execute_state):
+    # Query.update()/delete() don't go through the flush
+    if orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info[_WRITING] = True
+
+
+def _track_commit(session):
+    if session.info.get(_WRITING):
+        session.info[_LAST_WRITE] = time.monotonic()
+
+
+def _track_transaction_end(session, transaction):
+    if transaction.parent is None:
+        session.info[_WRITING] = False
+
+
+def _operation(database, func, args, kwargs):
+    """ Runs the outermost API call of an 'operation' scoped database """
+    token = _in_operation.set(True)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _in_operation.reset(token)
+        database.end_operation()
+
+
+def listing(func):
+    """ Decorates API functions returning lists of objects, which are
+    detached from the session if the database has expunge_listings set
+
+    Nothing is detached from a session holding uncommitted writes, the
+    objects may be part of them.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        result = func(*args, **kwargs)
+
+        database = get_database()
+        if not database.expunge_listings:
+            return result
+
+        db_session = database.get_session()
+        if db_session.info.get(_WRITING) or db_session.new or \
+           db_session.dirty or db_session.deleted:
+            return result
+
+        for instance in result:
+            if instance_state(instance).session_id == db_session.hash_key:
+                db_session.expunge(instance)
+
+        return result
+
+    return wrapper
+
+
+def read_only(func):
+    """ Decorates API functions that only read, so they can use a replica
+
+    Without replicas, within a writes() function and when the calling thread
+    has to see its own writes the function runs on the primary as usual.
+    Otherwise it gets a session bound to a replica the policy picked, which is
+    closed once the function returns; the objects it returned are detached.
+    """
+
+    name = '%s.%s' % (func.__module__, func.__qualname__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if instrumentation.enabled and instrumentation.current_call() is None:
+            return instrumentation.call(name, wrapper, args, kwargs)
+
+        database = get_database()
+        if database.session_scope == SESSION_OPERATION and \
+           not _in_operation.get():
+            return _operation(database, wrapper, args, kwargs)
+
+        if _route.get() is not None or not database.replicas or \
+           database.primary_required():
+            return func(*args, **kwargs)
+
+        token = _route.set(_READ)
+        db_session = database.replica_session()
+        db_session.bind = database.replica_policy(database.replicas)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _route.reset(token)
+
+            # Ends the replica transaction so the next call sees fresh data
+            db_session.close()
+
+    return wrapper
+
+
+def writes(func):
+    """ Decorates API functions that write, everything they call (including
+    read_only() functions) runs on the primary
+    """
+
+    name = '%s.%s' % (func.__module__, func.__qualname__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if instrumentation.enabled and instrumentation.current_call() is None:
+            return instrumentation.call(name, wrapper, args, kwargs)
+
+        database = get_database()
+        if database.session_scope == SESSION_OPERATION and \
+           not _in_operation.get():
+            return _operation(database, wrapper, args, kwargs)
+
+        if _route.get() == _WRITE:
+            return func(*args, **kwargs)
+
+        token = _route.set(_WRITE)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _route.reset(token)
+
+    return wrapper
+
+
+class Transaction(object):
+    """ Handle returned by transaction()
+    """
+
+    def __init__(self, session, depth):
+        #: The session the block runs in
+        self.session = session
+        #: 0 for the outermost block, > 0 for savepoints
+        self.depth = depth
+
+    def flush(self):
+        """ Sends the pending changes now instead of at commit """
+        self.session.flush()
+
+
+@contextmanager
+def transaction():
+    """ Groups the API calls made within into one database transaction
+
+    The outermost block commits when it exits and rolls back if it raises;
+    nested blocks become savepoints, so a failing inner block only undoes its
+    own changes.  Inside a block the API functions don't flush after each
+    write, pending inserts go out together when something needs them (a query,
+    a savepoint or the commit).  As a consequence a constraint violation may
+    surface as an IntegrityError from a later call or from the commit.
+
+        with mailapi.transaction() as tx:
+            mailapi.domain.create_domain('example.com')
+            for i in range(1000):
+                mailapi.alias.add_alias('a%d@example.com' % i, 'b@example.com')
+
+    :return: Transaction
+    :raises DbInitError: If init_db has not been called
+    """
+    db_session = get_db_session()
+    depth = db_session.info.get(_TRANSACTION_DEPTH, 0)
+
+    # The outermost block uses the session's own transaction
+    savepoint = db_session.begin_nested() if depth else None
+
+    db_session.info[_TRANSACTION_DEPTH] = depth + 1
+    try:
+        yield Transaction(db_session, depth)
+
+        # Pending writes are flushed here, so this is also where constraint
+        # violations within the block show up
+        (savepoint or db_session).commit()
+    except BaseException:
+        (savepoint or db_session).rollback()
+        raise
+    finally:
+        db_session.info[_TRANSACTION_DEPTH] = depth
+
+        if not depth and \
+           get_database().session_scope == SESSION_OPERATION:
+            get_database().end_operation()
+
+
+def in_transaction(db_session=None):
+    """ Whether the calling thread is inside a transaction() block
+
+    :param db_session: Session to check, defaults to the calling thread's
+    :return: True or False
+    """
+    db_session = db_session or get_db_session()
+    return db_session.info.get(_TRANSACTION_DEPTH, 0) > 0
+
+
+def flush(db_session):
+    """ Flushes the given session unless a transaction() block defers it
+
+    :param db_session: SQLAlchemy ORM Session object
+    """
+    if not in_transaction(db_session):
+        db_session.flush()
+
+
+def changed_since(query, modified, key, timestamp, cursor=None):
+    """ Filters and orders a query for paging through rows by (modified, key)
+
+    :param query: Query of a model
+    :param modified: The model's modified column
+    :param key: The model's primary key column, breaks ties of modified
+    :param timestamp: datetime, rows modified at or after it match
+    :param cursor: (modified, key) of the last row already read, only rows
+                   after it match then (@timestamp is ignored)
+    :return: Query
+    """
+    if cursor is None:
+        query = query.filter(modified >= timestamp)
     else:
-        return _DBSession
+        last_modified, last_key = cursor
+        # The first term keeps it a range scan of the (modified, key) index
+        query = query.filter(modified >= last_modified,
+                             or_(modified > last_modified,
+                                 and_(modified == last_modified,
+                                      key > last_key)))
+
+    return query.order_by(modified, key)
+
+
+def iter_changed(get_page, key, timestamp, cursor=None, batch_size=500):
+    """ Streams the rows of a changed_since() lookup page by page
+
+    Every page is an API call of its own: with session_scope='operation' or
+    replicas the iteration doesn't hold a session or transaction open
+    between pages.
+
+    :param get_page: API function taking (timestamp, cursor, limit)
+    :param key: Name of the primary key attribute
+    :param timestamp: See changed_since
+    :param cursor: See changed_since
+    :param batch_size: # of rows fetched per page
+    :return: Generator of model objects
+    """
+    while True:
+        page = get_page(timestamp, cursor, batch_size)
+        for row in page:
+            yield row
+
+        if len(page) < batch_size:
+            return
+        cursor = (page[-1].modified, getattr(page[-1], key))
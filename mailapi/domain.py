@@ -1,6 +1,15 @@
+import time
+from datetime import datetime
+
+from sqlalchemy import (String, case, delete, func, literal, select,
+                        update)
 from sqlalchemy.orm.exc import NoResultFound
-from .models import Domain, Mailbox, Alias
-from .db import get_db_session
+from .models import Domain, Mailbox, Alias, UsedQuota
+from .db import (get_db_session, changed_since, flush, in_transaction,
+                 iter_changed, listing, read_only, transaction, writes)
+from .cache import cached, forget_all, forget_domain, forget_mailboxes
+from .alias import _rewrite_gotos
+from . import changes
 from .validators import is_domain
 from .exc import NoSuchDomain, DomainExists
 
@@ -8,7 +17,11 @@ from .exc import NoSuchDomain, DomainExists
 # Error messages can go here
 DOMAIN_DNE = '''The given domain does not exist: %s'''
 
+# Rows deleted per statement and transaction by purge_domain
+PURGE_CHUNK_SIZE = 1000
+
 
+@writes
 def create_domain(domain_name, description=''):
     """ Adds domain name to the database
 
@@ -26,12 +39,19 @@ def create_domain(domain_name, description=''):
         raise DomainExists(domain_name)
 
     db_session = get_db_session()
-    d = Domain(domain=domain_name, description=description)
+    now = datetime.now()
+    d = Domain(domain=domain_name, description=description, created=now,
+               modified=now)
     db_session.add(d)
-    db_session.flush()
+    flush(db_session)
+
+    forget_domain(domain_name)
+    changes.record(changes.DOMAIN, changes.CREATE, [domain_name])
     return d
 
 
+@read_only
+@cached('get_domain', Domain)
 def get_domain(domain_name: str):
     """ Gets a domain with the given name from the db
 
@@ -47,6 +67,8 @@ def get_domain(domain_name: str):
         return None
 
 
+@read_only
+@listing
 def get_all_mailboxes(domain_name):
     """ Gets a list of all mailboxes associated with the given domain
 
@@ -60,6 +82,8 @@ def get_all_mailboxes(domain_name):
     return get_db_session().query(Mailbox).filter_by(domain=domain_name).all()
 
 
+@read_only
+@listing
 def get_all_domains():
     """ Fetches all domains from the database
 
@@ -70,9 +94,45 @@ def get_all_domains():
     return domains
 
 
+@read_only
+@listing
+def get_domains_changed_since(timestamp, cursor=None, limit=500):
+    """ A page of the domains modified at or after the given time, by
+    (modified, domain)
+
+    :param timestamp: datetime
+    :param cursor: (modified, domain) of the last domain of the previous
+                   page, @timestamp is ignored then
+    :param limit: Max # of domains returned
+    :return: List of Domain objects
+    """
+
+    return changed_since(get_db_session().query(Domain), Domain.modified,
+                         Domain.domain, timestamp, cursor).limit(limit).all()
+
+
+def iter_changed_since(timestamp, cursor=None, batch_size=500):
+    """ Streams the domains modified at or after the given time, by
+    (modified, domain), see mailbox.iter_changed_since
+
+    :param timestamp: datetime
+    :param cursor: (modified, domain) to continue after
+    :param batch_size: # of domains read per query
+    :return: Generator of Domain objects
+    """
+
+    return iter_changed(get_domains_changed_since, 'domain', timestamp,
+                        cursor, batch_size)
+
+
+@writes
 def delete_domain(domain_name):
     """ Deletes the given domain name from the database
 
+    The domain's aliases, mailboxes and used quota go with it, each with one
+    statement in the caller's transaction; see purge_domain for large
+    domains.
+
     :param domain_name: String
     :return: True if success
     :raises NoSuchDomain: If the given domain name doesn't exist
@@ -81,18 +141,239 @@ def delete_domain(domain_name):
     if not domain_exists(domain_name):
         raise NoSuchDomain(domain_name)
 
-    # Delete aliases and mailboxes
-    delete_aliases(domain_name)
-    delete_mailboxes(domain_name)
+    _delete_aliases(domain_name)
+    _delete_mailboxes(domain_name)
+    _delete_used_quota(domain_name)
 
     db_session = get_db_session()
     num_deleted = db_session.query(Domain).\
         filter_by(domain=domain_name).delete()
-    db_session.flush()
+    flush(db_session)
 
+    forget_domain(domain_name)
+    if num_deleted:
+        changes.record(changes.DOMAIN, changes.DELETE, [domain_name])
     return num_deleted == 1
 
 
+@writes
+def purge_domain(domain_name, chunk_size=PURGE_CHUNK_SIZE, pause=0.0,
+                 progress=None):
+    """ Deletes the given domain and everything in it a chunk at a time
+
+    Where delete_domain holds the locks of all the domain's rows until the
+    caller commits, purge_domain deletes the aliases, mailboxes and used
+    quota by primary key in chunks of @chunk_size rows, each committed on
+    its own, and sleeps @pause seconds between chunks so the lookups of
+    mail delivery get through.  The domain is deactivated first and its row
+    deleted last: after an interruption, calling purge_domain again picks up
+    the rows that are left.
+
+    As every chunk is committed, writes the session holds that aren't
+    committed yet are committed with the first one.
+
+    :param domain_name: String
+    :param chunk_size: # of rows deleted per statement and transaction
+    :param pause: Seconds to sleep after each chunk
+    :param progress: Callable called after each chunk with the table name and
+                     the # of its rows deleted so far
+    :return: Dict of table name => # of rows deleted
+    :raises NoSuchDomain: If the given domain name doesn't exist
+    :raises RuntimeError: If called inside a transaction() block, which the
+                          chunks can't be committed in
+    """
+
+    if in_transaction():
+        raise RuntimeError('purge_domain commits its chunks, it cannot run '
+                           'inside transaction()')
+
+    if not domain_exists(domain_name):
+        raise NoSuchDomain(domain_name)
+
+    with transaction():
+        get_db_session().execute(
+            update(Domain).where(Domain.domain == domain_name).
+            values(active=0, modified=datetime.now()))
+        forget_domain(domain_name)
+        changes.record(changes.DOMAIN, changes.UPDATE, [domain_name])
+
+    counts = {}
+    for table_name, model, key, entity in [
+            ('alias', Alias, Alias.address, changes.ALIAS),
+            ('mailbox', Mailbox, Mailbox.username, changes.MAILBOX),
+            ('used_quota', UsedQuota, UsedQuota.username, changes.USED_QUOTA)]:
+        counts[table_name] = 0
+
+        while True:
+            with transaction():
+                db_session = get_db_session()
+                keys = db_session.execute(
+                    select(key).where(model.domain == domain_name).
+                    order_by(key).limit(chunk_size)).scalars().all()
+                if not keys:
+                    break
+
+                db_session.execute(delete(model).where(key.in_(keys)))
+                if model is Mailbox:
+                    forget_mailboxes(keys)
+                changes.record(entity, changes.DELETE, keys)
+
+            counts[table_name] += len(keys)
+            if progress is not None:
+                progress(table_name, counts[table_name])
+            if pause:
+                time.sleep(pause)
+
+    with transaction():
+        num_deleted = get_db_session().execute(
+            delete(Domain).where(Domain.domain == domain_name)).rowcount
+        forget_domain(domain_name)
+        if num_deleted:
+            changes.record(changes.DOMAIN, changes.DELETE, [domain_name])
+
+    counts['domain'] = num_deleted
+    if progress is not None:
+        progress('domain', num_deleted)
+    return counts
+
+
+@writes
+def rename_domain(domain_name, new_domain_name):
+    """ Renames a domain, its mailboxes, aliases and used quota with it
+
+    A few set-based UPDATEs in the caller's transaction rewrite the
+    addresses, domain and maildir paths of the rows, passwords and dates are
+    kept; aliases pointing at the domain's addresses from anywhere are
+    repointed.  The maildirs aren't moved on disk: <storage node>/old/...
+    has to be renamed to <storage node>/new/... along with the commit.
+
+    :param domain_name: String
+    :param new_domain_name: A valid domain name
+    :return: True if success
+    :raises NoSuchDomain: If the given domain name doesn't exist
+    :raises DomainExists: If the new domain name already exists
+    :raises ValueError: If the new domain name is not a domain name
+    """
+
+    if not is_domain(new_domain_name):
+        raise ValueError('Invalid domain name supplied: %s' %
+                         new_domain_name)
+
+    if not domain_exists(domain_name):
+        raise NoSuchDomain(domain_name)
+
+    if domain_exists(new_domain_name):
+        raise DomainExists(new_domain_name)
+
+    db_session = get_db_session()
+    now = datetime.now()
+    old_suffix, new_suffix = '@' + domain_name, '@' + new_domain_name
+
+    def rename(address):
+        local_part, _, domain = address.rpartition('@')
+        if domain.lower() == domain_name.lower():
+            return local_part + new_suffix
+        return None
+
+    def renamed(addresses):
+        return [rename(address) for address in addresses]
+
+    # Aliases are filed under their destination's domain, the ones of the
+    # domain's addresses may be under another one and vice versa
+    renamed_aliases = Alias.address.endswith(old_suffix, autoescape=True)
+    aliases = changes.affected(db_session.query(Alias).
+                               filter(renamed_aliases), Alias.address)
+    mailboxes = changes.affected(db_session.query(Mailbox).
+                                 filter_by(domain=domain_name),
+                                 Mailbox.username)
+    used_quota = changes.affected(db_session.query(UsedQuota).
+                                  filter_by(domain=domain_name),
+                                  UsedQuota.username)
+    refiled = changes.affected(db_session.query(Alias).
+                               filter_by(domain=domain_name), Alias.address)
+
+    repointed = _rewrite_gotos([domain_name], rename, now)
+
+    # The WHERE clauses may match the old domain in any case (e.g. MySQL's
+    # collations), the addresses get the new one whatever case it was in
+    sync = {'synchronize_session': False}
+    db_session.execute(
+        update(Alias).where(renamed_aliases).
+        values(address=_moved_address(Alias.address, new_domain_name),
+               modified=now),
+        execution_options=sync)
+    db_session.execute(
+        update(Alias).where(Alias.domain == domain_name).
+        values(domain=new_domain_name, modified=now),
+        execution_options=sync)
+    db_session.execute(
+        update(Mailbox).where(Mailbox.domain == domain_name).
+        values(username=_moved_address(Mailbox.username, new_domain_name),
+               domain=new_domain_name,
+               maildir=_renamed_maildir(Mailbox.maildir, domain_name,
+                                        new_domain_name),
+               modified=now),
+        execution_options=sync)
+    db_session.execute(
+        update(UsedQuota).where(UsedQuota.domain == domain_name).
+        values(username=_moved_address(UsedQuota.username,
+                                       new_domain_name),
+               domain=new_domain_name),
+        execution_options=sync)
+    num_renamed = db_session.execute(
+        update(Domain).where(Domain.domain == domain_name).
+        values(domain=new_domain_name, modified=now),
+        execution_options=sync).rowcount
+
+    # Objects loaded under the old keys are reloaded, or gone, on access
+    db_session.expire_all()
+    forget_all()
+
+    updated = sorted((set(repointed) | set(refiled)) - set(aliases))
+    changes.record(changes.ALIAS, changes.UPDATE, updated)
+    changes.record(changes.DOMAIN, changes.DELETE, [domain_name])
+    changes.record(changes.DOMAIN, changes.CREATE, [new_domain_name])
+    for entity, keys in [(changes.MAILBOX, mailboxes),
+                         (changes.ALIAS, aliases),
+                         (changes.USED_QUOTA, used_quota)]:
+        changes.record(entity, changes.DELETE, keys)
+        changes.record(entity, changes.CREATE, renamed(keys))
+
+    return num_renamed == 1
+
+
+def _moved_address(address, new_domain):
+    """ SQL expression of email addresses with their domain part replaced
+    by @new_domain, whatever case it was in
+
+    :param address: An email address column
+    :param new_domain: String
+    :return: SQL expression
+    """
+
+    return func.substr(address, 1, func.instr(address, '@'), type_=String) + \
+        literal(new_domain, String)
+
+
+def _renamed_maildir(maildir, old_domain, new_domain):
+    """ SQL expression of maildir paths with their leading domain directory
+    renamed, paths generated with prepend_domain_name=False are kept
+
+    :param maildir: The maildir column
+    :param old_domain: String
+    :param new_domain: String
+    :return: SQL expression
+    """
+
+    prefix = old_domain.lower() + '/'
+    return case(
+        (maildir.startswith(prefix, autoescape=True),
+         literal(new_domain.lower() + '/', String) +
+         func.substr(maildir, len(prefix) + 1, type_=String)),
+        else_=maildir)
+
+
+@writes
 def delete_aliases(domain_name):
     """ Deletes all aliases in the given domain
 
@@ -104,12 +385,19 @@ def delete_aliases(domain_name):
     if not domain_exists(domain_name):
         raise NoSuchDomain(domain_name)
 
-    num_deleted = get_db_session().query(Alias).\
-        filter_by(domain=domain_name).delete()
+    return _delete_aliases(domain_name) >= 1
+
 
-    return num_deleted >= 1
+def _delete_aliases(domain_name):
+    query = get_db_session().query(Alias).filter_by(domain=domain_name)
+    deleted = changes.affected(query, Alias.address)
+    num_deleted = query.delete()
 
+    changes.record(changes.ALIAS, changes.DELETE, deleted)
+    return num_deleted
 
+
+@writes
 def delete_mailboxes(domain_name):
     """ Deletes all mailboxes (and their aliases) in the given domain
 
@@ -121,12 +409,31 @@ def delete_mailboxes(domain_name):
     if not domain_exists(domain_name):
         raise NoSuchDomain(domain_name)
 
-    num_deleted = get_db_session().query(Mailbox).\
-        filter_by(domain=domain_name).delete()
+    return _delete_mailboxes(domain_name) >= 1
+
+
+def _delete_mailboxes(domain_name):
+    query = get_db_session().query(Mailbox).filter_by(domain=domain_name)
+    deleted = changes.affected(query, Mailbox.username)
+    num_deleted = query.delete()
+
+    # The cache can't tell which of its mailboxes were in the domain
+    forget_all()
+    changes.record(changes.MAILBOX, changes.DELETE, deleted)
+    return num_deleted
+
+
+def _delete_used_quota(domain_name):
+    query = get_db_session().query(UsedQuota).filter_by(domain=domain_name)
+    deleted = changes.affected(query, UsedQuota.username)
+    num_deleted = query.delete()
 
-    return num_deleted >= 1
+    changes.record(changes.USED_QUOTA, changes.DELETE, deleted)
+    return num_deleted
 
 
+@read_only
+@cached('domain_exists')
 def domain_exists(domain_name):
     """ Checks if the given domain name exists in the database
 
@@ -52,3 +52,23 @@ class AliasExists(Exception):
                         (source, dest)
 
         super(AliasExists, self).__init__(error_message)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """ A query_budget() block issued more statements than it allowed, or
+    issued the same statement too often (N+1 queries)
+    """
+    def __init__(self, problems, statements):
+        error_message = '%s\nStatements:\n%s' % (
+            '\n'.join(problems),
+            '\n'.join('  %s' % statement for statement in statements))
+
+        super(QueryBudgetExceeded, self).__init__(error_message)
+        self.problems = problems
+        self.statements = statements
+
+
+class SnapshotError(ValueError):
+    """ A snapshot file can't be imported: it isn't one, was written by a
+    newer version or has columns the database's tables don't
+    """
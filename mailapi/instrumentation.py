@@ -0,0 +1,278 @@
+""" Per-call statistics of the API functions
+
+Off by default.  Once enabled every call of a domain, mailbox, alias or
+used_quota function records the # of statements it issued, the rows they
+returned or changed, the time spent executing them and the call's wall time:
+
+    from mailapi import instrumentation
+
+    instrumentation.enable(callback=metrics.send)
+    mailapi.mailbox.create_mailbox(...)
+
+    instrumentation.stats()['mailapi.mailbox.create_mailbox']['wall_time']
+    # {'count': 1, 'p50': 0.0061, 'p95': 0.0061, 'p99': 0.0061, ...}
+
+Only the outermost API function is recorded; create_mailbox calling
+domain_exists is one create_mailbox call.  While disabled the decorators
+check a single module global and no SQLAlchemy event listeners are attached.
+"""
+import bisect
+import threading
+import time
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+# The decorators in mailapi.db only look at this
+enabled = False
+
+_callback = None
+_histograms_enabled = True
+
+# CallStats of the API function running in this context, if any
+_current_call = ContextVar('mailapi_instrumented_call', default=None)
+
+# Histogram bucket upper bounds: 1e-6 to ~1e7, each 2 ** 0.25 (~19%) wider
+# than the previous, plus 0.  Good enough for seconds, statements and rows.
+_BUCKETS = [0.0] + [1e-6 * 2 ** (i / 4.0) for i in range(176)]
+
+METRICS = ('wall_time', 'db_time', 'statements', 'rows', 'rows_written')
+
+
+class CallStats(object):
+    """ What one API call did, handed to the callback once it returned
+
+    :ivar name: Qualified function name, e.g. 'mailapi.mailbox.get_mailbox'
+    :ivar statements: # of statements executed
+    :ivar rows: # of rows the SELECTs returned to the ORM
+    :ivar rows_written: # of rows INSERTs, UPDATEs and DELETEs changed
+    :ivar db_time: Seconds spent executing the statements
+    :ivar wall_time: Seconds the call took
+    :ivar error: The exception the call raised or None
+    """
+
+    __slots__ = ('name', 'statements', 'rows', 'rows_written', 'db_time',
+                 'wall_time', 'error')
+
+    def __init__(self, name):
+        self.name = name
+        self.statements = 0
+        self.rows = 0
+        self.rows_written = 0
+        self.db_time = 0.0
+        self.wall_time = 0.0
+        self.error = None
+
+    def __repr__(self):
+        return '<CallStats %s %d statements %.2fms>' % (
+            self.name, self.statements, self.wall_time * 1000)
+
+
+class Histogram(object):
+    """ Counts of values in exponentially growing buckets
+
+    Percentiles are the upper bound of the bucket they fall in, so they're
+    within ~19% of the exact value; memory stays the same however many
+    values are recorded.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(_BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """ Approximate @percent percentile, None without values """
+        if not self.count:
+            return None
+
+        rank = max(int(self.count * percent / 100.0 + 0.5), 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                # Never more than what was actually recorded
+                if index < len(_BUCKETS):
+                    return min(_BUCKETS[index], self.max)
+                return self.max
+        return self.max
+
+    def summary(self):
+        """ Dict of count, mean, max, p50, p95 and p99 """
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+        }
+
+
+# Function name => metric name => Histogram
+_histograms = {}
+_lock = threading.Lock()
+
+
+def _record(call):
+    with _lock:
+        histograms = _histograms.get(call.name)
+        if histograms is None:
+            histograms = _histograms[call.name] = dict(
+                (metric, Histogram()) for metric in METRICS)
+
+        for metric in METRICS:
+            histograms[metric].record(getattr(call, metric))
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if _current_call.get() is not None:
+        conn.info.setdefault('mailapi_query_start', []).append(
+            time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    call = _current_call.get()
+    if call is None:
+        return
+
+    starts = conn.info.get('mailapi_query_start')
+    if starts:
+        call.db_time += time.perf_counter() - starts.pop()
+
+    call.statements += 1
+
+
+def _after_execute(conn, clauseelement, multiparams, params,
+                   execution_options, result):
+    call = _current_call.get()
+    if call is None:
+        return
+
+    # Counted per execute() rather than per cursor execution: INSERTs may be
+    # sent in batches and have a RETURNING clause whose rows aren't fetched
+    # yet, so the cursor's rowcount isn't meaningful for them
+    context = result.context
+    if context.isinsert:
+        call.rows_written += len(context.compiled_parameters or ())
+    elif (context.isupdate or context.isdelete) and result.rowcount > 0:
+        call.rows_written += result.rowcount
+
+
+def _count_rows(orm_execute_state):
+    """ Buffers the rows of ORM SELECTs to count them; the functions fetch
+    all of them anyway
+    """
+    call = _current_call.get()
+    if call is None or not orm_execute_state.is_select or \
+       orm_execute_state.execution_options.get('yield_per') or \
+       orm_execute_state.execution_options.get('stream_results'):
+        return None
+
+    frozen = orm_execute_state.invoke_statement().freeze()
+    call.rows += len(frozen.data)
+    return frozen()
+
+
+_EVENTS = (
+    (Engine, 'before_cursor_execute', _before_cursor_execute),
+    (Engine, 'after_cursor_execute', _after_cursor_execute),
+    (Engine, 'after_execute', _after_execute),
+    (Session, 'do_orm_execute', _count_rows),
+)
+
+
+def enable(callback=None, histograms=True):
+    """ Starts recording the API calls
+
+    :param callback: Called with the CallStats of every call once it
+                     returned, in the calling thread; exceptions it raises
+                     propagate to the caller
+    :param histograms: False only calls @callback, stats() stays empty
+    """
+    global enabled, _callback, _histograms_enabled
+
+    for target, identifier, listener in _EVENTS:
+        if not event.contains(target, identifier, listener):
+            event.listen(target, identifier, listener)
+
+    _callback = callback
+    _histograms_enabled = histograms
+    enabled = True
+
+
+def disable():
+    """ Stops recording, the histograms are kept until reset() """
+    global enabled, _callback
+
+    enabled = False
+    _callback = None
+
+    for target, identifier, listener in _EVENTS:
+        if event.contains(target, identifier, listener):
+            event.remove(target, identifier, listener)
+
+
+def reset():
+    """ Forgets everything recorded so far """
+    with _lock:
+        _histograms.clear()
+
+
+def stats():
+    """ The histograms recorded since enable() or reset()
+
+    :return: Dict of function name => {'calls': #, metric name => summary
+             dict, see Histogram.summary}, metrics as in METRICS
+    """
+    with _lock:
+        result = {}
+        for name, histograms in _histograms.items():
+            result[name] = dict((metric, histogram.summary())
+                                for metric, histogram in histograms.items())
+            result[name]['calls'] = histograms['wall_time'].count
+        return result
+
+
+def current_call():
+    """ CallStats of the API function being recorded in this context
+
+    :return: CallStats or None
+    """
+    return _current_call.get()
+
+
+def call(name, func, args, kwargs):
+    """ Runs @func, recording it as a call of @name
+
+    Used by mailapi.db's decorators, which only call it while enabled and no
+    other call is being recorded.
+    """
+    stats = CallStats(name)
+    token = _current_call.set(stats)
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    except Exception as e:
+        stats.error = e
+        raise
+    finally:
+        stats.wall_time = time.perf_counter() - start
+        _current_call.reset(token)
+
+        if _histograms_enabled:
+            _record(stats)
+        if _callback is not None:
+            _callback(stats)
@@ -1,24 +1,45 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
+from sqlalchemy import case, select, update
 from sqlalchemy.orm.exc import NoResultFound
 
-from .domain import domain_exists
+from .domain import _moved_address, _renamed_maildir, domain_exists
 from .password import generate_md5_password
-from .maildir import generate_maildir_path
-from .models import Mailbox
+from .maildir import (
+    generate_maildir_path,
+    generate_unused_maildir_paths,
+)
+from .models import Mailbox, Domain, Alias, UsedQuota
 from .helpers import parse_email_domain
-from .alias import add_alias, delete_aliases, delete_alias
-from .db import get_db_session
+from .validators import validate_emails
+from .alias import (_rewrite_gotos, _save_alias, build_alias, delete_aliases,
+                    delete_alias)
+from .db import (get_db_session, changed_since, flush, iter_changed, listing,
+                 read_only, writes)
+from .cache import cached, forget_all, forget_mailboxes
+from . import changes
+from .storage import get_storage_backend, maildir_location, trash_on_commit
+from .placement import get_placement_engine
+from .archive import archive_maildir, archive_path
 from .exc import NoSuchDomain, MailboxExists, NoSuchMailbox
 
 
+# Max # of values bound in a single IN (...) clause
+IN_CLAUSE_CHUNK_SIZE = 500
+
+# Used when neither the caller nor a placement engine picks a storage node
+DEFAULT_STORAGE_NODE = 'vmail1'
+
+
+@writes
 def create_mailbox(email_address,
                    full_name,
                    plain_password,
                    quota=0,
                    language='en_US',
                    storage_base_dir='/var/vmail',
-                   storage_node='vmail1'):
+                   storage_node=None):
     """ Creates a new mailbox
 
     :param email_address: String, the desired email address
@@ -27,11 +48,16 @@ def create_mailbox(email_address,
     :param quota: Int, # of MB
     :param language: I guess for i18n
     :param storage_base_dir: Usually /var/vmail
-    :param storage_node: /var/vmail/<storage_node>
+    :param storage_node: /var/vmail/<storage_node>; None lets the configured
+                         placement engine pick one (see mailapi.placement) or
+                         falls back to 'vmail1'
     :raises ValueError: if the given email address is invalid
     :raises NoSuchDomain: If the domain does not exist
     :raises NoSuchMailbox: If the mailbox already exists
     :return: Mailbox object
+
+    If a storage backend is configured (see mailapi.storage) the maildir is
+    created as well.
     """
 
     # Get domain and user; Possible ValueError
@@ -43,13 +69,245 @@ def create_mailbox(email_address,
     if mailbox_exists(email_address):
         raise MailboxExists(email_address)
 
+    placed = []
+    if storage_node is None:
+        storage_node = _place_mailboxes([quota])[0]
+        placed.append(storage_node)
+
+    try:
+        mailbox = _build_mailbox(email_address, local_part, domain_part,
+                                 full_name, plain_password, quota, language,
+                                 storage_base_dir, storage_node,
+                                 generate_maildir_path(email_address,
+                                                       validate=False))
+
+        # Creates a self-referrential alias; Not exactly sure why, but
+        # iredadmin does this
+        # See: https://bitbucket.org/zhb/iredadmin-ose/src/45d6d5c30269d32d7818ea9dd1d5e0fb0d962d46/libs/mysql/user.py?at=default#cl-255 # noqa (suppresses PEP8 warning)
+        _save_alias(build_alias(email_address, email_address, domain_part))
+
+        db_session = get_db_session()
+        db_session.add(mailbox)
+        flush(db_session)
+        forget_mailboxes([email_address])
+        changes.record(changes.ALIAS, changes.CREATE, [email_address])
+        changes.record(changes.MAILBOX, changes.CREATE, [email_address])
+
+        storage_backend = get_storage_backend()
+        if storage_backend is not None:
+            storage_backend.provision([mailbox])
+    except BaseException:
+        _release_mailboxes(placed, [quota])
+        raise
+
+    return mailbox
+
+
+@writes
+def create_mailboxes(mailboxes,
+                     storage_base_dir='/var/vmail',
+                     storage_node=None):
+    """ Creates many mailboxes at once
+
+    Domains and existing mailboxes are checked with a handful of queries, every
+    row goes out in a single flush and, if a storage backend is configured, the
+    maildirs are provisioned as one batch.
+
+    :param mailboxes: List of dicts with the keyword arguments of
+                      create_mailbox (email_address, full_name and
+                      plain_password are required)
+    :param storage_base_dir: Default for records that don't set one
+    :param storage_node: Default for records that don't set one; None
+                         spreads them with the placement engine
+    :raises ValueError: if one of the email addresses is invalid
+    :raises NoSuchDomain: If one of the domains does not exist
+    :raises MailboxExists: If one of the mailboxes already exists or an
+                           address is given twice
+    :return: List of Mailbox objects
+    """
+
+    addresses, parsed = _parse_mailbox_records(mailboxes)
+    if not parsed:
+        return []
+
+    db_session = get_db_session()
+
+    domain_names = set(domain_part for _, _, domain_part in parsed)
+    known_domains = set(row.domain for row in db_session.query(Domain.domain).
+                        filter(Domain.domain.in_(domain_names)))
+    missing_domains = domain_names - known_domains
+    if missing_domains:
+        raise NoSuchDomain(sorted(missing_domains)[0])
+
+    # Keeps the IN lists within the limits of the db driver
+    unique_addresses = sorted(addresses)
+    for i in range(0, len(unique_addresses), IN_CLAUSE_CHUNK_SIZE):
+        chunk = unique_addresses[i:i + IN_CLAUSE_CHUNK_SIZE]
+        existing = db_session.query(Mailbox.username).\
+            filter(Mailbox.username.in_(chunk)).first()
+        if existing is not None:
+            raise MailboxExists(existing.username)
+
+    # Records without a storage node are spread over the nodes in one go
+    nodes = [record.get('storage_node', storage_node)
+             for record, _, _ in parsed]
+    unplaced = [i for i, node in enumerate(nodes) if node is None]
+    quotas = [parsed[i][0].get('quota', 0) for i in unplaced]
+    placed = _place_mailboxes(quotas)
+    for i, node in zip(unplaced, placed):
+        nodes[i] = node
+
+    try:
+        maildirs = generate_unique_maildir_paths(addresses, validate=False)
+
+        created = []
+        for (record, local_part, domain_part), node, maildir in \
+                zip(parsed, nodes, maildirs):
+            email_address = record['email_address']
+            mailbox = _build_mailbox(
+                email_address,
+                local_part,
+                domain_part,
+                record['full_name'],
+                record['plain_password'],
+                record.get('quota', 0),
+                record.get('language', 'en_US'),
+                record.get('storage_base_dir', storage_base_dir),
+                node,
+                maildir,
+            )
+
+            db_session.add(build_alias(email_address, email_address,
+                                       domain_part))
+            db_session.add(mailbox)
+            created.append(mailbox)
+
+        flush(db_session)
+        forget_mailboxes(addresses)
+        changes.record(changes.ALIAS, changes.CREATE, addresses)
+        changes.record(changes.MAILBOX, changes.CREATE, addresses)
+
+        storage_backend = get_storage_backend()
+        if storage_backend is not None:
+            storage_backend.provision(created)
+    except BaseException:
+        _release_mailboxes(placed, quotas)
+        raise
+
+    return created
+
+
+@read_only
+def generate_unique_maildir_paths(email_addresses,
+                                  hashed_maildir=True,
+                                  prepend_domain_name=True,
+                                  append_timestamp=True,
+                                  validate=True,
+                                  db_session=None):
+    """ Maildir paths for new mailboxes that are unique within the batch and
+    against the maildirs already in the database.
+
+    The database is asked for exact paths with one IN query per
+    IN_CLAUSE_CHUNK_SIZE paths, and again for the counter suffixed paths
+    replacing ones that are taken (rarely needed with timestamps).
+
+    :param email_addresses: List of email addresses
+    :param validate: False skips validating the addresses (again)
+    :param db_session: Session to query with, defaults to the calling thread's
+    :return: List of maildir paths, in the same order as @email_addresses
+    :raises ValueError: If one of the email addresses is invalid
+    """
+
+    db_session = db_session or get_db_session()
+    return generate_unused_maildir_paths(
+        email_addresses,
+        lambda paths: _maildirs_in_use(paths, db_session),
+        hashed_maildir=hashed_maildir,
+        prepend_domain_name=prepend_domain_name,
+        append_timestamp=append_timestamp,
+        validate=validate)
+
+
+def _maildirs_in_use(paths, db_session):
+    """ The ones of the given maildir paths that mailboxes have """
+    in_use = set()
+    for i in range(0, len(paths), IN_CLAUSE_CHUNK_SIZE):
+        in_use.update(row.maildir for row in db_session.query(
+            Mailbox.maildir).filter(
+                Mailbox.maildir.in_(paths[i:i + IN_CLAUSE_CHUNK_SIZE])))
+
+    return in_use
+
+
+def _parse_mailbox_records(mailboxes):
+    """ Validates the records given to create_mailboxes
+
+    :return: (list of addresses, list of (record, local part, domain) tuples)
+    :raises ValueError: if one of the email addresses is invalid
+    :raises MailboxExists: If an address is given twice
+    """
+
+    mailboxes = list(mailboxes)
+    addresses = [record['email_address'] for record in mailboxes]
+
+    # Every address is validated once, here
+    result = validate_emails(addresses)
+    if not result:
+        index, _ = result.first_error()
+        raise ValueError('Invalid email address provided: %s' %
+                         addresses[index])
+
+    parsed = []
+    seen = set()
+    for record, email_address in zip(mailboxes, addresses):
+        local_part, domain_part = email_address.split('@')
+
+        if email_address in seen:
+            raise MailboxExists(email_address)
+        seen.add(email_address)
+
+        parsed.append((record, local_part, domain_part))
+
+    return addresses, parsed
+
+
+def _place_mailboxes(quotas, db_session=None):
+    """ Storage nodes for new mailboxes with the given quotas
+    """
+
+    if not quotas:
+        return []
+
+    placement_engine = get_placement_engine()
+    if placement_engine is None:
+        return [DEFAULT_STORAGE_NODE] * len(quotas)
+
+    return placement_engine.assign(quotas, db_session)
+
+
+def _release_mailboxes(nodes, quotas, db_session=None):
+    """ Hands the storage nodes _place_mailboxes picked for mailboxes that
+    weren't created back to the placement engine
+    """
+
+    placement_engine = get_placement_engine()
+    if placement_engine is not None and nodes:
+        placement_engine.release(nodes, quotas, db_session)
+
+
+def _build_mailbox(email_address, local_part, domain_part, full_name,
+                   plain_password, quota, language, storage_base_dir,
+                   storage_node, maildir):
+    """ Creates an (unsaved) Mailbox object; the address must be valid
+    """
+
     mailbox = Mailbox()
     mailbox.username = email_address
     mailbox.password = generate_md5_password(plain_password)
     mailbox.language = language
     mailbox.storagebasedirectory = storage_base_dir
     mailbox.storagenode = storage_node
-    mailbox.maildir = generate_maildir_path(email_address)
+    mailbox.maildir = maildir
     mailbox.quota = int(quota)
     mailbox.domain = domain_part
     mailbox.local_part = local_part
@@ -58,18 +316,11 @@ def create_mailbox(email_address,
     mailbox.created = datetime.now()
     mailbox.modified = datetime.now()
 
-    # Creates a self-referrential alias; Not exactly sure why, but iredadmin
-    # does this
-    # See: https://bitbucket.org/zhb/iredadmin-ose/src/45d6d5c30269d32d7818ea9dd1d5e0fb0d962d46/libs/mysql/user.py?at=default#cl-255 # noqa (suppresses PEP8 warning)
-    add_alias(email_address, email_address)
-
-    db_session = get_db_session()
-    db_session.add(mailbox)
-    db_session.flush()
-
     return mailbox
 
 
+@read_only
+@cached('mailbox_exists')
 def mailbox_exists(email_address):
     """ Determines if a mailbox with the given email address exists in the DB
 
@@ -84,24 +335,236 @@ def mailbox_exists(email_address):
         return False
 
 
-def delete_mailbox(email_address):
+@writes
+def delete_mailbox(email_address, archive_to=None):
     """ Deletes the mailbox from the database by the given email address.
 
+    If a storage backend is configured the maildir is moved to the trash once
+    the deletion commits.
+
     :param email_address: String
+    :param archive_to: Directory to archive the maildir to (as a .tar.gz)
+                       before anything is deleted, None to skip archiving
     :return: True if success else False
     """
 
     if not mailbox_exists(email_address):
         raise NoSuchMailbox(email_address)
 
+    # The row is needed to locate the maildir once it's gone from the db
+    storage_backend = get_storage_backend()
+    mailbox = None
+    if storage_backend is not None or archive_to is not None:
+        mailbox = get_mailbox(email_address)
+
+    if archive_to is not None:
+        archive_maildir(maildir_location(mailbox),
+                        archive_path(archive_to, email_address))
+
     delete_aliases(email_address)
     delete_alias(email_address, email_address)
     num_deleted = get_db_session().query(Mailbox).\
         filter_by(username=email_address).delete()
+    forget_mailboxes([email_address])
+    if num_deleted:
+        changes.record(changes.MAILBOX, changes.DELETE, [email_address])
+
+    if storage_backend is not None:
+        trash_on_commit(get_db_session(), [mailbox])
 
     return num_deleted == 1
 
 
+@writes
+def delete_mailboxes(email_addresses, archive_to=None, workers=4):
+    """ Deletes many mailboxes (and their aliases) at once
+
+    With @archive_to every maildir is first streamed into its own .tar.gz on
+    a pool of @workers threads.  A mailbox's rows are only deleted once its
+    archive has been written and fsynced; if an archive fails the remaining
+    mailboxes are still deleted and the first error is raised afterwards.
+    With a storage backend the maildirs are trashed once the deletion
+    commits.
+
+    :param email_addresses: List of Strings
+    :param archive_to: Directory to archive the maildirs to, None to skip
+    :param workers: Int, # of maildirs archived concurrently
+    :return: Dict of email address => archive path (None when not archived)
+    :raises NoSuchMailbox: If one of the mailboxes does not exist
+    """
+
+    email_addresses = list(email_addresses)
+    db_session = get_db_session()
+
+    mailboxes = {}
+    for i in range(0, len(email_addresses), IN_CLAUSE_CHUNK_SIZE):
+        chunk = email_addresses[i:i + IN_CLAUSE_CHUNK_SIZE]
+        for mailbox in db_session.query(Mailbox).\
+                filter(Mailbox.username.in_(chunk)):
+            mailboxes[mailbox.username] = mailbox
+
+    for email_address in email_addresses:
+        if email_address not in mailboxes:
+            raise NoSuchMailbox(email_address)
+
+    archives = dict((email_address, None) for email_address in mailboxes)
+    error = None
+
+    if archive_to is not None:
+        def archive(mailbox):
+            return archive_maildir(maildir_location(mailbox),
+                                   archive_path(archive_to, mailbox.username))
+
+        with ThreadPoolExecutor(max_workers=max(int(workers), 1)) as pool:
+            futures = dict((pool.submit(archive, m), m.username)
+                           for m in mailboxes.values())
+            for future in as_completed(futures):
+                try:
+                    archives[futures[future]] = future.result()
+                except Exception as e:
+                    error = error or e
+                    del archives[futures[future]]
+
+    deleted = sorted(archives)
+    for i in range(0, len(deleted), IN_CLAUSE_CHUNK_SIZE):
+        chunk = deleted[i:i + IN_CLAUSE_CHUNK_SIZE]
+
+        # Every alias pointing at the mailbox, the self-referrential included
+        aliases = db_session.query(Alias).filter(Alias.goto.in_(chunk))
+        changes.record(changes.ALIAS, changes.DELETE,
+                       changes.affected(aliases, Alias.address))
+        aliases.delete()
+        db_session.query(Mailbox).filter(Mailbox.username.in_(chunk)).delete()
+
+    flush(db_session)
+    forget_mailboxes(deleted)
+    changes.record(changes.MAILBOX, changes.DELETE, deleted)
+
+    trash_on_commit(db_session, [mailboxes[a] for a in deleted])
+
+    if error is not None:
+        raise error
+
+    return archives
+
+
+@writes
+def move_mailboxes(email_addresses, domain_name):
+    """ Moves mailboxes to another domain, keeping their local part
+
+    Like domain.rename_domain, but for some mailboxes: set-based UPDATEs per
+    chunk of mailboxes, in the caller's transaction, rewrite the username,
+    domain and maildir path of the mailboxes, their aliases and used quota,
+    and repoint the aliases forwarding to them.  The maildirs aren't moved
+    on disk.
+
+    :param email_addresses: List of Strings
+    :param domain_name: Domain to move the mailboxes to
+    :return: Dict of old => new email address of the mailboxes moved (the
+             ones already in the domain are left alone)
+    :raises NoSuchDomain: If the given domain doesn't exist
+    :raises NoSuchMailbox: If one of the mailboxes does not exist
+    :raises MailboxExists: If a mailbox with one of the new addresses exists
+    """
+
+    if not domain_exists(domain_name):
+        raise NoSuchDomain(domain_name)
+
+    email_addresses = list(email_addresses)
+    db_session = get_db_session()
+
+    # Old domain => its mailboxes to move
+    by_domain = {}
+    found = set()
+    for i in range(0, len(email_addresses), IN_CLAUSE_CHUNK_SIZE):
+        chunk = email_addresses[i:i + IN_CLAUSE_CHUNK_SIZE]
+        for username, domain in db_session.execute(
+                select(Mailbox.username, Mailbox.domain).
+                where(Mailbox.username.in_(chunk))):
+            found.add(username)
+            if domain != domain_name:
+                by_domain.setdefault(domain, []).append(username)
+
+    for email_address in email_addresses:
+        if email_address not in found:
+            raise NoSuchMailbox(email_address)
+
+    moved = {}
+    for usernames in by_domain.values():
+        for username in usernames:
+            moved[username] = '%s@%s' % (username.rsplit('@', 1)[0],
+                                         domain_name)
+
+    new_addresses = sorted(moved.values())
+    for i in range(0, len(new_addresses), IN_CLAUSE_CHUNK_SIZE):
+        chunk = new_addresses[i:i + IN_CLAUSE_CHUNK_SIZE]
+        existing = db_session.execute(
+            select(Mailbox.username).where(Mailbox.username.in_(chunk))).\
+            scalars().first()
+        if existing is not None:
+            raise MailboxExists(existing)
+
+    if not moved:
+        return moved
+
+    now = datetime.now()
+    repointed = _rewrite_gotos(sorted(by_domain), moved.get, now)
+
+    # The domain part is replaced whatever case it's in
+    sync = {'synchronize_session': False}
+    aliases, used_quota = [], []
+    for old_domain, usernames in sorted(by_domain.items()):
+        usernames.sort()
+
+        for i in range(0, len(usernames), IN_CLAUSE_CHUNK_SIZE):
+            chunk = usernames[i:i + IN_CLAUSE_CHUNK_SIZE]
+            aliases += changes.affected(
+                db_session.query(Alias).filter(Alias.address.in_(chunk)),
+                Alias.address)
+            used_quota += changes.affected(
+                db_session.query(UsedQuota).
+                filter(UsedQuota.username.in_(chunk)), UsedQuota.username)
+
+            db_session.execute(
+                update(Mailbox).where(Mailbox.username.in_(chunk)).
+                values(username=_moved_address(Mailbox.username,
+                                               domain_name),
+                       domain=domain_name,
+                       maildir=_renamed_maildir(Mailbox.maildir, old_domain,
+                                                domain_name),
+                       modified=now),
+                execution_options=sync)
+            db_session.execute(
+                update(Alias).where(Alias.address.in_(chunk)).
+                values(address=_moved_address(Alias.address, domain_name),
+                       domain=case((Alias.domain == old_domain, domain_name),
+                                   else_=Alias.domain),
+                       modified=now),
+                execution_options=sync)
+            db_session.execute(
+                update(UsedQuota).where(UsedQuota.username.in_(chunk)).
+                values(username=_moved_address(UsedQuota.username,
+                                               domain_name),
+                       domain=domain_name),
+                execution_options=sync)
+
+    # Objects loaded under the old keys are reloaded, or gone, on access
+    db_session.expire_all()
+    forget_all()
+
+    changes.record(changes.ALIAS, changes.UPDATE,
+                   sorted(set(repointed) - set(aliases)))
+    for entity, keys in [(changes.MAILBOX, sorted(moved)),
+                         (changes.ALIAS, aliases),
+                         (changes.USED_QUOTA, used_quota)]:
+        changes.record(entity, changes.DELETE, keys)
+        changes.record(entity, changes.CREATE, [moved[key] for key in keys])
+
+    return moved
+
+
+@read_only
+@listing
 def get_all_mailboxes():
     """ Gets a list of all mailboxes defined in the database
 
@@ -111,6 +574,44 @@ def get_all_mailboxes():
     return get_db_session().query(Mailbox).order_by(Mailbox.username).all()
 
 
+@read_only
+@listing
+def get_mailboxes_changed_since(timestamp, cursor=None, limit=500):
+    """ A page of the mailboxes modified at or after the given time, by
+    (modified, username)
+
+    :param timestamp: datetime
+    :param cursor: (modified, username) of the last mailbox of the previous
+                   page, @timestamp is ignored then
+    :param limit: Max # of mailboxes returned
+    :return: List of Mailbox objects
+    """
+
+    return changed_since(get_db_session().query(Mailbox), Mailbox.modified,
+                         Mailbox.username, timestamp, cursor).\
+        limit(limit).all()
+
+
+def iter_changed_since(timestamp, cursor=None, batch_size=500):
+    """ Streams the mailboxes modified at or after the given time, by
+    (modified, username)
+
+    A sync job keeps (modified, username) of the last mailbox it processed
+    and passes it as @cursor next time, so it only reads what changed since.
+    Deleted mailboxes don't show up, see mailapi.changes for those.
+
+    :param timestamp: datetime
+    :param cursor: (modified, username) to continue after
+    :param batch_size: # of mailboxes read per query
+    :return: Generator of Mailbox objects
+    """
+
+    return iter_changed(get_mailboxes_changed_since, 'username', timestamp,
+                        cursor, batch_size)
+
+
+@read_only
+@cached('get_mailbox', Mailbox)
 def get_mailbox(email_address):
     """ Gets the mailbox by the given email address
 
@@ -118,13 +619,11 @@ def get_mailbox(email_address):
     :return: Mailbox or None
     """
 
-    if not mailbox_exists(email_address):
-        return None
-
     return get_db_session().query(Mailbox).\
-        filter_by(username=email_address).one()
+        filter_by(username=email_address).one_or_none()
 
 
+@writes
 def reset_mailbox_password(email_address, plain_password):
     """ Sets the password for the given email address to the given password
 
@@ -134,21 +633,25 @@ def reset_mailbox_password(email_address, plain_password):
     :raises NoSuchMailbox: If the given email address does not exist
     """
 
-    if not mailbox_exists(email_address):
+    mailbox = get_mailbox(email_address)
+    if mailbox is None:
         raise NoSuchMailbox(email_address)
 
-    mailbox = get_mailbox(email_address)
     mailbox.password = generate_md5_password(plain_password)
     mailbox.modified = datetime.now()
     mailbox.passwordlastchanged = datetime.now()
 
     db_session = get_db_session()
     db_session.add(mailbox)
-    db_session.flush()
+    flush(db_session)
+    forget_mailboxes([email_address])
+    changes.record(changes.MAILBOX, changes.UPDATE, [email_address])
 
     return True
 
 
+@read_only
+@listing
 def search_mailboxes(search_string):
     """ Returns a list of mailboxes with their email address or name like the
     search string.
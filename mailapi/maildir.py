@@ -1,22 +1,25 @@
 import time
 
-from .validators import is_email
+from .validators import is_email, validate_emails
 
 
 def generate_maildir_path(mail,
                           hashed_maildir=True,
                           prepend_domain_name=True,
-                          append_timestamp=True):
+                          append_timestamp=True,
+                          validate=True):
     """ Generate path of mailbox.
 
     Source: https://bitbucket.org/zhb/iredadmin-ose/src/fb7d39f487feb4b2eb2635990f1363ba73e404e6/libs/iredutils.py?at=default#cl-544
 
     Modified to raise a ValueError instead of returning a tuple
 
+    :param validate: False skips the check when the caller already validated
+                     the address
     :raises ValueError: If the email address is invalid.
     """
 
-    if not is_email(mail):
+    if validate and not is_email(mail):
         raise ValueError('Invalid email address.')
 
     # Get user/domain part from mail address.
@@ -25,8 +28,148 @@ def generate_maildir_path(mail,
     # Get current timestamp.
     timestamp = ''
     if append_timestamp:
-        timestamp = time.strftime('-%Y.%m.%d.%H.%M.%S')
+        timestamp = _timestamp(time.time())
 
+    return _maildir_path(username, domain, timestamp,
+                         hashed_maildir, prepend_domain_name)
+
+
+def generate_maildir_paths(mails,
+                           hashed_maildir=True,
+                           prepend_domain_name=True,
+                           append_timestamp=True,
+                           existing=(),
+                           validate=True):
+    """ Generate unique maildir paths for many mailboxes at once.
+
+    Same layout as generate_maildir_path, but every address is validated only
+    once and the timestamp is only formatted when the clock moves on to the
+    next second.  When a path is already taken, by an earlier address of the
+    batch or by one in @existing, a counter is appended: <path>-2/, <path>-3/..
+
+    :param mails: Iterable of email addresses
+    :param existing: Container of maildir paths that are already in use
+    :param validate: False skips the checks when the caller already validated
+                     the addresses
+    :return: List of maildir paths, in the same order as @mails
+    :raises ValueError: If one of the email addresses is invalid.
+    """
+
+    if validate:
+        mails = list(mails)
+        result = validate_emails(mails)
+        if not result:
+            index, _ = result.first_error()
+            raise ValueError('Invalid email address: %s' % mails[index])
+
+    paths = []
+
+    for mail in mails:
+        username, domain = mail.split('@', 1)
+
+        timestamp = ''
+        if append_timestamp:
+            timestamp = _timestamp(time.time())
+
+        paths.append(_maildir_path(username, domain, timestamp,
+                                   hashed_maildir, prepend_domain_name))
+
+    return dedupe_maildir_paths(paths, existing)
+
+
+def dedupe_maildir_paths(paths, existing=()):
+    """ Makes the given maildir paths unique
+
+    The first occurrence of a path is kept as is unless it's in @existing,
+    the others get a counter appended: <path>-2/, <path>-3/...
+
+    :param paths: List of maildir paths (ending with /)
+    :param existing: Container of maildir paths that are already in use
+    :return: List of maildir paths, in the same order as @paths
+    """
+
+    taken = set()
+    unique = []
+
+    for path in paths:
+        if path in taken or path in existing:
+            base = path[:-1]
+            counter = 2
+            while path in taken or path in existing:
+                path = '%s-%d/' % (base, counter)
+                counter += 1
+
+        taken.add(path)
+        unique.append(path)
+
+    return unique
+
+
+def generate_unused_maildir_paths(mails,
+                                  in_use,
+                                  hashed_maildir=True,
+                                  prepend_domain_name=True,
+                                  append_timestamp=True,
+                                  validate=True):
+    """ Generate maildir paths that are unique within the batch and not in use
+    yet.
+
+    Like generate_maildir_paths, @in_use is asked which of the generated paths
+    are taken, then which of the counter suffixed paths replacing those are,
+    until none is.  It only ever gets exact paths, so it can look them up by
+    equality.
+
+    :param mails: Iterable of email addresses
+    :param in_use: Callable taking a list of maildir paths, returning the ones
+                   among them that are already in use
+    :param validate: False skips the checks when the caller already validated
+                     the addresses
+    :return: List of maildir paths, in the same order as @mails
+    :raises ValueError: If one of the email addresses is invalid.
+    """
+
+    paths = generate_maildir_paths(mails,
+                                   hashed_maildir=hashed_maildir,
+                                   prepend_domain_name=prepend_domain_name,
+                                   append_timestamp=append_timestamp,
+                                   validate=validate)
+    unique = paths
+    checked = set()
+    existing = set()
+
+    while True:
+        candidates = [path for path in unique if path not in checked]
+        if not candidates:
+            return unique
+        checked.update(candidates)
+
+        taken = set(in_use(candidates))
+        if not taken:
+            return unique
+        existing.update(taken)
+        unique = dedupe_maildir_paths(paths, existing)
+
+
+# (second, formatted timestamp) of the last call to _timestamp
+_last_timestamp = (None, '')
+
+
+def _timestamp(now):
+    """ -%Y.%m.%d.%H.%M.%S for the given epoch time, formatted once a second
+    """
+    global _last_timestamp
+
+    second = int(now)
+    cached_second, formatted = _last_timestamp
+    if cached_second != second:
+        formatted = time.strftime('-%Y.%m.%d.%H.%M.%S', time.localtime(second))
+        _last_timestamp = (second, formatted)
+
+    return formatted
+
+
+def _maildir_path(username, domain, timestamp, hashed_maildir,
+                  prepend_domain_name):
     if hashed_maildir is True:
         if len(username) >= 3:
             maildir = "%s/%s/%s/%s%s/" % (
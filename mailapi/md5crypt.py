@@ -66,13 +66,15 @@ def unix_md5_crypt(pw, salt, magic=None):
         salt = salt[len(magic):]
 
     # salt can have up to 8 characters:
-    import string
-    salt = string.split(salt, '$', 1)[0]
+    salt = salt.split('$', 1)[0]
     salt = salt[:8]
 
-    ctx = pw + magic + salt
+    # hashlib works on bytes
+    pw = pw.encode('utf-8')
+    salt = salt.encode('utf-8')
+    ctx = pw + magic.encode('utf-8') + salt
 
-    final = md5.md5(pw + salt + pw).digest()
+    final = md5(pw + salt + pw).digest()
 
     for pl in range(len(pw),0,-16):
         if pl > 16:
@@ -86,12 +88,12 @@ def unix_md5_crypt(pw, salt, magic=None):
     i = len(pw)
     while i:
         if i & 1:
-            ctx = ctx + chr(0)  #if ($i & 1) { $ctx->add(pack("C", 0)); }
+            ctx = ctx + b'\x00'  #if ($i & 1) { $ctx->add(pack("C", 0)); }
         else:
-            ctx = ctx + pw[0]
+            ctx = ctx + pw[:1]
         i = i >> 1
 
-    final = md5.md5(ctx).digest()
+    final = md5(ctx).digest()
     
     # The following is supposed to make
     # things run slower. 
@@ -99,7 +101,7 @@ def unix_md5_crypt(pw, salt, magic=None):
     # my question: WTF???
 
     for i in range(1000):
-        ctx1 = ''
+        ctx1 = b''
         if i & 1:
             ctx1 = ctx1 + pw
         else:
@@ -117,36 +119,36 @@ def unix_md5_crypt(pw, salt, magic=None):
             ctx1 = ctx1 + pw
             
             
-        final = md5.md5(ctx1).digest()
+        final = md5(ctx1).digest()
 
 
     # Final xform
                                 
     passwd = ''
 
-    passwd = passwd + to64((int(ord(final[0])) << 16)
-                           |(int(ord(final[6])) << 8)
-                           |(int(ord(final[12]))),4)
+    passwd = passwd + to64((final[0] << 16)
+                           |(final[6] << 8)
+                           |(final[12]),4)
 
-    passwd = passwd + to64((int(ord(final[1])) << 16)
-                           |(int(ord(final[7])) << 8)
-                           |(int(ord(final[13]))), 4)
+    passwd = passwd + to64((final[1] << 16)
+                           |(final[7] << 8)
+                           |(final[13]), 4)
 
-    passwd = passwd + to64((int(ord(final[2])) << 16)
-                           |(int(ord(final[8])) << 8)
-                           |(int(ord(final[14]))), 4)
+    passwd = passwd + to64((final[2] << 16)
+                           |(final[8] << 8)
+                           |(final[14]), 4)
 
-    passwd = passwd + to64((int(ord(final[3])) << 16)
-                           |(int(ord(final[9])) << 8)
-                           |(int(ord(final[15]))), 4)
+    passwd = passwd + to64((final[3] << 16)
+                           |(final[9] << 8)
+                           |(final[15]), 4)
 
-    passwd = passwd + to64((int(ord(final[4])) << 16)
-                           |(int(ord(final[10])) << 8)
-                           |(int(ord(final[5]))), 4)
+    passwd = passwd + to64((final[4] << 16)
+                           |(final[10] << 8)
+                           |(final[5]), 4)
 
-    passwd = passwd + to64((int(ord(final[11]))), 2)
+    passwd = passwd + to64((final[11]), 2)
 
-    return magic + salt + '$' + passwd
+    return magic + salt.decode('utf-8') + '$' + passwd
 
 
 # assign a wrapper function:
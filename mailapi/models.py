@@ -1,29 +1,70 @@
 """ Data model definitions go in here.
 
-Note: This setup is done using SQLAlchemy's reflection feature.
+Note: The classes are mapped imperatively by init_db, onto tables that are
+either reflected from the database or defined statically, see mailapi.schema.
 
-See: http://docs.sqlalchemy.org/en/rel_0_9/orm/extensions/declarative.html#using-reflection-with-declarative # noqa
-See: http://docs.sqlalchemy.org/en/rel_0_9/orm/extensions/declarative.html#sqlalchemy.ext.declarative.DeferredReflection # noqa
+See: https://docs.sqlalchemy.org/en/latest/orm/mapping_styles.html#imperative-mapping # noqa
 """
-from sqlalchemy.ext.declarative import declarative_base, DeferredReflection
+from sqlalchemy.orm import registry
 
 
-# Declarative base class using deferred reflection
-# See: http://docs.sqlalchemy.org/en/rel_0_9/orm/extensions/declarative.html#sqlalchemy.ext.declarative.DeferredReflection # noqa
-Base = declarative_base(cls=DeferredReflection)
+# Registry the model classes are mapped with
+mapper_registry = registry()
 
 
-class Mailbox(Base):
+class Model(object):
+    """ Base of the model classes, accepts the column values as keywords
+    """
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            if not hasattr(type(self), key):
+                raise TypeError('%r is an invalid keyword argument for %s' %
+                                (key, type(self).__name__))
+            setattr(self, key, value)
+
+
+class Mailbox(Model):
     __tablename__ = 'mailbox'
 
 
-class Domain(Base):
+class Domain(Model):
     __tablename__ = 'domain'
 
 
-class Alias(Base):
+class Alias(Model):
     __tablename__ = 'alias'
 
 
-class UsedQuota(Base):
+class UsedQuota(Model):
     __tablename__ = 'used_quota'
+
+
+MODELS = (Mailbox, Domain, Alias, UsedQuota)
+
+
+def models_mapped():
+    """ Whether map_models has been called
+
+    :return: True or False
+    """
+    return all('__mapper__' in model.__dict__ for model in MODELS)
+
+
+def map_models(metadata):
+    """ Maps the model classes onto the tables in @metadata
+
+    Mapping happens once per process, later calls are no-ops.
+
+    Server generated defaults (created, expired, active...) are loaded when
+    first accessed rather than with RETURNING on INSERT: RETURNING makes the
+    ORM insert row by row on backends that can't match returned rows to
+    parameters, so bulk creates would cost a round trip per row.
+
+    :param metadata: MetaData holding the tables named by the models
+    """
+    for model in MODELS:
+        if '__mapper__' not in model.__dict__:
+            mapper_registry.map_imperatively(
+                model, metadata.tables[model.__tablename__],
+                eager_defaults=False)
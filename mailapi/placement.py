@@ -0,0 +1,282 @@
+""" Storage node placement for new mailboxes
+
+By default every mailbox lands on the storage node given to create_mailbox
+('vmail1').  Configure a PlacementEngine to have the least loaded node picked
+instead:
+
+    from mailapi.placement import PlacementEngine, set_placement_engine
+
+    set_placement_engine(PlacementEngine({
+        'vmail1': 2 * 1024 ** 4,  # capacity in bytes
+        'vmail2': 4 * 1024 ** 4,
+    }))
+"""
+import copy
+import heapq
+import threading
+import time
+
+from sqlalchemy import func
+
+from .models import Mailbox, UsedQuota
+from .db import get_db_session
+
+
+# The placement engine used by the mailbox module, None means "use the
+# storage_node argument as is".  Use set_placement_engine() to change it.
+_placement_engine = None
+
+
+def set_placement_engine(engine):
+    """ Sets the engine used to pick storage nodes for new mailboxes
+
+    :param engine: PlacementEngine object or None to disable
+    :return: The previous engine
+    """
+    global _placement_engine
+
+    previous = _placement_engine
+    _placement_engine = engine
+    return previous
+
+
+def get_placement_engine():
+    """ Gets the configured placement engine
+
+    :return: PlacementEngine or None
+    """
+    return _placement_engine
+
+
+class NodeStats(object):
+    """ Load of a single storage node
+    """
+
+    def __init__(self, name, capacity, max_mailboxes=None, mailboxes=0,
+                 used_bytes=0):
+        self.name = name
+        self.capacity = capacity
+        self.max_mailboxes = max_mailboxes
+        self.mailboxes = mailboxes
+        self.used_bytes = used_bytes
+
+    @property
+    def remaining(self):
+        """ # of bytes left, never negative """
+        return max(self.capacity - self.used_bytes, 0)
+
+    @property
+    def utilization(self):
+        """ Fraction of the capacity in use """
+        if self.capacity <= 0:
+            return 1.0
+        return float(self.used_bytes) / self.capacity
+
+    @property
+    def full(self):
+        return self.remaining == 0 or (
+            self.max_mailboxes is not None and
+            self.mailboxes >= self.max_mailboxes
+        )
+
+    def __repr__(self):
+        return '<NodeStats %s: %d mailboxes, %d/%d bytes>' % (
+            self.name, self.mailboxes, self.used_bytes, self.capacity)
+
+
+class PlacementEngine(object):
+    """ Picks the storage node with the lowest utilization
+
+    Mailbox counts and used bytes per node are aggregated from the mailbox and
+    used_quota tables with a single GROUP BY query.  The result is cached for
+    @ttl seconds; in the meantime every placement is added to the cached
+    numbers so consecutive creates keep spreading without hitting the db.
+    The cached NodeStats are never changed in place, each placement publishes
+    updated copies.  Every database (see mailapi.client) has stats of its
+    own, keyed by its URL, so clusters sharing the engine don't place their
+    mailboxes by each other's load.
+    """
+
+    def __init__(self, nodes, ttl=300, mailbox_bytes=None,
+                 max_mailboxes=None):
+        """
+        :param nodes: Dict of storage node name => capacity in bytes
+        :param ttl: Seconds the aggregated stats are cached for
+        :param mailbox_bytes: Bytes a new mailbox without quota is expected
+                              to use; None uses the current average
+        :param max_mailboxes: Optional dict of node name => max # mailboxes
+        """
+        if not nodes:
+            raise ValueError('At least one storage node is required.')
+
+        self.capacities = dict(nodes)
+        self.max_mailboxes = dict(max_mailboxes or {})
+        self.ttl = ttl
+        self.mailbox_bytes = mailbox_bytes
+
+        # Database URL => dict of node name => NodeStats, and when they were
+        # loaded
+        self._stats = {}
+        self._refreshed_at = {}
+        self._lock = threading.Lock()
+
+    def refresh(self, db_session=None):
+        """ Reloads the per node stats from the database
+
+        :param db_session: Session to query with, defaults to the calling
+                           thread's
+        :return: Dict of node name => NodeStats
+        """
+        db_session = db_session or get_db_session()
+        rows = db_session.query(
+            Mailbox.storagenode,
+            func.count(Mailbox.username),
+            func.coalesce(func.sum(UsedQuota.bytes), 0),
+        ).outerjoin(UsedQuota, UsedQuota.username == Mailbox.username).\
+            filter(Mailbox.storagenode.in_(self.capacities)).\
+            group_by(Mailbox.storagenode).all()
+
+        stats = dict(
+            (name, NodeStats(name, capacity, self.max_mailboxes.get(name)))
+            for name, capacity in self.capacities.items()
+        )
+        for name, mailboxes, used_bytes in rows:
+            stats[name].mailboxes = int(mailboxes)
+            stats[name].used_bytes = int(used_bytes)
+
+        key = _database_key(db_session)
+        with self._lock:
+            self._stats[key] = stats
+            self._refreshed_at[key] = time.monotonic()
+
+        return stats
+
+    def stats(self, db_session=None):
+        """ The cached per node stats, reloaded once they're too old
+
+        :param db_session: Session to query with, defaults to the calling
+                           thread's
+        :return: Dict of node name => NodeStats
+        """
+        db_session = db_session or get_db_session()
+        key = _database_key(db_session)
+        stats = self._stats.get(key)
+        if stats is None or \
+           time.monotonic() - self._refreshed_at[key] >= self.ttl:
+            return self.refresh(db_session)
+        return stats
+
+    def invalidate(self):
+        """ Forces the next placements to reload the stats, of every
+        database
+        """
+        with self._lock:
+            self._stats.clear()
+
+    def choose(self, quota=0, db_session=None):
+        """ Picks a storage node for one new mailbox and accounts for it
+
+        :param quota: Int, quota of the new mailbox in MB
+        :param db_session: Session to query with, defaults to the calling
+                           thread's
+        :return: Storage node name
+        """
+        return self.assign([quota], db_session)[0]
+
+    def assign(self, quotas, db_session=None):
+        """ Spreads new mailboxes over the storage nodes
+
+        Each mailbox goes to the node that is the least full relative to its
+        capacity at that point, so a bulk import sends more records to the
+        nodes with the most room left and the nodes fill up evenly.
+
+        The cached stats only account for the mailboxes once every one of them
+        got a node; when creating them fails afterwards, hand the nodes back
+        with release().
+
+        :param quotas: List of Ints, the quotas of the new mailboxes in MB
+        :param db_session: Session to query with, defaults to the calling
+                           thread's
+        :return: List of storage node names, one per quota
+        :raises RuntimeError: If every node is full
+        """
+        db_session = db_session or get_db_session()
+        key = _database_key(db_session)
+        stats = self.stats(db_session)
+
+        with self._lock:
+            # Other threads may have placed mailboxes in the meantime
+            stats = self._stats.get(key, stats)
+
+            placed = dict((name, copy.copy(node))
+                          for name, node in stats.items())
+            default_bytes = self._default_mailbox_bytes(placed)
+
+            # Name breaks ties deterministically
+            heap = [(s.utilization, s.name) for s in placed.values()
+                    if not s.full]
+            heapq.heapify(heap)
+
+            assigned = []
+            for quota in quotas:
+                if not heap:
+                    raise RuntimeError('All storage nodes are full.')
+
+                _, name = heapq.heappop(heap)
+                node = placed[name]
+                node.mailboxes += 1
+                node.used_bytes += int(quota) * 1024 * 1024 or default_bytes
+                assigned.append(name)
+
+                if not node.full:
+                    heapq.heappush(heap, (node.utilization, name))
+
+            # Unless invalidate() was called, then they're reloaded anyway
+            if key in self._stats:
+                self._stats[key] = placed
+
+        return assigned
+
+    def release(self, nodes, quotas, db_session=None):
+        """ Takes back mailboxes that assign() placed but that weren't created
+
+        :param nodes: List of storage node names assign() returned
+        :param quotas: List of Ints, the quotas given to assign()
+        :param db_session: Session of the database they were placed for,
+                           defaults to the calling thread's
+        """
+        key = _database_key(db_session or get_db_session())
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                return
+
+            released = dict((name, copy.copy(node))
+                            for name, node in stats.items())
+            default_bytes = self._default_mailbox_bytes(released)
+
+            for name, quota in zip(nodes, quotas):
+                node = released.get(name)
+                if node is None:
+                    continue
+
+                node.mailboxes = max(node.mailboxes - 1, 0)
+                node.used_bytes = max(
+                    node.used_bytes -
+                    (int(quota) * 1024 * 1024 or default_bytes), 0)
+
+            self._stats[key] = released
+
+    def _default_mailbox_bytes(self, stats):
+        if self.mailbox_bytes is not None:
+            return self.mailbox_bytes
+
+        mailboxes = sum(s.mailboxes for s in stats.values())
+        used_bytes = sum(s.used_bytes for s in stats.values())
+
+        # At least one byte so an empty cluster still spreads by capacity
+        return max(used_bytes // mailboxes if mailboxes else 0, 1)
+
+
+def _database_key(db_session):
+    return db_session.get_bind().url.render_as_string(hide_password=True)
@@ -0,0 +1,478 @@
+""" Brings domains, mailboxes and aliases to a desired state
+
+    import yaml
+    import mailapi
+
+    plan = mailapi.reconcile(yaml.safe_load(open('vmail.yaml')))  # dry run
+    mailapi.reconcile(yaml.safe_load(open('vmail.yaml')), dry_run=False)
+
+The desired state maps domain names to what they should look like:
+
+    example.com:
+      description: Example
+      mailboxes:
+        jdoe@example.com: {name: John Doe, quota: 1024, password: secret}
+      aliases:
+        info@example.com: [jdoe@example.com, jane@elsewhere.org]
+    old.example.com: null                  # deleted with everything in it
+
+Only the listed domains are looked at.  Within one, the keys that are given
+are authoritative: with 'mailboxes' present, mailboxes missing from it are
+deleted, without it the domain's mailboxes are left alone; same for
+'aliases' (the self-referential aliases of mailboxes aren't managed, they
+come and go with their mailbox).  A mailbox's name, quota, language and
+active flag are updated when they differ; its password is only used to
+create it.
+
+Aliases are filed under the domain of their (first) destination, as
+add_alias does.  A domain's aliases are the ones filed under it plus the
+listed ones wherever they're filed; an unlisted alias of the domain that
+forwards to another domain is filed there and left alone.
+
+The current state of the listed domains is read with a few queries per 500
+domains and compared in memory.  Applying runs in one transaction() with
+set-based statements: bulk INSERTs/UPDATEs per table, DELETEs by chunked IN
+lists, and create_mailboxes/delete_mailboxes for the mailboxes (placement,
+maildirs, the cache and the change feed work as with the other writes).
+"""
+import sys
+from datetime import datetime
+
+from sqlalchemy import delete, insert, select, update
+
+from . import changes
+from .alias import build_alias
+from .cache import forget_domain, forget_mailboxes
+from .db import get_db_session, read_only, transaction, writes
+from .domain import delete_domain
+from .mailbox import IN_CLAUSE_CHUNK_SIZE, create_mailboxes, delete_mailboxes
+from .models import Alias, Domain, Mailbox
+from .validators import is_domain, is_email
+
+
+CREATE = changes.CREATE
+UPDATE = changes.UPDATE
+DELETE = changes.DELETE
+
+# Rows per executemany() of the bulk INSERTs and UPDATEs
+BATCH_SIZE = 1000
+
+# Keys of a domain's and a mailbox's desired state; the mailbox keys map to
+# the columns compared with the current state
+DOMAIN_KEYS = ('description', 'active', 'mailboxes', 'aliases')
+MAILBOX_COLUMNS = {'name': 'name', 'quota': 'quota', 'language': 'language',
+                   'active': 'active'}
+MAILBOX_KEYS = tuple(MAILBOX_COLUMNS) + ('password', 'storage_node')
+
+_SYMBOLS = {CREATE: '+', UPDATE: '~', DELETE: '-'}
+
+
+class Action(object):
+    """ One row to create, update or delete
+    """
+
+    __slots__ = ('op', 'entity', 'key', 'values', 'previous')
+
+    def __init__(self, op, entity, key, values=None, previous=None):
+        #: 'create', 'update' or 'delete'
+        self.op = op
+        #: 'domain', 'mailbox' or 'alias'
+        self.entity = entity
+        #: Domain name or email address
+        self.key = key
+        #: Column values to set (the desired state's for a mailbox create)
+        self.values = values or {}
+        #: Current values of the columns an update changes
+        self.previous = previous or {}
+
+    def __str__(self):
+        line = '%s %s %s' % (_SYMBOLS[self.op], self.entity, self.key)
+        if self.op == UPDATE:
+            line += ': ' + ', '.join(
+                '%s %r -> %r' % (name, self.previous.get(name), value)
+                for name, value in sorted(self.values.items()))
+        return line
+
+    def __repr__(self):
+        return '<Action %s>' % self
+
+
+class Plan(object):
+    """ What reconcile() does (or did) to reach the desired state
+    """
+
+    def __init__(self, actions=None):
+        #: List of Action objects
+        self.actions = actions or []
+
+    def get(self, op, entity):
+        """ The actions of one kind
+
+        :param op: 'create', 'update' or 'delete'
+        :param entity: 'domain', 'mailbox' or 'alias'
+        :return: List of Action objects
+        """
+        return [a for a in self.actions if a.op == op and a.entity == entity]
+
+    def summary(self):
+        """ # of actions per op and entity, e.g. {'create mailbox': 3} """
+        counts = {}
+        for action in self.actions:
+            key = '%s %s' % (action.op, action.entity)
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def __len__(self):
+        return len(self.actions)
+
+    def __iter__(self):
+        return iter(self.actions)
+
+    def __str__(self):
+        if not self.actions:
+            return 'Nothing to do'
+
+        summary = ', '.join('%d to %s' % (count, key) for key, count in
+                            sorted(self.summary().items()))
+        return '\n'.join([str(a) for a in self.actions] + [summary])
+
+
+def _gotos(value):
+    """ Canonical goto of an alias: its addresses, sorted, comma separated """
+    if isinstance(value, str):
+        value = value.split(',')
+    return ','.join(sorted(set(v.strip() for v in value if v.strip())))
+
+
+def _flag(value):
+    return 1 if value else 0
+
+
+def _validate(desired_state):
+    """ Checks the desired state and normalizes its values
+
+    :return: Dict of domain name => normalized spec (None for deletes)
+    :raises ValueError: If the desired state is malformed
+    """
+    normalized = {}
+
+    for domain_name, spec in desired_state.items():
+        if not is_domain(domain_name):
+            raise ValueError('Invalid domain name supplied: %s' % domain_name)
+        if spec is None:
+            normalized[domain_name] = None
+            continue
+
+        unknown = set(spec) - set(DOMAIN_KEYS)
+        if unknown:
+            raise ValueError('Unknown keys for domain %s: %s' %
+                             (domain_name, ', '.join(sorted(unknown))))
+
+        spec = dict(spec)
+        if 'active' in spec:
+            spec['active'] = _flag(spec['active'])
+
+        if spec.get('mailboxes') is not None:
+            mailboxes = {}
+            for address, mailbox_spec in spec['mailboxes'].items():
+                mailbox_spec = dict(mailbox_spec or {})
+                _check_address(address, domain_name, 'mailbox')
+
+                unknown = set(mailbox_spec) - set(MAILBOX_KEYS)
+                if unknown:
+                    raise ValueError('Unknown keys for mailbox %s: %s' %
+                                     (address, ', '.join(sorted(unknown))))
+                if 'quota' in mailbox_spec:
+                    mailbox_spec['quota'] = int(mailbox_spec['quota'])
+                if 'active' in mailbox_spec:
+                    mailbox_spec['active'] = _flag(mailbox_spec['active'])
+
+                mailboxes[address] = mailbox_spec
+            spec['mailboxes'] = mailboxes
+
+        if spec.get('aliases') is not None:
+            aliases = {}
+            for address, gotos in spec['aliases'].items():
+                _check_address(address, domain_name, 'alias')
+                gotos = _gotos(gotos)
+                for goto in gotos.split(','):
+                    if not is_email(goto):
+                        raise ValueError('Invalid destination email address '
+                                         'provided: %s' % goto)
+                aliases[address] = gotos
+            spec['aliases'] = aliases
+
+        normalized[domain_name] = spec
+
+    return normalized
+
+
+def _check_address(address, domain_name, entity):
+    if not is_email(address):
+        raise ValueError('Invalid email address provided: %s' % address)
+    if address.split('@')[1] != domain_name:
+        raise ValueError('The %s %s is not in the domain %s' %
+                         (entity, address, domain_name))
+
+
+@read_only
+def load_state(domain_names, alias_addresses=()):
+    """ The current domains, mailboxes and aliases of the given domains
+
+    Plain rows are streamed, no model objects are loaded.  Every query
+    filters on an indexed column: the domain or the alias' address.
+
+    :param domain_names: Iterable of domain names
+    :param alias_addresses: Iterable of addresses of aliases to load too,
+                            wherever they're filed
+    :return: (domains, mailboxes, aliases): dicts of domain name => dict of
+             description & active, address => dict of the mailbox columns
+             reconcile compares and domain, address => goto
+    """
+    db_session = get_db_session()
+    domain_names = sorted(set(domain_names))
+    domains, mailboxes, aliases = {}, {}, {}
+
+    mailbox_columns = [getattr(Mailbox, c) for c in MAILBOX_COLUMNS.values()]
+    for i in range(0, len(domain_names), IN_CLAUSE_CHUNK_SIZE):
+        chunk = domain_names[i:i + IN_CLAUSE_CHUNK_SIZE]
+
+        for row in db_session.execute(
+                select(Domain.domain, Domain.description, Domain.active).
+                where(Domain.domain.in_(chunk))):
+            domains[row.domain] = {'description': row.description,
+                                   'active': row.active}
+
+        for row in db_session.execute(
+                select(Mailbox.username, Mailbox.domain, *mailbox_columns).
+                where(Mailbox.domain.in_(chunk)).
+                execution_options(yield_per=BATCH_SIZE)):
+            mailboxes[row.username] = dict(
+                (name, getattr(row, column))
+                for name, column in MAILBOX_COLUMNS.items())
+            mailboxes[row.username]['domain'] = row.domain
+
+        for row in db_session.execute(
+                select(Alias.address, Alias.goto).
+                where(Alias.domain.in_(chunk)).
+                execution_options(yield_per=BATCH_SIZE)):
+            aliases[row.address] = row.goto or ''
+
+    # Listed aliases filed under another domain, by primary key
+    missing = sorted(set(alias_addresses) - set(aliases))
+    for i in range(0, len(missing), IN_CLAUSE_CHUNK_SIZE):
+        for row in db_session.execute(
+                select(Alias.address, Alias.goto).
+                where(Alias.address.in_(missing[i:i + IN_CLAUSE_CHUNK_SIZE]))):
+            aliases[row.address] = row.goto or ''
+
+    return domains, mailboxes, aliases
+
+
+def plan(desired_state):
+    """ Compares the desired state with the database's
+
+    :param desired_state: Dict of domain name => spec, see the module's
+                          docstring
+    :return: Plan
+    :raises ValueError: If the desired state is malformed
+    """
+    desired = _validate(desired_state)
+    domains, mailboxes, aliases = load_state(
+        desired, [address for spec in desired.values() if spec
+                  for address in spec.get('aliases') or ()])
+    actions = []
+
+    for domain_name in sorted(desired):
+        spec = desired[domain_name]
+        current = domains.get(domain_name)
+
+        if spec is None:
+            if current is not None:
+                actions.append(Action(DELETE, 'domain', domain_name))
+            continue
+
+        values = dict((key, spec[key]) for key in ('description', 'active')
+                      if key in spec)
+        if current is None:
+            actions.append(Action(CREATE, 'domain', domain_name, values))
+        else:
+            _update(actions, 'domain', domain_name, values, current)
+
+        mailbox_specs = spec.get('mailboxes')
+        domain_mailboxes = set(address for address, row in mailboxes.items()
+                               if row['domain'] == domain_name)
+        if mailbox_specs is not None:
+            for address in sorted(domain_mailboxes - set(mailbox_specs)):
+                actions.append(Action(DELETE, 'mailbox', address))
+
+            for address, mailbox_spec in sorted(mailbox_specs.items()):
+                if address not in mailboxes:
+                    if 'password' not in mailbox_spec:
+                        raise ValueError('A password is required to create '
+                                         'the mailbox %s' % address)
+                    actions.append(Action(CREATE, 'mailbox', address,
+                                          mailbox_spec))
+                else:
+                    values = dict((key, mailbox_spec[key])
+                                  for key in MAILBOX_COLUMNS
+                                  if key in mailbox_spec)
+                    _update(actions, 'mailbox', address, values,
+                            mailboxes[address])
+
+        alias_specs = spec.get('aliases')
+        if alias_specs is not None:
+            # Self-referential aliases belong to their mailbox
+            managed = set(mailbox_specs or ()) | domain_mailboxes
+
+            for address in sorted(aliases):
+                if address.split('@')[1] == domain_name and \
+                   address not in alias_specs and address not in managed:
+                    actions.append(Action(DELETE, 'alias', address))
+
+            for address, goto in sorted(alias_specs.items()):
+                if address not in aliases and address not in mailboxes and \
+                   address in (mailbox_specs or ()):
+                    # e.g. a new mailbox forwarding copies elsewhere, its
+                    # self-referential alias comes with it
+                    actions.append(Action(UPDATE, 'alias', address,
+                                          {'goto': goto}, {'goto': address}))
+                elif address not in aliases:
+                    actions.append(Action(CREATE, 'alias', address,
+                                          {'goto': goto}))
+                elif _gotos(aliases[address]) != goto:
+                    actions.append(Action(UPDATE, 'alias', address,
+                                          {'goto': goto},
+                                          {'goto': aliases[address]}))
+
+    return Plan(actions)
+
+
+def _update(actions, entity, key, values, current):
+    changed = dict((name, value) for name, value in values.items()
+                   if current.get(name) != value)
+    if changed:
+        actions.append(Action(UPDATE, entity, key, changed,
+                              dict((name, current.get(name))
+                                   for name in changed)))
+
+
+def _chunks(values, size):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+@writes
+def apply(plan):
+    """ Carries out a plan, within the caller's transaction
+
+    :param plan: Plan
+    """
+    db_session = get_db_session()
+    now = datetime.now()
+
+    # Domains first, the mailboxes and aliases need them
+    rows = [dict(action.values, domain=action.key, created=now, modified=now)
+            for action in plan.get(CREATE, 'domain')]
+    for batch in _chunks(rows, BATCH_SIZE):
+        db_session.execute(insert(Domain), batch)
+    for row in rows:
+        forget_domain(row['domain'])
+    changes.record(changes.DOMAIN, CREATE, [row['domain'] for row in rows])
+
+    _bulk_update(Domain, 'domain', plan.get(UPDATE, 'domain'), now)
+    for action in plan.get(UPDATE, 'domain'):
+        forget_domain(action.key)
+
+    # Aliases are deleted before the mailboxes they may point to
+    deleted = [action.key for action in plan.get(DELETE, 'alias')]
+    for chunk in _chunks(deleted, IN_CLAUSE_CHUNK_SIZE):
+        db_session.execute(delete(Alias).where(Alias.address.in_(chunk)))
+    changes.record(changes.ALIAS, DELETE, deleted)
+
+    deleted = [action.key for action in plan.get(DELETE, 'mailbox')]
+    if deleted:
+        delete_mailboxes(deleted)
+
+    created = plan.get(CREATE, 'mailbox')
+    if created:
+        create_mailboxes([
+            dict(email_address=action.key,
+                 full_name=action.values.get('name', ''),
+                 plain_password=action.values['password'],
+                 **dict((key, action.values[key])
+                        for key in ('quota', 'language', 'storage_node')
+                        if key in action.values))
+            for action in created
+        ])
+
+        # create_mailboxes has no say over these
+        inactive = [Action(UPDATE, 'mailbox', action.key, {'active': 0})
+                    for action in created
+                    if action.values.get('active', 1) == 0]
+        _bulk_update(Mailbox, 'username', inactive, now)
+
+    updated = plan.get(UPDATE, 'mailbox')
+    _bulk_update(Mailbox, 'username', updated, now)
+    forget_mailboxes([action.key for action in updated])
+    changes.record(changes.MAILBOX, UPDATE, [a.key for a in updated])
+
+    created = plan.get(CREATE, 'alias')
+    for action in created:
+        # Filed like add_alias does, under the (first) destination's domain
+        goto = action.values['goto']
+        alias = build_alias(action.key, goto,
+                            goto.split(',')[0].split('@')[1])
+        db_session.add(alias)
+    changes.record(changes.ALIAS, CREATE, [a.key for a in created])
+
+    updated = plan.get(UPDATE, 'alias')
+    _bulk_update(Alias, 'address', updated, now)
+    changes.record(changes.ALIAS, UPDATE, [a.key for a in updated])
+
+    # Last, they take their mailboxes and aliases along
+    for action in plan.get(DELETE, 'domain'):
+        delete_domain(action.key)
+
+
+def _bulk_update(model, key, actions, now):
+    """ UPDATEs by primary key, one executemany per batch and set of columns
+    """
+    by_columns = {}
+    for action in actions:
+        by_columns.setdefault(tuple(sorted(action.values)), []).append(
+            dict(action.values, modified=now, **{key: action.key}))
+
+    db_session = get_db_session()
+    if by_columns:
+        # Bulk UPDATEs by primary key don't autoflush, the rows may be
+        # pending inserts of this transaction
+        db_session.flush()
+
+    for rows in by_columns.values():
+        for batch in _chunks(rows, BATCH_SIZE):
+            db_session.execute(update(model), batch)
+
+
+def reconcile(desired_state, dry_run=True, out=None):
+    """ Creates, updates and deletes domains, mailboxes and aliases until the
+    database matches @desired_state
+
+    :param desired_state: Dict of domain name => spec (None to delete the
+                          domain), see mailapi.reconciler
+    :param dry_run: True only prints the plan, False applies it in one
+                    transaction (committed unless something fails)
+    :param out: File the plan is printed to on a dry run, stdout by default
+    :return: Plan
+    :raises ValueError: If the desired state is malformed
+    """
+    if dry_run:
+        result = plan(desired_state)
+        print(result, file=out or sys.stdout)
+        return result
+
+    with transaction():
+        result = plan(desired_state)
+        apply(result)
+
+    return result
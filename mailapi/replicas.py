@@ -0,0 +1,52 @@
+""" Load balancing policies for read replicas
+
+init_db(conn_str, replicas=[...]) sends the read-only API calls to one of the
+replicas, picked per call by a policy.  A policy is any callable taking the
+list of replica engines and returning one of them; the named ones are:
+
+    round_robin  Each replica in turn (the default)
+    random       A random replica
+"""
+import itertools
+import random
+import threading
+
+
+ROUND_ROBIN = 'round_robin'
+RANDOM = 'random'
+
+
+class RoundRobinPolicy(object):
+    """ Hands out the replicas in turn, safe to share between threads
+    """
+
+    def __init__(self):
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def __call__(self, engines):
+        with self._lock:
+            i = next(self._counter)
+        return engines[i % len(engines)]
+
+
+def random_policy(engines):
+    """ Picks a random replica """
+    return random.choice(engines)
+
+
+def get_policy(policy):
+    """ Resolves a policy name to the policy
+
+    :param policy: ROUND_ROBIN, RANDOM or a callable taking the list of
+                   replica engines and returning one
+    :return: Callable
+    :raises ValueError: On an unknown name
+    """
+    if callable(policy):
+        return policy
+    if policy == ROUND_ROBIN:
+        return RoundRobinPolicy()
+    if policy == RANDOM:
+        return random_policy
+    raise ValueError('Unknown replica policy: %s' % policy)
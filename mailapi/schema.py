@@ -0,0 +1,243 @@
+""" Table definitions of the iRedMail vmail schema
+
+init_db maps the models onto the tables it gets from one of two sources:
+
+    reflect  One round of reflection against the live database (the default).
+             With schema_cache=path the reflected tables are pickled to disk
+             and later processes load them from there instead.
+    static   The definitions below, no catalog queries at all.  They cover the
+             columns this package uses, which every iRedMail release since 0.9
+             has; columns the API doesn't touch are simply not loaded.
+
+The cache is keyed by a fingerprint of the database URL, the schema_version
+passed to init_db and the SQLAlchemy version.  Nothing is asked of the
+database to validate it, so bump schema_version (e.g. to the iRedMail
+release) whenever the vmail schema is upgraded.  Unpickling runs code, so a
+cache file is only loaded when it belongs to the current user and nobody
+else can write to it; save_cache creates it readable by its owner only.
+
+The (modified, key) indexes aren't part of iRedMail's schema, they serve the
+iter_changed_since lookups.  Existing databases need them created, e.g.
+CREATE INDEX mailbox_modified ON mailbox (modified, username).
+"""
+import hashlib
+import logging
+import os
+import pickle
+import stat
+
+import sqlalchemy
+from sqlalchemy import (MetaData, Table, Column, Index, String, Text,
+                        Integer, BigInteger, SmallInteger, DateTime, text)
+
+
+SCHEMA_REFLECT = 'reflect'
+SCHEMA_STATIC = 'static'
+
+# The tables the models are mapped onto
+TABLE_NAMES = ('domain', 'mailbox', 'alias', 'used_quota')
+
+logger = logging.getLogger(__name__)
+
+_CREATED = text("'1970-01-01 01:01:01'")
+_EXPIRED = text("'9999-12-31 00:00:00'")
+
+
+metadata = MetaData()
+
+domain = Table(
+    'domain', metadata,
+    Column('domain', String(255), primary_key=True, server_default=''),
+    Column('description', Text),
+    Column('disclaimer', Text),
+    Column('aliases', Integer, nullable=False, server_default='0'),
+    Column('mailboxes', Integer, nullable=False, server_default='0'),
+    Column('maxquota', BigInteger, nullable=False, server_default='0'),
+    Column('quota', BigInteger, nullable=False, server_default='0'),
+    Column('transport', String(255), nullable=False,
+           server_default='dovecot'),
+    Column('backupmx', SmallInteger, nullable=False, server_default='0'),
+    Column('created', DateTime, nullable=False, server_default=_CREATED),
+    Column('modified', DateTime, nullable=False, server_default=_CREATED),
+    Column('expired', DateTime, nullable=False, server_default=_EXPIRED),
+    Column('active', SmallInteger, nullable=False, server_default='1'),
+    Index('domain_backupmx', 'backupmx'),
+    Index('domain_expired', 'expired'),
+    Index('domain_active', 'active'),
+    Index('domain_modified', 'modified', 'domain'),
+)
+
+mailbox = Table(
+    'mailbox', metadata,
+    Column('username', String(255), primary_key=True, server_default=''),
+    Column('password', String(255), nullable=False, server_default=''),
+    Column('name', String(255), nullable=False, server_default=''),
+    Column('language', String(5), nullable=False, server_default=''),
+    Column('storagebasedirectory', String(255), nullable=False,
+           server_default='/var/vmail'),
+    Column('storagenode', String(255), nullable=False,
+           server_default='vmail1'),
+    Column('maildir', String(255), nullable=False, server_default=''),
+    Column('quota', BigInteger, nullable=False, server_default='0'),
+    Column('domain', String(255), nullable=False, server_default=''),
+    Column('passwordlastchange', DateTime, nullable=False,
+           server_default=_CREATED),
+    Column('created', DateTime, nullable=False, server_default=_CREATED),
+    Column('modified', DateTime, nullable=False, server_default=_CREATED),
+    Column('expired', DateTime, nullable=False, server_default=_EXPIRED),
+    Column('active', SmallInteger, nullable=False, server_default='1'),
+    Column('local_part', String(255), nullable=False, server_default=''),
+    Index('mailbox_domain', 'domain'),
+    Index('mailbox_expired', 'expired'),
+    Index('mailbox_active', 'active'),
+    Index('mailbox_modified', 'modified', 'username'),
+)
+
+alias = Table(
+    'alias', metadata,
+    Column('address', String(255), primary_key=True, server_default=''),
+    Column('goto', Text),
+    Column('name', String(255), nullable=False, server_default=''),
+    Column('domain', String(255), nullable=False, server_default=''),
+    Column('created', DateTime, nullable=False, server_default=_CREATED),
+    Column('modified', DateTime, nullable=False, server_default=_CREATED),
+    Column('expired', DateTime, nullable=False, server_default=_EXPIRED),
+    Column('active', SmallInteger, nullable=False, server_default='1'),
+    Index('alias_domain', 'domain'),
+    Index('alias_expired', 'expired'),
+    Index('alias_active', 'active'),
+    Index('alias_modified', 'modified', 'address'),
+)
+
+used_quota = Table(
+    'used_quota', metadata,
+    Column('username', String(255), primary_key=True),
+    Column('bytes', BigInteger, nullable=False, server_default='0'),
+    Column('messages', BigInteger, nullable=False, server_default='0'),
+    Column('domain', String(255), nullable=False, server_default=''),
+    Index('used_quota_domain', 'domain'),
+)
+
+
+def fingerprint(url, schema_version=None):
+    """ Identifies the schema a cache file was written for
+
+    :param url: sqlalchemy.engine.URL of the database
+    :param schema_version: String naming the schema's version, e.g. the
+                           iRedMail release
+    :return: String
+    """
+    parts = (
+        url.get_backend_name(),
+        url.host or '',
+        str(url.port or ''),
+        url.database or '',
+        schema_version or '',
+        sqlalchemy.__version__,
+        ','.join(TABLE_NAMES),
+    )
+    return hashlib.sha1('\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+def load_cache(path, expected_fingerprint):
+    """ Loads tables pickled by save_cache
+
+    :param path: Cache file
+    :param expected_fingerprint: See fingerprint()
+    :return: MetaData or None if the file is missing, unreadable, written
+             for another schema or writable by someone else
+    """
+    try:
+        with open(path, 'rb') as f:
+            # Checked before anything is unpickled, on the file that was
+            # opened
+            if not _private(os.fstat(f.fileno())):
+                logger.warning('Ignoring the schema cache %s, it is not '
+                               'owned by and only writable by the current '
+                               'user', path)
+                return None
+            cached = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError,
+            ImportError):
+        return None
+
+    if not isinstance(cached, dict) or \
+       cached.get('fingerprint') != expected_fingerprint:
+        return None
+
+    return cached.get('metadata')
+
+
+def save_cache(path, fingerprint, reflected):
+    """ Pickles reflected tables to @path
+
+    The file is written under a temporary name and renamed into place, so
+    processes starting concurrently never load half a file.  Only its owner
+    can read and write it.
+
+    :param path: Cache file
+    :param fingerprint: See fingerprint()
+    :param reflected: MetaData
+    """
+    partial = '%s.%d.part' % (path, os.getpid())
+    try:
+        fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump({'fingerprint': fingerprint, 'metadata': reflected},
+                        f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(partial, path)
+    except BaseException:
+        if os.path.exists(partial):
+            os.unlink(partial)
+        raise
+
+
+def _private(file_stat):
+    """ Whether only the current user could have written the file """
+    if file_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        return False
+
+    # No owners to compare on e.g. Windows
+    return not hasattr(os, 'getuid') or file_stat.st_uid == os.getuid()
+
+
+def load_metadata(url, schema=SCHEMA_REFLECT, schema_cache=None,
+                  schema_version=None):
+    """ Gets the tables to map the models onto without asking the database
+
+    :param url: sqlalchemy.engine.URL of the database
+    :param schema: SCHEMA_REFLECT or SCHEMA_STATIC
+    :param schema_cache: Optional path of the reflection cache file
+    :param schema_version: See fingerprint()
+    :return: MetaData or None if the tables have to be reflected
+    :raises ValueError: On an unknown @schema
+    """
+    if schema == SCHEMA_STATIC:
+        return metadata
+
+    if schema != SCHEMA_REFLECT:
+        raise ValueError('Unknown schema source: %s' % schema)
+
+    if schema_cache is None:
+        return None
+
+    return load_cache(schema_cache, fingerprint(url, schema_version))
+
+
+def reflect(bind, url=None, schema_cache=None, schema_version=None):
+    """ Reflects the vmail tables from the database
+
+    :param bind: Engine or Connection
+    :param url: sqlalchemy.engine.URL of the database, needed with
+                @schema_cache
+    :param schema_cache: Optional path to write the reflected tables to
+    :param schema_version: See fingerprint()
+    :return: MetaData
+    """
+    reflected = MetaData()
+    reflected.reflect(bind, only=TABLE_NAMES)
+
+    if schema_cache is not None:
+        save_cache(schema_cache, fingerprint(url, schema_version), reflected)
+
+    return reflected
@@ -0,0 +1,254 @@
+""" Streaming export and import of the vmail tables
+
+    from mailapi import snapshot
+
+    snapshot.export('/tmp/tenant.snapshot.gz', domains=['example.com'])
+    snapshot.import_('/tmp/tenant.snapshot.gz')      # on another database
+
+A snapshot is a gzip compressed file of JSON lines.  The first line is a
+header naming the format, its version and the columns of each table; then
+come the domain, mailbox, alias and used_quota sections, each a line naming
+the table followed by one JSON array of column values per row.
+
+Both sides hold one chunk of rows in memory at a time.  export() reads the
+tables with a server side cursor (where the driver has one) inside a single
+transaction, so the snapshot is consistent on databases with snapshot
+isolation (e.g. InnoDB's REPEATABLE READ); import_() inserts each chunk with
+one executemany straight to the driver (MySQL's drivers turn it into
+multi-row INSERTs), all in one transaction.
+
+Rows are imported as they are: the cache (see mailapi.cache) is cleared
+afterwards, but no change events are recorded (see mailapi.changes).
+"""
+import gzip
+import json
+from datetime import datetime
+
+from sqlalchemy import DateTime, inspect, select
+
+from .bulk import BulkInsert
+from .cache import get_cache
+from .db import get_engine
+from .exc import SnapshotError
+from .models import Alias, Domain, Mailbox, UsedQuota
+
+
+FORMAT = 'mailapi-snapshot'
+VERSION = 1
+
+# Tables in the order they're written and read
+MODELS = (Domain, Mailbox, Alias, UsedQuota)
+
+# Rows per fetch and per INSERT
+CHUNK_SIZE = 5000
+
+# Speed over size, level 1 already shrinks the rows ~5 times
+COMPRESS_LEVEL = 1
+
+# Distinct dates converted once per column, the same ones (expired,
+# created == modified...) come up over and over
+_MAX_MEMO = 100000
+
+_encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False,
+                            default=lambda value: value.isoformat(' '))
+
+
+def _tables():
+    return [inspect(model).local_table for model in MODELS]
+
+
+def _memoize(func):
+    memo = {}
+
+    def memoized(value):
+        try:
+            return memo[value]
+        except KeyError:
+            result = func(value)
+            if len(memo) < _MAX_MEMO:
+                memo[value] = result
+            return result
+
+    return memoized
+
+
+def _format_datetime(value):
+    return value.isoformat(' ')
+
+
+def _datetime_parsers(inserter, columns):
+    """ (index, parser) of the DateTime columns of a BulkInsert's rows
+
+    Rows that go to the driver as they are get the values SQLAlchemy would
+    have sent for the datetimes, e.g. strings with microseconds on SQLite.
+    """
+    dialect = inserter.connection.dialect
+    parsers = []
+
+    for i, name in enumerate(columns):
+        column_type = inserter.table.c[name].type
+        if not isinstance(column_type, DateTime):
+            continue
+
+        process = None
+        if inserter.sql is not None:
+            process = column_type.dialect_impl(dialect).\
+                bind_processor(dialect)
+
+        if process is None:
+            parse = datetime.fromisoformat
+        else:
+            def parse(value, process=process):
+                return process(datetime.fromisoformat(value))
+        parsers.append((i, _memoize(parse)))
+
+    return parsers
+
+
+def export(path, domains=None, chunk_size=CHUNK_SIZE):
+    """ Writes the rows of the vmail tables to a snapshot file
+
+    :param path: File to write, overwritten if it exists
+    :param domains: Iterable of domain names to export the rows of, None for
+                    every domain
+    :param chunk_size: # of rows fetched at a time
+    :return: Dict of table name => # of rows written
+    :raises DbInitError: If init_db has not been called
+    """
+    if domains is not None:
+        domains = sorted(set(domains))
+
+    tables = _tables()
+    header = {
+        'format': FORMAT,
+        'version': VERSION,
+        'created': datetime.now(),
+        'domains': domains,
+        'tables': dict((table.name, [column.name for column in table.c])
+                       for table in tables),
+    }
+
+    counts = {}
+    encode = _encoder.encode
+    with gzip.open(path, 'wt', encoding='utf-8',
+                   compresslevel=COMPRESS_LEVEL) as f, \
+            get_engine().connect() as connection, connection.begin():
+        f.write(encode(header) + '\n')
+
+        connection = connection.execution_options(yield_per=chunk_size)
+        for table in tables:
+            query = select(*table.c)
+            if domains is not None:
+                query = query.where(table.c.domain.in_(domains))
+
+            datetimes = [i for i, column in enumerate(table.c)
+                         if isinstance(column.type, DateTime)]
+            format_datetime = _memoize(_format_datetime)
+
+            f.write(encode({'table': table.name}) + '\n')
+            counts[table.name] = 0
+            for rows in connection.execute(query).partitions():
+                lines = []
+                for row in rows:
+                    row = list(row)
+                    for i in datetimes:
+                        if row[i] is not None:
+                            row[i] = format_datetime(row[i])
+                    lines.append(encode(row))
+
+                f.write('\n'.join(lines) + '\n')
+                counts[table.name] += len(rows)
+
+    return counts
+
+
+def read_header(path):
+    """ The header of a snapshot file
+
+    :param path: Snapshot file
+    :return: Dict with format, version, created, domains and tables (table
+             name => column names)
+    :raises SnapshotError: If the file isn't a snapshot this version reads
+    """
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return _read_header(f)
+
+
+def _read_header(f):
+    try:
+        header = json.loads(f.readline())
+    except (ValueError, OSError):
+        header = None
+
+    if not isinstance(header, dict) or header.get('format') != FORMAT:
+        raise SnapshotError('Not a mailapi snapshot')
+    if header.get('version', 0) > VERSION:
+        raise SnapshotError('Snapshot version %s is newer than %s' %
+                            (header.get('version'), VERSION))
+
+    return header
+
+
+def import_(path, chunk_size=CHUNK_SIZE):
+    """ Inserts the rows of a snapshot file
+
+    Everything is inserted in one transaction: rows that already exist make
+    the import fail with an IntegrityError and nothing is imported.
+
+    :param path: File export() wrote
+    :param chunk_size: # of rows per INSERT
+    :return: Dict of table name => # of rows inserted
+    :raises SnapshotError: If the file isn't a snapshot, was written by a
+                           newer version or has columns the tables don't
+    :raises DbInitError: If init_db has not been called
+    """
+    tables = dict((table.name, table) for table in _tables())
+    counts = {}
+
+    with gzip.open(path, 'rt', encoding='utf-8') as f, \
+            get_engine().begin() as connection:
+        header = _read_header(f)
+
+        for name, columns in header['tables'].items():
+            table = tables.get(name)
+            if table is None:
+                raise SnapshotError('Unknown table %s' % name)
+            missing = [c for c in columns if c not in table.c]
+            if missing:
+                raise SnapshotError('Table %s has no column %s' %
+                                    (name, ', '.join(missing)))
+
+        inserter = parsers = None
+        loads = json.loads
+
+        for line in f:
+            row = loads(line)
+
+            if isinstance(row, dict):
+                if inserter is not None:
+                    inserter.flush()
+                    counts[inserter.table.name] = inserter.count
+
+                name = row['table']
+                columns = tuple(header['tables'][name])
+                inserter = BulkInsert(connection, tables[name], columns)
+                parsers = _datetime_parsers(inserter, columns)
+                continue
+
+            for i, parse in parsers:
+                if row[i] is not None:
+                    row[i] = parse(row[i])
+            inserter.rows.append(tuple(row))
+
+            if len(inserter.rows) >= chunk_size:
+                inserter.flush()
+
+        if inserter is not None:
+            inserter.flush()
+            counts[inserter.table.name] = inserter.count
+
+    cache = get_cache()
+    if cache is not None:
+        cache.clear()
+
+    return counts
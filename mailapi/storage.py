@@ -0,0 +1,294 @@
+""" Filesystem side of mailbox management
+
+The database only records where a mailbox lives
+(storagebasedirectory/storagenode/maildir); a storage backend makes that path
+exist on disk.  No backend is configured by default, so nothing touches the
+filesystem unless you opt in:
+
+    from mailapi.storage import MaildirStorage, set_storage_backend
+
+    set_storage_backend(MaildirStorage(workers=8))
+
+Maildirs of deleted mailboxes are only trashed once the deletion commits, a
+rollback leaves them where they are.
+"""
+import errno
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+logger = logging.getLogger(__name__)
+
+
+# Sub directories every maildir needs before delivery can happen
+MAILDIR_SUBDIRS = ('cur', 'new', 'tmp')
+
+# Deleted maildirs are renamed into this directory under the storage node
+TRASH_DIRNAME = '.trash'
+
+
+# Session.info key holding the maildirs to trash once the session commits, as
+# (SessionTransaction they were deleted in, backend, DeletedMailbox) tuples
+_PENDING = 'mailapi.trash_pending'
+
+# The storage backend used by the mailbox module, None means "don't touch the
+# filesystem".  Use set_storage_backend() to change it.
+_storage_backend = None
+
+# What the backend gets to trash: the columns locating a deleted mailbox's
+# maildir, read while the row was still there
+DeletedMailbox = namedtuple('DeletedMailbox', ['username',
+                                               'storagebasedirectory',
+                                               'storagenode', 'maildir'])
+
+
+def set_storage_backend(backend):
+    """ Sets the backend used to provision and remove maildirs
+
+    :param backend: MaildirStorage (or compatible) object or None to disable
+    :return: The previous backend
+    """
+    global _storage_backend
+
+    previous = _storage_backend
+    _storage_backend = backend
+    return previous
+
+
+def get_storage_backend():
+    """ Gets the configured storage backend
+
+    :return: The storage backend or None if the filesystem isn't managed
+    """
+    return _storage_backend
+
+
+def maildir_location(mailbox):
+    """ Absolute path of the given mailbox's maildir
+
+    :param mailbox: Mailbox model object
+    :return: String
+    """
+    return os.path.join(mailbox.storagebasedirectory,
+                        mailbox.storagenode,
+                        mailbox.maildir)
+
+
+def trash_on_commit(db_session, mailboxes):
+    """ Has the storage backend trash the maildirs of deleted mailboxes once
+    the transaction deleting them commits
+
+    Nothing is moved if the transaction, or the savepoint they were deleted
+    in, is rolled back.  The backend's errors are logged, not raised; the rows
+    are gone by then.
+
+    :param db_session: The (sync) session the mailboxes were deleted in
+    :param mailboxes: Iterable of Mailbox model objects
+    """
+    backend = _storage_backend
+    if backend is None:
+        return
+
+    deleted = [DeletedMailbox(m.username, m.storagebasedirectory,
+                              m.storagenode, m.maildir) for m in mailboxes]
+    if not deleted:
+        return
+
+    _listen()
+    transaction = db_session.get_nested_transaction() or \
+        db_session.get_transaction()
+    db_session.info.setdefault(_PENDING, []).extend(
+        (transaction, backend, mailbox) for mailbox in deleted)
+
+
+def _listen():
+    if not event.contains(Session, 'after_commit', _trash):
+        event.listen(Session, 'after_commit', _trash)
+        event.listen(Session, 'after_soft_rollback', _discard_rolled_back)
+        event.listen(Session, 'after_transaction_end', _discard)
+
+
+def _trash(session):
+    # Released savepoints commit too
+    if session.in_nested_transaction():
+        return
+
+    for _, backend, mailbox in session.info.pop(_PENDING, None) or ():
+        try:
+            backend.trash(mailbox)
+        except Exception:
+            logger.exception('Trashing the maildir of %s failed',
+                             mailbox.username)
+
+
+def _within(transaction, ancestor):
+    while transaction is not None:
+        if transaction is ancestor:
+            return True
+        transaction = transaction.parent
+    return False
+
+
+def _discard_rolled_back(session, previous_transaction):
+    # A savepoint rolled back, its mailboxes (and its savepoints') are back
+    pending = session.info.get(_PENDING)
+    if pending and previous_transaction.parent is not None:
+        pending[:] = [item for item in pending
+                      if not _within(item[0], previous_transaction)]
+
+
+def _discard(session, transaction):
+    # Whatever's left once the outermost transaction ended without a commit
+    if transaction.parent is None:
+        session.info.pop(_PENDING, None)
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class MaildirStorage(object):
+    """ Creates maildirs on create and trashes them on delete
+
+    Paths are created in batches spread across a pool of worker threads.
+    Parent directories are remembered once created so siblings in the same
+    hashed directory (e.g. domain/j/o/h/) don't pay for another makedirs.
+    """
+
+    def __init__(self, workers=4, batch_size=500, mode=0o700, uid=None,
+                 gid=None, trash_dirname=TRASH_DIRNAME):
+        """
+        :param workers: Int, size of the thread pool used for bulk creates
+        :param batch_size: Int, # of maildirs handed to a worker at a time
+        :param mode: Permission bits of the created directories
+        :param uid: Owner of the created directories, None to leave as is
+        :param gid: Group of the created directories, None to leave as is
+        :param trash_dirname: Where deleted maildirs go, relative to the
+                              storage node so the move stays a rename
+        """
+        self.workers = max(int(workers), 1)
+        self.batch_size = max(int(batch_size), 1)
+        self.mode = mode
+        self.uid = uid
+        self.gid = gid
+        self.trash_dirname = trash_dirname
+
+        self._known_parents = set()
+        self._lock = threading.Lock()
+
+    def provision(self, mailboxes):
+        """ Creates the cur/new/tmp maildir structure for each mailbox
+
+        :param mailboxes: Iterable of Mailbox model objects
+        :return: List of absolute maildir paths
+        """
+        paths = [maildir_location(m) for m in mailboxes]
+        self.create_maildirs(paths)
+        return paths
+
+    def create_maildirs(self, paths):
+        """ Creates maildirs at the given absolute paths
+
+        :param paths: List of Strings
+        :return: None
+        """
+
+        # Sorting keeps paths sharing a parent in the same batch
+        paths = sorted(paths)
+
+        if len(paths) <= self.batch_size or self.workers == 1:
+            self._create_batch(paths)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            # list() re-raises the first error from a worker
+            list(pool.map(self._create_batch,
+                          _chunks(paths, self.batch_size)))
+
+    def _create_batch(self, paths):
+        for path in paths:
+            self._create_maildir(path)
+
+    def _create_maildir(self, path):
+        path = path.rstrip(os.sep)
+        parent = os.path.dirname(path)
+
+        if parent not in self._known_parents:
+            self._makedirs(parent)
+            with self._lock:
+                self._known_parents.add(parent)
+
+        self._mkdir(path)
+        for subdir in MAILDIR_SUBDIRS:
+            self._mkdir(os.path.join(path, subdir))
+
+    def _makedirs(self, path):
+        # Ownership is only applied to the maildir itself, parents are shared
+        # by many mailboxes.
+        os.makedirs(path, mode=self.mode, exist_ok=True)
+
+    def _mkdir(self, path):
+        try:
+            os.mkdir(path, self.mode)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            return
+
+        if self.uid is not None or self.gid is not None:
+            os.chown(path,
+                     -1 if self.uid is None else self.uid,
+                     -1 if self.gid is None else self.gid)
+
+    def trash(self, mailbox):
+        """ Moves the mailbox's maildir into the storage node's trash area
+
+        The move is a single rename, the actual removal can happen later out
+        of band (e.g. a cron job emptying the trash directories).
+
+        :param mailbox: Mailbox model object or DeletedMailbox
+        :return: The path in the trash or None if there was no maildir
+        """
+        node_dir = os.path.join(mailbox.storagebasedirectory,
+                                mailbox.storagenode)
+        return self.trash_path(maildir_location(mailbox), node_dir)
+
+    def trash_path(self, path, node_dir):
+        """ Renames @path into the trash directory of @node_dir
+
+        :param path: Absolute path of a maildir
+        :param node_dir: Absolute path of the storage node it lives on
+        :return: The path in the trash or None if @path doesn't exist
+        """
+        path = path.rstrip(os.sep)
+        trash_dir = os.path.join(node_dir, self.trash_dirname)
+
+        if trash_dir not in self._known_parents:
+            self._makedirs(trash_dir)
+            with self._lock:
+                self._known_parents.add(trash_dir)
+
+        # Unique name so re-created and re-deleted mailboxes don't collide
+        destination = os.path.join(trash_dir, '%s-%s-%s' % (
+            time.strftime('%Y.%m.%d.%H.%M.%S'),
+            uuid.uuid4().hex[:8],
+            os.path.basename(path),
+        ))
+
+        try:
+            os.rename(path, destination)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+        return destination
@@ -0,0 +1,267 @@
+""" SQLite backed vmail databases for tests and benchmarks
+
+Nothing but the standard library's sqlite3 is needed:
+
+    from mailapi import testing
+
+    conn_str = testing.init_test_db()          # in-memory, tables created
+    testing.seed(conn_str, mailboxes=100000)   # realistic looking data
+
+The tables come from mailapi.schema, so they have the iRedMail primary keys
+and indexes.  mailapi's own test suite falls back to this when
+TEST_DB_CONN_STR isn't set.
+"""
+import atexit
+import os
+import random
+import shutil
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+from sqlalchemy.pool import SingletonThreadPool
+
+from .bulk import BulkInsert
+from .schema import metadata, domain, mailbox, alias, used_quota
+from .maildir import _maildir_path, _timestamp
+
+
+# Connections keeping in-memory databases alive, by URL; SQLite drops a
+# shared in-memory database once its last connection closes.
+_keep_alive = {}
+
+# Rows sent to the database per executemany() when seeding
+SEED_BATCH_SIZE = 10000
+
+_FIRST_NAMES = ('james', 'mary', 'john', 'patricia', 'robert', 'jennifer',
+                'michael', 'linda', 'william', 'elizabeth', 'david', 'susan',
+                'richard', 'jessica', 'joseph', 'sarah', 'thomas', 'karen',
+                'charles', 'nancy', 'daniel', 'lisa', 'matthew', 'betty')
+_LAST_NAMES = ('smith', 'johnson', 'williams', 'brown', 'jones', 'garcia',
+               'miller', 'davis', 'rodriguez', 'martinez', 'hernandez',
+               'lopez', 'gonzalez', 'wilson', 'anderson', 'thomas', 'taylor',
+               'moore', 'jackson', 'martin', 'lee', 'perez', 'thompson')
+_TLDS = ('com', 'net', 'org', 'io', 'de', 'co.uk', 'hu', 'fr')
+
+# Seeded mailboxes share one password hash, md5crypt is far too slow to run
+# a million times.  The password is 'password1234'.
+SEED_PASSWORD_HASH = '$1$mLtMBOTu$folrvUY3tnkn26DCrjRnP/'
+
+
+def memory_url(name=None):
+    """ URL of a shared in-memory SQLite database
+
+    Every connection to the URL sees the same database, as long as the
+    process runs.
+
+    :param name: Name of the database, a random one by default
+    :return: String
+    """
+    return 'sqlite:///file:%s?mode=memory&cache=shared&uri=true' % (
+        name or 'mailapi-%s' % uuid.uuid4().hex)
+
+
+def temp_file_url():
+    """ URL of a SQLite database file that's removed at exit
+
+    Unlike shared in-memory databases, files let several threads write
+    concurrently (SQLite's busy timeout makes them wait for each other).
+
+    :return: String
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='mailapi-')
+    atexit.register(shutil.rmtree, tmp_dir, True)
+    return 'sqlite:///' + os.path.join(tmp_dir, 'vmail.db')
+
+
+def engine_for(conn_str):
+    """ create_engine for the URLs of this module
+
+    :param conn_str: SQLAlchemy URL
+    :return: Engine
+    """
+    if 'mode=memory' in conn_str:
+        # What SQLAlchemy picks for these anyway, named to avoid its warning
+        return create_engine(conn_str, poolclass=SingletonThreadPool)
+    return create_engine(conn_str)
+
+
+def create_test_db(conn_str=None):
+    """ Creates the vmail tables
+
+    :param conn_str: SQLAlchemy URL, defaults to a new in-memory database
+    :return: The URL
+    """
+    conn_str = conn_str or memory_url()
+
+    engine = engine_for(conn_str)
+    metadata.create_all(engine)
+
+    if 'mode=memory' in conn_str:
+        _keep_alive[conn_str] = engine.connect()
+    else:
+        engine.dispose()
+
+    return conn_str
+
+
+def drop_test_db(conn_str):
+    """ Lets an in-memory database created by create_test_db go
+
+    :param conn_str: The URL create_test_db returned
+    """
+    connection = _keep_alive.pop(conn_str, None)
+    if connection is not None:
+        connection.close()
+        connection.engine.dispose()
+
+
+def init_test_db(conn_str=None, **options):
+    """ create_test_db and init_db in one go
+
+    :param conn_str: See create_test_db
+    :param options: Keyword arguments for init_db
+    :return: The URL
+    """
+    from .db import init_db
+
+    conn_str = create_test_db(conn_str)
+    options.setdefault('schema', 'static')
+    init_db(conn_str, **options)
+    return conn_str
+
+
+def _domain_names(count, rnd):
+    names = set()
+    while len(names) < count:
+        names.add('%s%d.%s' % (rnd.choice(_LAST_NAMES),
+                               rnd.randrange(count * 10),
+                               rnd.choice(_TLDS)))
+    return sorted(names)
+
+
+# Column order of the tuples seed() generates
+_DOMAIN_COLUMNS = ('domain', 'description', 'created', 'modified')
+_MAILBOX_COLUMNS = ('username', 'password', 'name', 'language',
+                    'storagebasedirectory', 'storagenode', 'maildir', 'quota',
+                    'domain', 'local_part', 'created', 'modified', 'active')
+_ALIAS_COLUMNS = ('address', 'goto', 'domain', 'created', 'modified')
+_USED_QUOTA_COLUMNS = ('username', 'bytes', 'messages', 'domain')
+
+
+def seed(conn_str_or_engine, domains=100, mailboxes=10000,
+         aliases_per_mailbox=1, with_used_quota=True, random_seed=0,
+         batch_size=SEED_BATCH_SIZE):
+    """ Fills a vmail database with generated, realistic looking data
+
+    Mailboxes are spread over the domains, each gets its self-referrential
+    alias plus @aliases_per_mailbox forwarding aliases and, optionally, a
+    used_quota row.  Rows go in with executemany() in batches within one
+    transaction, about a million mailboxes a minute on SQLite given a URL
+    (synchronous writes are only turned off on an engine of seed's own).
+
+    :param conn_str_or_engine: SQLAlchemy URL or Engine
+    :param domains: # of domains
+    :param mailboxes: # of mailboxes over all the domains
+    :param aliases_per_mailbox: # of extra aliases pointing at each mailbox
+    :param with_used_quota: Also fills used_quota
+    :param random_seed: Same seed, same data
+    :param batch_size: # of rows per executemany()
+    :return: Dict of table name => # of rows inserted
+    """
+    engine = conn_str_or_engine
+    if isinstance(engine, str):
+        engine = engine_for(engine)
+
+    rnd = random.Random(random_seed)
+    now = datetime.now().replace(microsecond=0)
+    timestamp = _timestamp(time.time())
+
+    domain_names = _domain_names(domains, rnd)
+
+    with engine.begin() as connection:
+        # Creation dates within the last ten years, formatted once the way
+        # SQLAlchemy would send them (e.g. with microseconds on SQLite), so
+        # they compare right with the ORM's
+        dialect = connection.dialect
+        process = mailbox.c.created.type.dialect_impl(dialect).\
+            bind_processor(dialect)
+        dates = [now - timedelta(days=days) for days in range(3650)]
+        if process is not None:
+            dates = [process(date) for date in dates]
+
+        if engine is not conn_str_or_engine and \
+           connection.dialect.name == 'sqlite':
+            # Only on our own engine: its connections are disposed of with
+            # it, a caller's would go back to their pool with the pragma set
+            connection.exec_driver_sql('PRAGMA synchronous = OFF')
+
+        domain_insert = BulkInsert(connection, domain, _DOMAIN_COLUMNS)
+        mailbox_insert = BulkInsert(connection, mailbox, _MAILBOX_COLUMNS)
+        alias_insert = BulkInsert(connection, alias, _ALIAS_COLUMNS)
+        quota_insert = BulkInsert(connection, used_quota, _USED_QUOTA_COLUMNS)
+        inserts = (mailbox_insert, alias_insert, quota_insert)
+
+        domain_insert.rows = [
+            (name, name.split('.')[0].title(), dates[0], dates[0])
+            for name in domain_names
+        ]
+        domain_insert.flush()
+
+        quotas = (0, 1024, 2048, 5120)
+        mean_bytes = 200 * 1024 ** 2
+        for i in range(mailboxes):
+            domain_name = domain_names[i % len(domain_names)]
+            first = rnd.choice(_FIRST_NAMES)
+            last = rnd.choice(_LAST_NAMES)
+
+            # The counter keeps addresses unique
+            local_part = '%s.%s%d' % (first, last, i)
+            address = '%s@%s' % (local_part, domain_name)
+            created = rnd.choice(dates)
+
+            mailbox_insert.rows.append((
+                address,
+                SEED_PASSWORD_HASH,
+                '%s %s' % (first.title(), last.title()),
+                'en_US',
+                '/var/vmail',
+                'vmail%d' % (i % 2 + 1),
+                _maildir_path(local_part, domain_name, timestamp, True, True),
+                rnd.choice(quotas),
+                domain_name,
+                local_part,
+                created,
+                created,
+                1,
+            ))
+
+            alias_insert.rows.append(
+                (address, address, domain_name, created, created))
+            for n in range(aliases_per_mailbox):
+                alias_insert.rows.append((
+                    '%s.%s%d.%d@%s' % (last, first, i, n, domain_name),
+                    address, domain_name, created, created))
+
+            if with_used_quota:
+                quota_insert.rows.append((
+                    address,
+                    int(rnd.expovariate(1.0 / mean_bytes)),
+                    rnd.randrange(20000),
+                    domain_name,
+                ))
+
+            if len(mailbox_insert.rows) >= batch_size:
+                for bulk_insert in inserts:
+                    bulk_insert.flush()
+
+        for bulk_insert in inserts:
+            bulk_insert.flush()
+
+    if engine is not conn_str_or_engine:
+        engine.dispose()
+
+    return dict((bulk_insert.table.name, bulk_insert.count)
+                for bulk_insert in (domain_insert,) + inserts)
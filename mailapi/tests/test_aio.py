@@ -0,0 +1,226 @@
+import asyncio
+import os
+import shutil
+import tempfile
+from unittest import IsolatedAsyncioTestCase, SkipTest
+
+try:
+    import aiosqlite  # noqa
+except ImportError:
+    raise SkipTest('aiosqlite is required for the asyncio tests')
+
+from ..models import Domain, Mailbox, Alias
+from ..exc import DomainExists, NoSuchDomain, NoSuchMailbox, AliasExists
+from .. import aio, cache, changes, testing
+from ..storage import MaildirStorage, maildir_location, set_storage_backend
+
+
+class AioBaseCase(IsolatedAsyncioTestCase):
+    """ Runs against a throwaway SQLite database through aiosqlite
+    """
+
+    async def asyncSetUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(self.tmp_dir, 'vmail.db')
+        testing.create_test_db('sqlite:///' + path)
+
+        await aio.init_db('sqlite+aiosqlite:///' + path, pool_size=5,
+                          max_overflow=0, schema='static')
+
+        self.domain_name = 'testdomain.lan'
+        await aio.domain.create_domain(self.domain_name, 'Test Domain')
+
+    async def asyncTearDown(self):
+        await aio.db.get_engine().dispose()
+        shutil.rmtree(self.tmp_dir)
+
+
+class AioDomainTests(AioBaseCase):
+    async def test_create_and_delete_domain(self):
+        domain = await aio.domain.get_domain(self.domain_name)
+
+        self.assertIsInstance(domain, Domain)
+        self.assertEqual(domain.description, 'Test Domain')
+        self.assertEqual(len(await aio.domain.get_all_domains()), 1)
+
+        with self.assertRaises(DomainExists):
+            await aio.domain.create_domain(self.domain_name)
+
+        self.assertTrue(await aio.domain.delete_domain(self.domain_name))
+        self.assertFalse(await aio.domain.domain_exists(self.domain_name))
+
+        with self.assertRaises(NoSuchDomain):
+            await aio.domain.delete_domain(self.domain_name)
+
+
+class AioMailboxTests(AioBaseCase):
+    async def test_create_mailbox(self):
+        email_address = 'testusr@' + self.domain_name
+
+        mailbox = await aio.mailbox.create_mailbox(email_address,
+                                                   'Test User',
+                                                   'password123')
+
+        self.assertIsInstance(mailbox, Mailbox)
+        self.assertTrue(await aio.mailbox.mailbox_exists(email_address))
+        self.assertEqual(
+            [m.username for m in await aio.mailbox.search_mailboxes('Test')],
+            [email_address])
+
+        # The self-referrential alias
+        aliases = await aio.alias.get_aliases(email_address)
+        self.assertEqual([a.address for a in aliases], [email_address])
+
+        self.assertTrue(await aio.mailbox.reset_mailbox_password(
+            email_address, 'password90125'))
+
+        self.assertTrue(await aio.mailbox.delete_mailbox(email_address))
+        self.assertIsNone(await aio.mailbox.get_mailbox(email_address))
+        self.assertEqual(await aio.alias.get_aliases(email_address), [])
+
+        with self.assertRaises(NoSuchMailbox):
+            await aio.mailbox.delete_mailbox(email_address)
+
+    async def test_create_mailboxes(self):
+        mailboxes = await aio.mailbox.create_mailboxes([
+            {'email_address': 'testusr%d@%s' % (i, self.domain_name),
+             'full_name': 'Test User',
+             'plain_password': 'password123'} for i in range(3)
+        ])
+
+        self.assertEqual(len(mailboxes), 3)
+        self.assertEqual(
+            len(await aio.domain.get_all_mailboxes(self.domain_name)), 3)
+
+        archives = await aio.mailbox.delete_mailboxes(
+            [m.username for m in mailboxes])
+        self.assertEqual(sorted(archives), sorted(m.username
+                                                  for m in mailboxes))
+        self.assertEqual(await aio.mailbox.get_all_mailboxes(), [])
+
+
+    async def test_delete_mailboxes_archive_failure(self):
+        set_storage_backend(MaildirStorage())
+        self.addCleanup(set_storage_backend, None)
+        mailboxes = await aio.mailbox.create_mailboxes([
+            {'email_address': 'testusr%d@%s' % (i, self.domain_name),
+             'full_name': 'Test User',
+             'plain_password': 'password123',
+             'storage_base_dir': self.tmp_dir} for i in range(3)
+        ])
+        bad = mailboxes[0]
+        shutil.rmtree(maildir_location(bad))
+
+        with self.assertRaises(FileNotFoundError):
+            await aio.mailbox.delete_mailboxes(
+                [m.username for m in mailboxes],
+                archive_to=os.path.join(self.tmp_dir, 'archive'))
+
+        # The deletes of the archived mailboxes were committed
+        self.assertEqual(
+            [m.username for m in await aio.mailbox.get_all_mailboxes()],
+            [bad.username])
+        for mailbox in mailboxes[1:]:
+            self.assertFalse(os.path.exists(maildir_location(mailbox)))
+
+
+class AioAliasTests(AioBaseCase):
+    async def test_add_alias(self):
+        source = 'testuser_alias@' + self.domain_name
+        dest = 'testuser@' + self.domain_name
+
+        alias = await aio.alias.add_alias(source, dest)
+        self.assertIsInstance(alias, Alias)
+
+        with self.assertRaises(AliasExists):
+            await aio.alias.add_alias(source, dest)
+
+        self.assertTrue(await aio.alias.delete_alias(source, dest))
+
+
+class AioSessionScopeTests(AioBaseCase):
+    async def test_scope_is_one_transaction(self):
+        with self.assertRaises(NoSuchDomain):
+            async with aio.session_scope():
+                await aio.domain.create_domain('testdomain2.lan')
+
+                # Fails, so the domain above is rolled back as well
+                await aio.mailbox.create_mailbox('testusr@fakedomain.tld',
+                                                 'Test User',
+                                                 'password123')
+
+        self.assertFalse(await aio.domain.domain_exists('testdomain2.lan'))
+
+    async def test_duplicate_alias_keeps_earlier_work(self):
+        source = 'alias@testdomain2.lan'
+        async with aio.session_scope():
+            await aio.domain.create_domain('testdomain2.lan')
+            await aio.alias.add_alias(source, 'a@testdomain2.lan')
+
+            # Only the duplicate's savepoint is rolled back
+            with self.assertRaises(AliasExists):
+                await aio.alias.add_alias(source, 'a@testdomain2.lan')
+            await aio.alias.add_alias('other@testdomain2.lan',
+                                      'a@testdomain2.lan')
+
+        self.assertTrue(await aio.domain.domain_exists('testdomain2.lan'))
+        self.assertEqual(
+            sorted(a.address for a in
+                   await aio.alias.get_aliases('a@testdomain2.lan')),
+            [source, 'other@testdomain2.lan'])
+
+
+class AioBookkeepingTests(AioBaseCase):
+    """ The cache, change feed and dates are kept as by the sync API
+    """
+
+    async def test_created(self):
+        domain = await aio.domain.get_domain(self.domain_name)
+        self.assertIsNotNone(domain.created)
+        self.assertEqual(domain.created, domain.modified)
+
+    async def test_changes(self):
+        published = []
+        changes.subscribe(published.append)
+        self.addCleanup(changes.unsubscribe, published.append)
+
+        email_address = 'testusr@' + self.domain_name
+        await aio.mailbox.create_mailbox(email_address, 'Test User',
+                                         'password123')
+        await aio.domain.delete_domain(self.domain_name)
+
+        self.assertEqual(
+            [[(c.op, c.entity, c.key) for c in batch] for batch in published],
+            [[('create', 'alias', email_address),
+              ('create', 'mailbox', email_address)],
+             [('delete', 'alias', email_address),
+              ('delete', 'mailbox', email_address),
+              ('delete', 'domain', self.domain_name)]])
+
+    async def test_cache_invalidated(self):
+        lookups = cache.Cache()
+        previous = cache.set_cache(lookups)
+        self.addCleanup(cache.set_cache, previous)
+
+        key = cache._key('domain_exists', 'testdomain2.lan')
+        lookups.set(key, False)
+        await aio.domain.create_domain('testdomain2.lan')
+
+        self.assertIs(lookups.get(key), cache.MISSING)
+
+
+class AioConcurrencyTests(AioBaseCase):
+    async def test_concurrent_requests_share_small_pool(self):
+        domain_names = ['testdomain%d.lan' % i for i in range(200)]
+
+        await asyncio.gather(*[aio.domain.create_domain(d)
+                               for d in domain_names])
+
+        results = await asyncio.gather(*[aio.domain.domain_exists(d)
+                                         for d in domain_names])
+        self.assertTrue(all(results))
+
+        # Every connection went back to the pool of 5
+        pool = aio.db.get_engine().pool
+        self.assertEqual(pool.checkedout(), 0)
+        self.assertLessEqual(pool.checkedin(), 5)
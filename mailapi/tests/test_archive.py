@@ -0,0 +1,156 @@
+import os
+import shutil
+import tarfile
+import tempfile
+from unittest import TestCase
+
+from ..archive import archive_maildir, CHUNK_SIZE
+from ..storage import MaildirStorage, maildir_location
+from ..mailbox import (
+    create_mailbox,
+    delete_mailbox,
+    delete_mailboxes,
+    mailbox_exists,
+)
+from ..domain import create_domain, delete_domain
+from ..exc import NoSuchMailbox
+
+
+class ArchiveBaseCase(TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.archive_dir = os.path.join(self.base_dir, 'archive')
+        self.storage = MaildirStorage()
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def make_maildir(self, path, message_size=10):
+        self.storage.create_maildirs([path])
+        with open(os.path.join(path, 'cur', '1.host:2,S'), 'wb') as f:
+            f.write(b'x' * message_size)
+
+    def archive_members(self, archive):
+        with tarfile.open(archive, 'r:gz') as tar:
+            return dict((i.name, i.size) for i in tar.getmembers())
+
+
+class ArchiveMaildirTests(ArchiveBaseCase):
+    def test_archive_maildir(self):
+        maildir = os.path.join(self.base_dir, 'testuser')
+
+        # Bigger than a chunk so the copy loops
+        self.make_maildir(maildir, message_size=CHUNK_SIZE * 2 + 1)
+
+        destination = os.path.join(self.archive_dir, 'testuser.tar.gz')
+        self.assertEqual(archive_maildir(maildir, destination), destination)
+
+        members = self.archive_members(destination)
+        self.assertIn('testuser/new', members)
+        self.assertEqual(members['testuser/cur/1.host:2,S'],
+                         CHUNK_SIZE * 2 + 1)
+
+        # No partial file is left behind
+        self.assertEqual(os.listdir(self.archive_dir), ['testuser.tar.gz'])
+
+    def test_archive_never_overwrites(self):
+        maildir = os.path.join(self.base_dir, 'testuser')
+        self.make_maildir(maildir)
+        destination = os.path.join(self.archive_dir, 'testuser.tar.gz')
+        archive_maildir(maildir, destination)
+
+        shutil.rmtree(os.path.join(maildir, 'cur'))
+        self.assertRaises(FileExistsError,
+                          archive_maildir, maildir, destination)
+
+        # The first archive is untouched, the partial file is gone
+        self.assertIn('testuser/cur/1.host:2,S',
+                      self.archive_members(destination))
+        self.assertEqual(os.listdir(self.archive_dir), ['testuser.tar.gz'])
+
+    def test_archive_missing_maildir(self):
+        self.assertRaises(FileNotFoundError,
+                          archive_maildir,
+                          os.path.join(self.base_dir, 'nope'),
+                          os.path.join(self.archive_dir, 'nope.tar.gz'))
+        self.assertFalse(os.path.exists(self.archive_dir))
+
+
+class DeleteMailboxArchiveTests(ArchiveBaseCase):
+    def setUp(self):
+        super(DeleteMailboxArchiveTests, self).setUp()
+        self.domain_name = 'testdomain.lan'
+        create_domain(self.domain_name, 'A Test Domain')
+
+    def tearDown(self):
+        delete_domain(self.domain_name)
+        super(DeleteMailboxArchiveTests, self).tearDown()
+
+    def create_mailbox(self, local_part):
+        mailbox = create_mailbox(''.join([local_part, '@', self.domain_name]),
+                                 'Test User',
+                                 'password123',
+                                 storage_base_dir=self.base_dir)
+        self.make_maildir(maildir_location(mailbox))
+        return mailbox
+
+    def test_delete_mailbox_archive_to(self):
+        mailbox = self.create_mailbox('testusr')
+
+        self.assertTrue(delete_mailbox(mailbox.username,
+                                       archive_to=self.archive_dir))
+
+        self.assertFalse(mailbox_exists(mailbox.username))
+        self.assertEqual(len(os.listdir(self.archive_dir)), 1)
+
+    def test_archive_same_mailbox_twice(self):
+        # Within the same second, most likely
+        for _ in range(2):
+            mailbox = self.create_mailbox('testusr')
+            self.assertTrue(delete_mailbox(mailbox.username,
+                                           archive_to=self.archive_dir))
+
+        self.assertEqual(len(os.listdir(self.archive_dir)), 2)
+
+    def test_delete_mailbox_archive_failure_keeps_mailbox(self):
+        mailbox = self.create_mailbox('testusr')
+        shutil.rmtree(maildir_location(mailbox))
+
+        self.assertRaises(FileNotFoundError,
+                          delete_mailbox,
+                          mailbox.username,
+                          archive_to=self.archive_dir)
+
+        # Nothing was deleted since the archive couldn't be written
+        self.assertTrue(mailbox_exists(mailbox.username))
+
+    def test_delete_mailboxes_archive_to(self):
+        mailboxes = [self.create_mailbox('testusr%d' % i) for i in range(4)]
+        addresses = [m.username for m in mailboxes]
+
+        archives = delete_mailboxes(addresses, archive_to=self.archive_dir,
+                                    workers=2)
+
+        self.assertEqual(sorted(archives), sorted(addresses))
+        for address in addresses:
+            self.assertTrue(os.path.isfile(archives[address]))
+            self.assertFalse(mailbox_exists(address))
+
+    def test_delete_mailboxes_partial_failure(self):
+        good = self.create_mailbox('testusr1')
+        bad = self.create_mailbox('testusr2')
+        shutil.rmtree(maildir_location(bad))
+
+        self.assertRaises(FileNotFoundError,
+                          delete_mailboxes,
+                          [good.username, bad.username],
+                          archive_to=self.archive_dir)
+
+        # Only the mailbox that was archived is gone
+        self.assertFalse(mailbox_exists(good.username))
+        self.assertTrue(mailbox_exists(bad.username))
+
+    def test_delete_nonexistant_mailboxes(self):
+        self.assertRaises(NoSuchMailbox,
+                          delete_mailboxes,
+                          ['asdfasdf@' + self.domain_name])
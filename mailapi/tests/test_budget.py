@@ -0,0 +1,209 @@
+import threading
+from datetime import datetime
+from unittest import TestCase
+
+from .. import alias, domain, mailbox, used_quota
+from ..budget import query_budget, statement_shape
+from ..db import get_db_session
+from ..exc import QueryBudgetExceeded
+from ..models import UsedQuota
+
+
+class QueryBudgetTests(TestCase):
+    domain_name = 'budget.lan'
+
+    def setUp(self):
+        self.db_session = get_db_session()
+        self.db_session.rollback()
+
+        for name in ('a', 'b', 'c'):
+            domain.create_domain('%s.%s' % (name, self.domain_name))
+
+    def tearDown(self):
+        self.db_session.rollback()
+
+    def test_within_budget(self):
+        with query_budget(max_statements=1) as budget:
+            domain.get_all_domains()
+
+        self.assertEqual(budget.count, 1)
+        self.assertIn('FROM domain', budget.statements[0])
+
+    def test_over_budget(self):
+        with self.assertRaises(QueryBudgetExceeded) as cm:
+            with query_budget(max_statements=1):
+                domain.get_all_domains()
+                domain.get_all_domains()
+
+        self.assertEqual(cm.exception.problems,
+                         ['2 statements issued, 1 allowed'])
+        self.assertEqual(len(cm.exception.statements), 2)
+
+    def test_n_plus_one(self):
+        with self.assertRaises(QueryBudgetExceeded) as cm:
+            with query_budget(max_repeats=1):
+                for d in domain.get_all_domains():
+                    used_quota.get_domain_sum_used_quota(d.domain)
+
+        self.assertTrue(cm.exception.problems[0].startswith('Issued'))
+
+    def test_errors_pass_through(self):
+        # The block's own exception wins over the budget's
+        with self.assertRaises(ZeroDivisionError):
+            with query_budget(max_statements=0):
+                domain.get_all_domains()
+                1 / 0
+
+    def test_nested(self):
+        with query_budget() as outer:
+            domain.domain_exists(self.domain_name)
+            with query_budget() as inner:
+                domain.domain_exists(self.domain_name)
+
+        self.assertEqual(outer.count, 2)
+        self.assertEqual(inner.count, 1)
+
+    def test_other_threads_not_counted(self):
+        def worker():
+            try:
+                domain.domain_exists(self.domain_name)
+            finally:
+                domain.get_db_session().close()
+
+        with query_budget() as budget:
+            thread = threading.Thread(target=worker)
+            thread.start()
+            thread.join()
+
+        self.assertEqual(budget.count, 0)
+
+    def test_statement_shape(self):
+        self.assertEqual(
+            statement_shape('SELECT a FROM t WHERE a IN (?, ?, ?)'),
+            statement_shape('SELECT a FROM t WHERE a IN (?)'))
+        self.assertEqual(
+            statement_shape('INSERT INTO t (a, b) VALUES (%s, %s), (%s, %s)'),
+            'INSERT INTO t (a, b) VALUES (...)')
+        self.assertNotEqual(statement_shape('SELECT a FROM t WHERE b = ?'),
+                            statement_shape('SELECT a FROM t WHERE c = ?'))
+
+
+class RoundTripTests(TestCase):
+    """ Statements each API function may send, and none of them twice
+
+    Lower a budget when a function gets cheaper; raising one needs a reason.
+    """
+
+    domain_name = 'roundtrips.lan'
+    address = 'user@roundtrips.lan'
+
+    def setUp(self):
+        self.db_session = get_db_session()
+        self.db_session.rollback()
+
+        domain.create_domain(self.domain_name)
+        mailbox.create_mailbox(self.address, 'User', 'pw123456')
+        alias.add_alias('alias@' + self.domain_name, self.address)
+        self.db_session.add(UsedQuota(username=self.address, bytes=10,
+                                      messages=1, domain=self.domain_name))
+        self.db_session.commit()
+
+    def tearDown(self):
+        self.db_session.rollback()
+        self.db_session.query(UsedQuota).filter_by(
+            domain=self.domain_name).delete()
+        if domain.domain_exists(self.domain_name):
+            domain.delete_domain(self.domain_name)
+        self.db_session.commit()
+
+    def assertRoundTrips(self, max_statements, func, *args, **kwargs):
+        max_repeats = kwargs.pop('max_repeats', 1)
+        with query_budget(max_statements, max_repeats):
+            func(*args, **kwargs)
+
+    def test_reads(self):
+        budgets = [
+            (1, domain.get_domain, self.domain_name),
+            (1, domain.domain_exists, self.domain_name),
+            (1, domain.get_all_domains),
+            (2, domain.get_all_mailboxes, self.domain_name),
+            (1, mailbox.mailbox_exists, self.address),
+            (1, mailbox.get_mailbox, self.address),
+            (1, mailbox.get_all_mailboxes),
+            (2, mailbox.search_mailboxes, 'user'),
+            (1, alias.get_aliases, self.address),
+            (1, used_quota.get_sum_used_quota),
+            (2, used_quota.get_domain_sum_used_quota, self.domain_name),
+            (2, used_quota.get_mailbox_sum_used_quota, self.address),
+            (2, used_quota.get_domain_used_quota, self.domain_name),
+            (2, used_quota.get_mailbox_used_quota, self.address),
+            (1, domain.get_domains_changed_since, datetime(2000, 1, 1)),
+            (1, mailbox.get_mailboxes_changed_since, datetime(2000, 1, 1)),
+            (1, alias.get_aliases_changed_since, datetime(2000, 1, 1)),
+        ]
+
+        for budget in budgets:
+            with self.subTest(budget[1].__name__):
+                self.assertRoundTrips(*budget)
+
+    def test_create_domain(self):
+        self.assertRoundTrips(2, domain.create_domain, 'new.' +
+                              self.domain_name)
+
+    def test_create_mailbox(self):
+        # Existence checks, the alias in a savepoint and the mailbox
+        self.assertRoundTrips(6, mailbox.create_mailbox,
+                              'new@' + self.domain_name, 'New', 'pw123456')
+
+    def test_create_mailboxes(self):
+        # However many mailboxes, their aliases and they go in one INSERT each
+        self.assertRoundTrips(5, mailbox.create_mailboxes, [
+            {'email_address': 'new%d@%s' % (i, self.domain_name),
+             'full_name': 'New', 'plain_password': 'pw123456'}
+            for i in range(20)
+        ])
+
+    def test_add_alias(self):
+        self.assertRoundTrips(3, alias.add_alias,
+                              'other@' + self.domain_name, self.address)
+
+    def test_reset_mailbox_password(self):
+        self.assertRoundTrips(2, mailbox.reset_mailbox_password,
+                              self.address, 'pw654321')
+
+    def test_reset_mailbox_used_quota(self):
+        self.assertRoundTrips(3, used_quota.reset_mailbox_used_quota,
+                              self.address)
+
+    def test_deletes(self):
+        budgets = [
+            (1, alias.delete_alias, 'alias@' + self.domain_name,
+             self.address),
+            (2, used_quota.delete_used_quota_mailbox, self.address),
+            (4, mailbox.delete_mailbox, self.address),
+        ]
+
+        for budget in budgets:
+            with self.subTest(budget[1].__name__):
+                self.assertRoundTrips(*budget)
+                self.db_session.rollback()
+
+    def test_delete_mailboxes(self):
+        self.assertRoundTrips(3, mailbox.delete_mailboxes, [self.address])
+
+    def test_rename_domain(self):
+        # Both domains checked, the aliases to repoint and their
+        # executemany, then one UPDATE per table (alias twice)
+        self.assertRoundTrips(9, domain.rename_domain, self.domain_name,
+                              'renamed.lan', max_repeats=2)
+
+    def test_move_mailboxes(self):
+        domain.create_domain('moved.lan')
+        # Three checks, the aliases to repoint and their executemany, one
+        # UPDATE per table
+        self.assertRoundTrips(8, mailbox.move_mailboxes, [self.address],
+                              'moved.lan')
+
+    def test_delete_domain(self):
+        # The check, then the aliases, mailboxes, used quota and the domain
+        self.assertRoundTrips(5, domain.delete_domain, self.domain_name)
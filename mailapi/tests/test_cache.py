@@ -0,0 +1,191 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from .. import cache
+from ..budget import query_budget
+from ..cache import MISSING, Cache, MemoryBackend, SQLiteBackend, set_cache
+from ..db import get_db_session, transaction
+from ..domain import create_domain, delete_domain, domain_exists, get_domain
+from ..mailbox import (create_mailbox, get_mailbox, mailbox_exists,
+                       reset_mailbox_password)
+from ..models import Domain
+
+
+class MemoryBackendTests(TestCase):
+    def test_ttl(self):
+        backend = MemoryBackend()
+        backend.set('a', 1, 60)
+        backend.set('b', None, -1)
+
+        self.assertEqual(backend.get('a'), 1)
+        self.assertIs(backend.get('b'), MISSING)
+        self.assertIs(backend.get('c'), MISSING)
+
+    def test_lru(self):
+        backend = MemoryBackend(max_size=2)
+        backend.set('a', 1, 60)
+        backend.set('b', 2, 60)
+        backend.get('a')
+        backend.set('c', 3, 60)
+
+        self.assertIs(backend.get('b'), MISSING)
+        self.assertEqual(backend.get('a'), 1)
+        self.assertEqual(len(backend), 2)
+
+
+class SQLiteBackendTests(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_shared(self):
+        # Two backends on one file, as two processes would have
+        first = SQLiteBackend(self.path)
+        second = SQLiteBackend(self.path)
+
+        first.set('a', {'domain': 'a.lan'}, 60)
+        self.assertEqual(second.get('a'), {'domain': 'a.lan'})
+
+        second.delete(['a'])
+        self.assertIs(first.get('a'), MISSING)
+
+    def test_ttl(self):
+        backend = SQLiteBackend(self.path)
+        backend.set('a', False, -1)
+
+        self.assertIs(backend.get('a'), MISSING)
+        self.assertEqual(len(backend), 0)
+
+    def test_evict(self):
+        backend = SQLiteBackend(self.path, max_size=2)
+        for i, key in enumerate('abc'):
+            backend.set(key, i, 60)
+            time.sleep(0.01)
+        backend.evict()
+
+        self.assertIs(backend.get('a'), MISSING)
+        self.assertEqual(backend.get('c'), 2)
+
+
+class CachedLookupTests(TestCase):
+    domain_name = 'cache.lan'
+    address = 'user@cache.lan'
+
+    def setUp(self):
+        self.db_session = get_db_session()
+        self.db_session.rollback()
+
+        create_domain(self.domain_name, 'Cached')
+        create_mailbox(self.address, 'User', 'pw123456')
+        self.db_session.commit()
+
+        self.cache = Cache()
+        self.previous = set_cache(self.cache)
+
+    def tearDown(self):
+        set_cache(self.previous)
+
+        self.db_session.rollback()
+        for name in (self.domain_name, 'new.' + self.domain_name):
+            if domain_exists(name):
+                delete_domain(name)
+        self.db_session.commit()
+
+    def test_domain_exists(self):
+        self.assertTrue(domain_exists(self.domain_name))
+        self.db_session.rollback()
+
+        with query_budget(max_statements=0):
+            self.assertTrue(domain_exists(self.domain_name))
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_get_domain(self):
+        get_domain(self.domain_name)
+        self.db_session.close()
+
+        with query_budget(max_statements=0):
+            domain = get_domain(self.domain_name)
+
+        self.assertIsInstance(domain, Domain)
+        self.assertEqual(domain.description, 'Cached')
+        self.assertIn(domain, self.db_session)
+
+    def test_get_mailbox(self):
+        get_mailbox(self.address)
+        self.db_session.close()
+
+        with query_budget(max_statements=0):
+            self.assertEqual(get_mailbox(self.address).name, 'User')
+
+    def test_negative_lookups(self):
+        name = 'new.' + self.domain_name
+        self.assertFalse(domain_exists(name))
+
+        create_domain(name)
+        self.assertTrue(domain_exists(name))
+
+    def test_reset_mailbox_password(self):
+        password = get_mailbox(self.address).password
+        reset_mailbox_password(self.address, 'pw654321')
+        self.db_session.commit()
+        self.db_session.close()
+
+        self.assertNotEqual(get_mailbox(self.address).password, password)
+
+    def test_delete_domain(self):
+        self.assertTrue(mailbox_exists(self.address))
+
+        delete_domain(self.domain_name)
+        self.assertFalse(mailbox_exists(self.address))
+        self.assertFalse(domain_exists(self.domain_name))
+
+    def test_uncommitted_writes_not_cached(self):
+        name = 'new.' + self.domain_name
+        create_domain(name)
+        self.assertTrue(domain_exists(name))
+        self.db_session.rollback()
+
+        self.assertFalse(domain_exists(name))
+
+    def test_dropped_again_on_commit(self):
+        name = 'new.' + self.domain_name
+        with transaction():
+            create_domain(name)
+
+            # Another thread reading the committed state meanwhile
+            self.cache.set(cache._key('domain_exists', name), False)
+
+        self.assertTrue(domain_exists(name))
+
+    def test_keyword_arguments(self):
+        for enabled in (True, False):
+            if not enabled:
+                set_cache(None)
+
+            with self.subTest(enabled=enabled):
+                self.assertTrue(domain_exists(domain_name=self.domain_name))
+                self.assertEqual(
+                    get_domain(domain_name=self.domain_name).description,
+                    'Cached')
+                self.assertTrue(mailbox_exists(email_address=self.address))
+                self.assertEqual(
+                    get_mailbox(email_address=self.address).name, 'User')
+
+        # Cached under the same key as positional calls
+        set_cache(self.cache)
+        with query_budget(max_statements=0):
+            self.assertTrue(domain_exists(self.domain_name))
+
+    def test_disabled(self):
+        set_cache(None)
+        domain_exists(self.domain_name)
+
+        with query_budget() as budget:
+            domain_exists(self.domain_name)
+        self.assertEqual(budget.count, 1)
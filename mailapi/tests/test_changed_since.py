@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import select
+
+from .. import alias, domain, mailbox, testing
+from ..budget import query_budget
+from ..client import MailApi
+from ..schema import alias as alias_table
+from ..schema import domain as domain_table
+from ..schema import mailbox as mailbox_table
+
+
+class ChangedSinceTests(TestCase):
+    def setUp(self):
+        self.conn_str = testing.create_test_db(testing.temp_file_url())
+        testing.seed(self.conn_str, domains=5, mailboxes=300)
+
+        self.client = MailApi(self.conn_str, schema='static')
+        self.since = datetime.now() - timedelta(days=365)
+
+    def tearDown(self):
+        self.client.close()
+
+    def expected(self, table, key):
+        # Seeded dates are days apart, so plenty of them tie
+        with self.client.database.engine.connect() as connection:
+            return [tuple(row) for row in connection.execute(
+                select(table.c.modified, key).
+                where(table.c.modified >= self.since).
+                order_by(table.c.modified, key))]
+
+    def test_streams_in_keyset_order(self):
+        lookups = [
+            (mailbox, mailbox_table, mailbox_table.c.username, 'username'),
+            (domain, domain_table, domain_table.c.domain, 'domain'),
+            (alias, alias_table, alias_table.c.address, 'address'),
+        ]
+
+        with self.client.activate():
+            for module, table, key, attribute in lookups:
+                with self.subTest(module.__name__):
+                    rows = [(row.modified, getattr(row, attribute)) for row in
+                            module.iter_changed_since(self.since,
+                                                      batch_size=7)]
+
+                    self.assertEqual(rows, self.expected(table, key))
+
+    def test_cursor(self):
+        expected = self.expected(mailbox_table, mailbox_table.c.username)
+        self.assertGreater(len(expected), 20)
+
+        with self.client.activate():
+            rows = list(mailbox.iter_changed_since(
+                self.since, cursor=expected[9], batch_size=5))
+
+        self.assertEqual([(m.modified, m.username) for m in rows],
+                         expected[10:])
+
+    def test_one_query_per_page(self):
+        with self.client.activate():
+            with query_budget() as budget:
+                rows = list(mailbox.iter_changed_since(self.since,
+                                                       batch_size=50))
+
+        self.assertEqual(budget.count, len(rows) // 50 + 1)
+
+    def test_writes_bump_modified(self):
+        # Seeded rows may be dated now as well
+        self.client.close()
+        self.client = MailApi(testing.create_test_db(testing.temp_file_url()),
+                              schema='static')
+        start = datetime.now() - timedelta(seconds=1)
+
+        with self.client.transaction():
+            self.client.domain.create_domain('new.lan')
+            self.client.mailbox.create_mailbox('user@new.lan', 'User',
+                                               'pw123456')
+
+        with self.client.activate():
+            self.assertEqual(
+                [d.domain for d in domain.iter_changed_since(start)],
+                ['new.lan'])
+            self.assertEqual(
+                [a.address for a in alias.iter_changed_since(start)],
+                ['user@new.lan'])
+            self.assertEqual(
+                [m.username for m in mailbox.iter_changed_since(start)],
+                ['user@new.lan'])
@@ -0,0 +1,182 @@
+from unittest import TestCase
+
+from .. import changes, testing
+from ..alias import add_alias
+from ..changes import Change, subscribe, unsubscribe
+from ..client import MailApi
+from ..db import get_db_session, transaction
+from ..domain import (create_domain, delete_domain, domain_exists,
+                      rename_domain)
+from ..mailbox import create_mailbox, reset_mailbox_password
+
+
+def ops(changes):
+    return [(c.op, c.entity, c.key) for c in changes]
+
+
+class SubscriberTests(TestCase):
+    domain_name = 'changes.lan'
+
+    def setUp(self):
+        self.db_session = get_db_session()
+        self.db_session.rollback()
+
+        self.published = []
+        subscribe(self.published.append)
+
+    def tearDown(self):
+        unsubscribe(self.published.append)
+
+        self.db_session.rollback()
+        if domain_exists(self.domain_name):
+            delete_domain(self.domain_name)
+        self.db_session.commit()
+
+    def test_published_on_commit(self):
+        address = 'user@' + self.domain_name
+        create_domain(self.domain_name)
+        create_mailbox(address, 'User', 'pw123456')
+        add_alias('alias@' + self.domain_name, address)
+        reset_mailbox_password(address, 'pw654321')
+        self.assertEqual(self.published, [])
+
+        self.db_session.commit()
+
+        self.assertEqual(len(self.published), 1)
+        self.assertEqual(ops(self.published[0]), [
+            ('create', 'domain', self.domain_name),
+            ('create', 'alias', address),
+            ('create', 'mailbox', address),
+            ('create', 'alias', 'alias@' + self.domain_name),
+            ('update', 'mailbox', address),
+        ])
+
+        seqs = [c.seq for c in self.published[0]]
+        self.assertEqual(seqs, sorted(seqs))
+        self.assertEqual(len(set(seqs)), len(seqs))
+
+    def test_bulk_deletes_name_their_rows(self):
+        address = 'user@' + self.domain_name
+        create_domain(self.domain_name)
+        create_mailbox(address, 'User', 'pw123456')
+        self.db_session.commit()
+
+        delete_domain(self.domain_name)
+        self.db_session.commit()
+
+        self.assertEqual(ops(self.published[-1]), [
+            ('delete', 'alias', address),
+            ('delete', 'mailbox', address),
+            ('delete', 'domain', self.domain_name),
+        ])
+        self.assertGreater(self.published[-1][0].seq,
+                           self.published[0][-1].seq)
+
+    def test_rename_names_old_and_new_keys(self):
+        address = 'user@' + self.domain_name
+        create_domain(self.domain_name)
+        create_mailbox(address, 'User', 'pw123456')
+        self.db_session.commit()
+        self.addCleanup(self.delete_domain, 'renamed.lan')
+
+        rename_domain(self.domain_name, 'renamed.lan')
+        self.db_session.commit()
+
+        self.assertEqual(ops(self.published[-1]), [
+            ('delete', 'domain', self.domain_name),
+            ('create', 'domain', 'renamed.lan'),
+            ('delete', 'mailbox', address),
+            ('create', 'mailbox', 'user@renamed.lan'),
+            ('delete', 'alias', address),
+            ('create', 'alias', 'user@renamed.lan'),
+        ])
+
+    def delete_domain(self, domain_name):
+        self.db_session.rollback()
+        if domain_exists(domain_name):
+            delete_domain(domain_name)
+        self.db_session.commit()
+
+    def test_rolled_back(self):
+        create_domain(self.domain_name)
+        self.db_session.rollback()
+        self.db_session.commit()
+
+        self.assertEqual(self.published, [])
+
+    def test_savepoint_rolled_back(self):
+        with transaction():
+            create_domain(self.domain_name)
+            try:
+                with transaction():
+                    add_alias('a@' + self.domain_name, 'b@' + self.domain_name)
+                    raise ValueError
+            except ValueError:
+                pass
+            with transaction():
+                add_alias('c@' + self.domain_name, 'b@' + self.domain_name)
+
+        self.assertEqual(ops(self.published[0]), [
+            ('create', 'domain', self.domain_name),
+            ('create', 'alias', 'c@' + self.domain_name),
+        ])
+
+    def test_failing_subscriber(self):
+        def fail(changes):
+            raise RuntimeError
+
+        subscribe(fail)
+        try:
+            create_domain(self.domain_name)
+            self.db_session.commit()
+        finally:
+            unsubscribe(fail)
+
+        self.assertEqual(len(self.published), 1)
+
+
+class OutboxTests(TestCase):
+    domain_name = 'outbox.lan'
+
+    def setUp(self):
+        self.conn_str = testing.create_test_db(testing.temp_file_url())
+        self.client = MailApi(self.conn_str, schema='static',
+                              change_outbox=True)
+        changes.create_outbox(self.client.database.engine)
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_outbox(self):
+        client = self.client
+        client.domain.create_domain(self.domain_name)
+        client.mailbox.create_mailbox('user@' + self.domain_name, 'User',
+                                      'pw123456')
+        client.get_db_session().commit()
+
+        client.domain.create_domain('rolled.back.lan')
+        client.get_db_session().rollback()
+
+        with client.activate():
+            feed = changes.read_outbox()
+            self.assertEqual(ops(feed), [
+                ('create', 'domain', self.domain_name),
+                ('create', 'alias', 'user@' + self.domain_name),
+                ('create', 'mailbox', 'user@' + self.domain_name),
+            ])
+            self.assertEqual([c.seq for c in feed], [1, 2, 3])
+            self.assertIsInstance(feed[0], Change)
+
+            # Only what came after the checkpoint
+            self.assertEqual(changes.read_outbox(since=2), feed[2:])
+
+            self.assertEqual(changes.prune_outbox(2), 2)
+            get_db_session().commit()
+            self.assertEqual(changes.read_outbox(), feed[2:])
+
+    def test_off_by_default(self):
+        with MailApi(self.conn_str, schema='static') as client:
+            client.domain.create_domain(self.domain_name)
+            client.get_db_session().commit()
+
+            self.assertEqual(client.call(changes.read_outbox), [])
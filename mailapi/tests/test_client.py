@@ -0,0 +1,162 @@
+import asyncio
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine, insert
+
+from . import conn_str
+from ..client import (MailApi, fan_out, fan_out_async, find_mailbox,
+                      quota_summary)
+from ..db import get_db_session
+from ..domain import create_domain, domain_exists, get_all_domains
+from ..exc import NoSuchDomain
+from ..placement import PlacementEngine
+from ..schema import metadata, used_quota
+from ..used_quota import get_domain_used_quota
+
+GB = 1024 ** 3
+
+
+class ClientBaseCase(TestCase):
+    """ One client on the suite's database, another on an empty SQLite one
+    """
+
+    def setUp(self):
+        # Releases whatever the default session may still hold
+        get_db_session().rollback()
+
+        self.tmp_dir = tempfile.mkdtemp()
+        other_conn_str = 'sqlite:///' + os.path.join(self.tmp_dir, 'vmail.db')
+
+        engine = create_engine(other_conn_str)
+        metadata.create_all(engine)
+        engine.dispose()
+
+        self.main = MailApi(conn_str, name='main')
+        self.other = MailApi(other_conn_str, name='other', schema='static')
+
+        self.main.domain.create_domain('main.lan', 'Main')
+        self.main.mailbox.create_mailbox('user@main.lan', 'User', 'pw1234')
+        self.main.get_db_session().commit()
+
+        self.other.domain.create_domain('other.lan', 'Other')
+        self.other.get_db_session().commit()
+
+    def tearDown(self):
+        self.main.domain.delete_domain('main.lan')
+        self.main.get_db_session().commit()
+
+        self.main.close()
+        self.other.close()
+        shutil.rmtree(self.tmp_dir)
+
+
+class MailApiTests(ClientBaseCase):
+    def test_clients_are_independent(self):
+        self.assertTrue(self.main.domain.domain_exists('main.lan'))
+        self.assertFalse(self.main.domain.domain_exists('other.lan'))
+
+        self.assertEqual([d.domain for d in
+                          self.other.domain.get_all_domains()],
+                         ['other.lan'])
+
+    def test_default_database_untouched(self):
+        # The default session never saw the other client's domain
+        self.assertFalse(domain_exists('other.lan'))
+        self.assertIsNot(self.other.get_db_session(), get_db_session())
+
+    def test_activate(self):
+        with self.other.activate():
+            self.assertEqual([d.domain for d in get_all_domains()],
+                             ['other.lan'])
+
+        self.assertFalse(domain_exists('other.lan'))
+
+    def test_transaction(self):
+        with self.other.transaction():
+            self.other.domain.create_domain('other2.lan', 'Other 2')
+
+        # Committed, so a fresh session sees it
+        self.other.remove_db_session()
+        self.assertTrue(self.other.domain.domain_exists('other2.lan'))
+
+    def test_placement_per_database(self):
+        # user@main.lan fills vmail1 of main, other's is empty
+        engine = PlacementEngine({'vmail1': 10 * GB, 'vmail2': 10 * GB},
+                                 max_mailboxes={'vmail1': 1})
+
+        self.assertEqual(self.main.call(engine.assign, [0]), ['vmail2'])
+        self.assertEqual(self.other.call(engine.assign, [0]), ['vmail1'])
+        self.assertEqual(self.main.call(engine.stats)['vmail1'].mailboxes, 1)
+
+    def test_exceptions_pass_through(self):
+        self.assertIs(self.main.domain.NoSuchDomain, NoSuchDomain)
+
+
+class FanOutTests(ClientBaseCase):
+    def test_fan_out(self):
+        results = fan_out([self.main, self.other], domain_exists, 'main.lan')
+
+        self.assertEqual(results, {'main': True, 'other': False})
+
+    def test_fan_out_errors(self):
+        clients = [self.main, self.other]
+        self.assertRaises(NoSuchDomain, fan_out, clients,
+                          get_domain_used_quota, 'main.lan')
+
+        results = fan_out(clients, get_domain_used_quota, 'main.lan',
+                          return_exceptions=True)
+        self.assertEqual(results['main'], [])
+        self.assertIsInstance(results['other'], NoSuchDomain)
+
+    def test_fan_out_commit(self):
+        fan_out([self.other], create_domain, 'committed.lan', commit=True)
+        fan_out([self.other], create_domain, 'rolled-back.lan')
+
+        self.assertTrue(self.other.domain.domain_exists('committed.lan'))
+        self.assertFalse(self.other.domain.domain_exists('rolled-back.lan'))
+
+    def test_fan_out_commit_returns_loaded_objects(self):
+        results = fan_out([self.other], create_domain, 'committed.lan',
+                          'Committed', commit=True)
+
+        self.assertEqual(results['other'].description, 'Committed')
+
+    def test_duplicate_names(self):
+        twin = MailApi(conn_str, name='other')
+        self.addCleanup(twin.close)
+
+        self.assertRaises(ValueError, fan_out, [self.other, twin],
+                          domain_exists, 'other.lan')
+        self.assertRaises(ValueError, asyncio.run, fan_out_async(
+            [self.other, twin], domain_exists, 'other.lan'))
+
+    def test_fan_out_async(self):
+        results = asyncio.run(fan_out_async([self.main, self.other],
+                                            domain_exists, 'other.lan'))
+
+        self.assertEqual(results, {'main': False, 'other': True})
+
+    def test_find_mailbox(self):
+        found = find_mailbox([self.main, self.other], 'user@main.lan')
+
+        self.assertEqual(list(found), ['main'])
+        self.assertEqual(found['main'].username, 'user@main.lan')
+
+    def test_quota_summary(self):
+        with self.other.database.engine.begin() as connection:
+            connection.execute(insert(used_quota), [
+                {'username': 'a@other.lan', 'bytes': 100, 'messages': 2,
+                 'domain': 'other.lan'},
+                {'username': 'b@other.lan', 'bytes': 50, 'messages': 1,
+                 'domain': 'other.lan'},
+            ])
+
+        summary = quota_summary([self.main, self.other])
+
+        self.assertEqual(summary['clusters']['other'],
+                         {'bytes': 150, 'messages': 3})
+        self.assertEqual(summary['bytes'],
+                         150 + summary['clusters']['main']['bytes'])
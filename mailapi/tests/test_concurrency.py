@@ -0,0 +1,73 @@
+import threading
+from unittest import TestCase
+
+from ..db import get_db_session, remove_db_session
+from ..domain import create_domain, delete_domain, domain_exists
+from ..mailbox import create_mailbox, get_mailbox, reset_mailbox_password
+
+
+class ScopedSessionTests(TestCase):
+    def test_session_per_thread(self):
+        sessions = []
+
+        def worker():
+            sessions.append(get_db_session())
+            remove_db_session()
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+
+        # Same session within a thread, a different one in another thread
+        self.assertIs(get_db_session(), get_db_session())
+        self.assertIsNot(sessions[0], get_db_session())
+
+
+class ConcurrentProvisioningStressTest(TestCase):
+    """ Many threads provisioning at once must not see each other's unit of
+    work.  Every thread rolls back what it did so the database is left as is.
+    """
+
+    threads = 16
+    iterations = 10
+
+    def setUp(self):
+        # Releases whatever the main thread's session may still hold
+        get_db_session().rollback()
+
+    def worker(self, n, errors, barrier):
+        try:
+            barrier.wait()
+            for i in range(self.iterations):
+                domain_name = 'stress%d-%d.lan' % (n, i)
+                email_address = 'testusr@' + domain_name
+
+                create_domain(domain_name, 'Stress Test Domain')
+                create_mailbox(email_address, 'Test User', 'password123')
+                reset_mailbox_password(email_address, 'password90125')
+
+                mailbox = get_mailbox(email_address)
+                assert mailbox.domain == domain_name, mailbox.domain
+                assert delete_domain(domain_name)
+
+                # Ends the unit of work without keeping anything
+                get_db_session().rollback()
+                assert not domain_exists(domain_name)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            remove_db_session()
+
+    def test_concurrent_provisioning(self):
+        errors = []
+        barrier = threading.Barrier(self.threads)
+        workers = [threading.Thread(target=self.worker,
+                                    args=(n, errors, barrier))
+                   for n in range(self.threads)]
+
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
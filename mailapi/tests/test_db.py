@@ -0,0 +1,42 @@
+from unittest import TestCase
+
+from . import conn_str
+from ..db import (init_db, get_database, get_db_session, get_engine,
+                  pool_stats)
+from ..domain import get_all_domains
+
+
+class PoolOptionsTests(TestCase):
+    def tearDown(self):
+        # Back to the engine the rest of the suite uses, closing the test's
+        # pooled connections first
+        get_database().dispose()
+        init_db(conn_str)
+
+    def test_pool_options(self):
+        init_db(conn_str, pool_size=3, max_overflow=2, pool_recycle=3600,
+                pool_pre_ping=True, pool_timeout=5)
+
+        pool = get_engine().pool
+        self.assertEqual(pool._recycle, 3600)
+        self.assertTrue(pool._pre_ping)
+        if pool_stats()['size'] is not None:
+            self.assertEqual(pool_stats()['size'], 3)
+
+
+class PoolStatsTests(TestCase):
+    def test_pool_stats(self):
+        # Makes sure the session holds a connection
+        get_all_domains()
+        stats = pool_stats()
+
+        self.assertGreaterEqual(stats['wait_count'], 1)
+        self.assertGreaterEqual(stats['wait_time_max'], stats['wait_time_avg'])
+        if stats['checked_out'] is not None:
+            self.assertGreaterEqual(stats['checked_out'], 1)
+
+        # Hands the connection back
+        get_db_session().rollback()
+        if stats['checked_out'] is not None:
+            self.assertEqual(pool_stats()['checked_out'],
+                             stats['checked_out'] - 1)
@@ -1,6 +1,11 @@
 from unittest import TestCase
 
-from ..models import Domain
+from sqlalchemy import func, select
+
+from .. import testing
+from ..client import MailApi
+from ..db import transaction
+from ..models import Alias, Domain, Mailbox, UsedQuota
 from ..domain import (
     create_domain,
     delete_domain,
@@ -10,8 +15,11 @@ from ..domain import (
     delete_mailboxes,
     delete_aliases,
     get_all_mailboxes,
+    purge_domain,
+    rename_domain,
 )
-from ..mailbox import create_mailbox
+from ..alias import add_alias, get_aliases
+from ..mailbox import create_mailbox, get_mailbox
 from ..exc import DomainExists, NoSuchDomain
 
 
@@ -216,3 +224,130 @@ class GetAllMailboxesTests(TestCase):
     def test_get_all_mailboxes_for_nonexistant_domain(self):
         # Should raise a NoSuchDomain error
         self.assertRaises(NoSuchDomain, get_all_mailboxes, 'asdfkljahsdfkja')
+
+
+class SeededDomainCase(TestCase):
+    def setUp(self):
+        self.client = MailApi(testing.create_test_db(testing.temp_file_url()),
+                              schema='static')
+        testing.seed(self.client.database.engine, domains=2, mailboxes=40)
+        self.activation = self.client.activate()
+        self.activation.__enter__()
+
+        self.domain_name, self.other_name = sorted(
+            d.domain for d in get_all_domains())
+        self.rows = self.count_rows(self.domain_name)
+        self.other_rows = self.count_rows(self.other_name)
+
+    def tearDown(self):
+        self.activation.__exit__(None, None, None)
+        self.client.close()
+
+    def count_rows(self, domain_name):
+        db_session = self.client.get_db_session()
+        return dict(
+            (name, db_session.execute(
+                select(func.count()).select_from(model).
+                where(model.domain == domain_name)).scalar())
+            for name, model in [('alias', Alias), ('mailbox', Mailbox),
+                                ('used_quota', UsedQuota),
+                                ('domain', Domain)])
+
+
+class PurgeDomainTests(SeededDomainCase):
+    def test_purge_domain(self):
+        calls = []
+        counts = purge_domain(self.domain_name, chunk_size=7,
+                              progress=lambda *args: calls.append(args))
+
+        self.assertEqual(counts, self.rows)
+        self.assertFalse(domain_exists(self.domain_name))
+        self.assertEqual(set(self.count_rows(self.domain_name).values()),
+                         {0})
+        self.assertEqual(self.count_rows(self.other_name), self.other_rows)
+
+        # One call per chunk, with the running total of the table
+        mailbox_calls = [n for table, n in calls if table == 'mailbox']
+        self.assertEqual(mailbox_calls[:2], [7, 14])
+        self.assertEqual(mailbox_calls[-1], self.rows['mailbox'])
+        self.assertEqual(calls[-1], ('domain', 1))
+
+    def test_resume(self):
+        def interrupt(table, num_deleted):
+            if table == 'mailbox':
+                raise KeyboardInterrupt()
+
+        self.assertRaises(KeyboardInterrupt, purge_domain, self.domain_name,
+                          chunk_size=5, progress=interrupt)
+
+        # The chunks so far are committed and the domain deactivated
+        self.client.get_db_session().rollback()
+        left = self.count_rows(self.domain_name)
+        self.assertEqual(left['alias'], 0)
+        self.assertEqual(left['mailbox'], self.rows['mailbox'] - 5)
+        self.assertEqual(get_domain(self.domain_name).active, 0)
+
+        counts = purge_domain(self.domain_name)
+        self.assertEqual(counts['mailbox'], self.rows['mailbox'] - 5)
+        self.assertEqual(set(self.count_rows(self.domain_name).values()),
+                         {0})
+
+    def test_inside_transaction(self):
+        with transaction():
+            self.assertRaises(RuntimeError, purge_domain, self.domain_name)
+        self.assertRaises(NoSuchDomain, purge_domain, 'nosuchdomain.lan')
+
+    def test_delete_domain(self):
+        self.assertTrue(delete_domain(self.domain_name))
+        self.assertEqual(set(self.count_rows(self.domain_name).values()),
+                         {0})
+        self.assertEqual(self.count_rows(self.other_name), self.other_rows)
+
+
+class RenameDomainTests(SeededDomainCase):
+    new_name = 'renamed.lan'
+
+    def test_rename_domain(self):
+        mailbox = get_all_mailboxes(self.domain_name)[0]
+        username, password = mailbox.username, mailbox.password
+        created, maildir = mailbox.created, mailbox.maildir
+        new_username = username.split('@')[0] + '@' + self.new_name
+        add_alias('fwd@' + self.other_name, username)
+
+        self.assertTrue(rename_domain(self.domain_name, self.new_name))
+
+        # add_alias filed fwd@ under the domain of its destination
+        self.assertFalse(domain_exists(self.domain_name))
+        self.assertEqual(self.count_rows(self.new_name),
+                         dict(self.rows, alias=self.rows['alias'] + 1))
+        self.assertEqual(set(self.count_rows(self.domain_name).values()),
+                         {0})
+
+        mailbox = get_mailbox(new_username)
+        self.assertEqual((mailbox.password, mailbox.created),
+                         (password, created))
+        self.assertEqual(mailbox.maildir, maildir.replace(
+            self.domain_name + '/', self.new_name + '/', 1))
+        self.assertIn('fwd@' + self.other_name,
+                      [a.address for a in get_aliases(new_username)])
+        self.assertEqual(get_aliases(username), [])
+
+    def test_mixed_case_alias(self):
+        username = get_all_mailboxes(self.domain_name)[0].username
+        add_alias('Sales@' + self.domain_name.upper(), username)
+
+        self.assertTrue(rename_domain(self.domain_name, self.new_name))
+
+        new_username = username.split('@')[0] + '@' + self.new_name
+        addresses = [a.address for a in get_aliases(new_username)]
+        self.assertIn('Sales@' + self.new_name, addresses)
+        self.assertEqual(set(self.count_rows(self.domain_name).values()),
+                         {0})
+
+    def test_errors(self):
+        self.assertRaises(NoSuchDomain, rename_domain, 'nosuchdomain.lan',
+                          self.new_name)
+        self.assertRaises(DomainExists, rename_domain, self.domain_name,
+                          self.other_name)
+        self.assertRaises(ValueError, rename_domain, self.domain_name,
+                          'notadomain')
@@ -0,0 +1,63 @@
+import os
+import subprocess
+import sys
+from unittest import TestCase
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+
+# Upper bound on the cumulative time of a cold `import mailapi`, in
+# microseconds.  Loading SQLAlchemy's ORM alone takes several times this.
+IMPORT_BUDGET_US = 50000
+
+
+def run_python(code, *options):
+    """ Runs @code in a fresh interpreter, returns (stdout, stderr) """
+    process = subprocess.run([sys.executable] + list(options) + ['-c', code],
+                             cwd=ROOT, capture_output=True, text=True,
+                             check=True)
+    return process.stdout, process.stderr
+
+
+class LazyImportTests(TestCase):
+    def test_import_skips_sqlalchemy(self):
+        stdout, _ = run_python(
+            'import sys, mailapi, mailapi.validators, mailapi.maildir\n'
+            'print("sqlalchemy" in sys.modules)')
+
+        self.assertEqual(stdout.strip(), 'False')
+
+    def test_import_time(self):
+        _, stderr = run_python('import mailapi', '-X', 'importtime')
+
+        # Lines look like "import time:  self [us] | cumulative | name"
+        cumulative = None
+        for line in stderr.splitlines():
+            fields = [f.strip() for f in line.split('|')]
+            if len(fields) == 3 and fields[2] == 'mailapi':
+                cumulative = int(fields[1])
+
+        self.assertIsNotNone(cumulative)
+        self.assertLess(cumulative, IMPORT_BUDGET_US)
+
+    def test_public_api_loads_on_access(self):
+        stdout, _ = run_python(
+            'import mailapi\n'
+            'print(mailapi.domain.__name__, mailapi.init_db.__module__,\n'
+            '      mailapi.transaction.__name__, "alias" in dir(mailapi))')
+
+        self.assertEqual(stdout.split(),
+                         ['mailapi.domain', 'mailapi.db', 'transaction',
+                          'True'])
+
+    def test_aio_loads_on_access(self):
+        stdout, _ = run_python(
+            'import mailapi\n'
+            'print(mailapi.aio.__name__, "aio" in dir(mailapi))')
+
+        self.assertEqual(stdout.split(), ['mailapi.aio', 'True'])
+
+    def test_unknown_attribute(self):
+        import mailapi
+
+        self.assertRaises(AttributeError, getattr, mailapi, 'nope')
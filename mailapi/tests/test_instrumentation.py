@@ -0,0 +1,96 @@
+from unittest import TestCase
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .. import instrumentation
+from ..db import get_db_session
+from ..domain import create_domain, get_all_domains
+from ..exc import NoSuchDomain
+from ..mailbox import create_mailbox
+from ..used_quota import get_domain_used_quota
+
+
+class InstrumentationTests(TestCase):
+    domain_name = 'instrumentation.lan'
+
+    def setUp(self):
+        self.db_session = get_db_session()
+        self.db_session.rollback()
+
+        self.calls = []
+        instrumentation.reset()
+        instrumentation.enable(callback=self.calls.append)
+
+    def tearDown(self):
+        instrumentation.disable()
+        instrumentation.reset()
+        self.db_session.rollback()
+
+    def test_outermost_call_only(self):
+        create_domain(self.domain_name)
+        create_mailbox('user@' + self.domain_name, 'User', 'pw123456')
+
+        # domain_exists & co. called by them aren't recorded on their own
+        self.assertEqual([call.name for call in self.calls],
+                         ['mailapi.domain.create_domain',
+                          'mailapi.mailbox.create_mailbox'])
+
+        call = self.calls[1]
+        self.assertGreaterEqual(call.statements, 3)
+        self.assertEqual(call.rows_written, 2)  # the mailbox and its alias
+        self.assertGreater(call.wall_time, 0)
+        self.assertGreater(call.db_time, 0)
+        self.assertLessEqual(call.db_time, call.wall_time)
+        self.assertIsNone(call.error)
+
+    def test_rows(self):
+        create_domain(self.domain_name)
+        domains = get_all_domains()
+
+        self.assertEqual(self.calls[-1].rows, len(domains))
+        self.assertEqual(self.calls[-1].statements, 1)
+
+    def test_error(self):
+        self.assertRaises(NoSuchDomain, get_domain_used_quota, 'nope.lan')
+
+        self.assertIsInstance(self.calls[0].error, NoSuchDomain)
+
+    def test_stats(self):
+        for _ in range(3):
+            get_all_domains()
+
+        stats = instrumentation.stats()['mailapi.domain.get_all_domains']
+        self.assertEqual(stats['calls'], 3)
+        self.assertEqual(stats['statements']['p99'], 1)
+        self.assertLessEqual(stats['wall_time']['p50'],
+                             stats['wall_time']['max'])
+
+    def test_disabled(self):
+        instrumentation.disable()
+        get_all_domains()
+
+        self.assertEqual(self.calls, [])
+        self.assertFalse(event.contains(
+            Engine, 'before_cursor_execute',
+            instrumentation._before_cursor_execute))
+
+
+class HistogramTests(TestCase):
+    def test_percentiles(self):
+        histogram = instrumentation.Histogram()
+        for value in range(1, 101):
+            histogram.record(value / 1000.0)
+
+        # Within a bucket (~19%) of the exact value
+        self.assertAlmostEqual(histogram.percentile(50), 0.050, delta=0.01)
+        self.assertAlmostEqual(histogram.percentile(95), 0.095, delta=0.019)
+        self.assertEqual(histogram.percentile(100), 0.1)
+        self.assertEqual(histogram.summary()['count'], 100)
+
+    def test_zero_and_empty(self):
+        histogram = instrumentation.Histogram()
+        self.assertIsNone(histogram.percentile(50))
+
+        histogram.record(0)
+        self.assertEqual(histogram.percentile(99), 0)
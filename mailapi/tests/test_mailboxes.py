@@ -3,16 +3,20 @@ from datetime import datetime
 
 from ..mailbox import (
     create_mailbox,
+    create_mailboxes,
+    generate_unique_maildir_paths,
     delete_mailbox,
     mailbox_exists,
     get_all_mailboxes,
     get_mailbox,
+    move_mailboxes,
     reset_mailbox_password,
     search_mailboxes,
 )
-from ..alias import get_aliases
+from ..alias import add_alias, get_aliases
+from ..db import get_db_session
 from ..domain import create_domain, delete_domain
-from ..models import Mailbox
+from ..models import Mailbox, UsedQuota
 from ..exc import NoSuchMailbox, MailboxExists, NoSuchDomain
 
 
@@ -85,6 +89,76 @@ class CreateMailboxTests(MailboxBaseCase):
         self.assertTrue(delete_mailbox(email_address))
 
 
+class CreateMailboxesTests(MailboxBaseCase):
+    def records(self, *local_parts):
+        return [{'email_address': ''.join([i, '@', self.domain_name]),
+                 'full_name': 'Test User',
+                 'plain_password': 'password123'} for i in local_parts]
+
+    def test_create_mailboxes(self):
+        mailboxes = create_mailboxes(self.records('testusr1', 'testusr2'))
+
+        # We get a Mailbox object per record...
+        self.assertEqual(len(mailboxes), 2)
+        for mailbox in mailboxes:
+            self.assertIsInstance(mailbox, Mailbox)
+
+            # ...each with its self-referrential alias
+            self.assertEqual(len(get_aliases(mailbox.username)), 1)
+
+    def test_create_mailboxes_that_exist(self):
+        create_mailbox(''.join(['testusr1', '@', self.domain_name]),
+                       'Test User',
+                       'password123')
+
+        self.assertRaises(MailboxExists,
+                          create_mailboxes,
+                          self.records('testusr2', 'testusr1'))
+
+    def test_create_duplicate_mailboxes(self):
+        self.assertRaises(MailboxExists,
+                          create_mailboxes,
+                          self.records('testusr1', 'testusr1'))
+
+    def test_create_mailboxes_for_domain_that_doesnt_exist(self):
+        records = self.records('testusr1')
+        records[0]['email_address'] = 'test@fakedomain.tld'
+
+        self.assertRaises(NoSuchDomain, create_mailboxes, records)
+
+
+class GenerateUniqueMaildirPathsTests(MailboxBaseCase):
+    def test_unique_against_database(self):
+        email_address = ''.join(['testusr', '@', self.domain_name])
+        mailbox = create_mailbox(email_address, 'Test User', 'password123')
+
+        # Pretend the existing mailbox got the path we're about to generate
+        mailbox.maildir = generate_unique_maildir_paths(
+            [email_address], append_timestamp=False)[0]
+
+        path, = generate_unique_maildir_paths([email_address],
+                                              append_timestamp=False)
+
+        self.assertNotEqual(path, mailbox.maildir)
+        self.assertTrue(path.startswith(mailbox.maildir[:-1]))
+
+        # cleanup
+        self.assertTrue(delete_mailbox(email_address))
+
+    def test_unique_timestamped_against_database(self):
+        email_address = ''.join(['testusr', '@', self.domain_name])
+        mailbox = create_mailbox(email_address, 'Test User', 'password123')
+
+        mailbox.maildir = generate_unique_maildir_paths([email_address])[0]
+
+        # Either a second went by or the path got a counter
+        path, = generate_unique_maildir_paths([email_address])
+        self.assertNotEqual(path, mailbox.maildir)
+
+        # cleanup
+        self.assertTrue(delete_mailbox(email_address))
+
+
 class MailboxExistsTests(MailboxBaseCase):
     def test_mailbox_exists(self):
         email_address = ''.join(['testusr', '@', self.domain_name])
@@ -285,3 +359,57 @@ class MailboxSearchTest(MailboxBaseCase):
 
         # cleanup
         self.assertTrue(delete_mailbox(email_address))
+
+
+class MoveMailboxesTests(MailboxBaseCase):
+    other_name = 'other.lan'
+
+    def setUp(self):
+        super(MoveMailboxesTests, self).setUp()
+        create_domain(self.other_name)
+        self.address = 'moved@' + self.domain_name
+        self.new_address = 'moved@' + self.other_name
+        self.mailbox = create_mailbox(self.address, 'Moved', 'password123')
+        create_mailbox('stays@' + self.domain_name, 'Stays', 'password123')
+        add_alias('fwd@' + self.domain_name, self.address)
+        get_db_session().add(UsedQuota(username=self.address, bytes=10,
+                                       messages=1, domain=self.domain_name))
+
+    def tearDown(self):
+        delete_domain(self.other_name)
+        super(MoveMailboxesTests, self).tearDown()
+
+    def test_move_mailboxes(self):
+        password, maildir = self.mailbox.password, self.mailbox.maildir
+
+        self.assertEqual(move_mailboxes([self.address], self.other_name),
+                         {self.address: self.new_address})
+
+        self.assertFalse(mailbox_exists(self.address))
+        self.assertTrue(mailbox_exists('stays@' + self.domain_name))
+        mailbox = get_mailbox(self.new_address)
+        self.assertEqual((mailbox.domain, mailbox.password),
+                         (self.other_name, password))
+        self.assertEqual(mailbox.maildir, maildir.replace(
+            self.domain_name + '/', self.other_name + '/', 1))
+        self.assertEqual(
+            sorted(a.address for a in get_aliases(self.new_address)),
+            ['fwd@' + self.domain_name, self.new_address])
+        self.assertEqual(
+            get_db_session().query(UsedQuota).
+            filter_by(domain=self.other_name).one().username,
+            self.new_address)
+
+        # Already there
+        self.assertEqual(move_mailboxes([self.new_address], self.other_name),
+                         {})
+
+    def test_errors(self):
+        self.assertRaises(NoSuchDomain, move_mailboxes, [self.address],
+                          'nosuchdomain.lan')
+        self.assertRaises(NoSuchMailbox, move_mailboxes,
+                          ['nobody@' + self.domain_name], self.other_name)
+
+        create_mailbox(self.new_address, 'Taken', 'password123')
+        self.assertRaises(MailboxExists, move_mailboxes, [self.address],
+                          self.other_name)
@@ -0,0 +1,71 @@
+from unittest import TestCase
+
+from ..maildir import (
+    generate_maildir_path,
+    generate_maildir_paths,
+    generate_unused_maildir_paths,
+    dedupe_maildir_paths,
+)
+
+
+class GenerateMaildirPathsTests(TestCase):
+    def test_same_layout_as_single_path(self):
+        address = 'testuser@testdomain.lan'
+
+        path, = generate_maildir_paths([address], append_timestamp=False)
+
+        self.assertEqual(path, generate_maildir_path(address,
+                                                     append_timestamp=False))
+        self.assertEqual(path, 'testdomain.lan/t/e/s/testuser/')
+
+    def test_unique_within_batch(self):
+        addresses = ['TestUser@testdomain.lan', 'testuser@testdomain.lan',
+                     'testuser@testdomain.lan']
+
+        paths = generate_maildir_paths(addresses, append_timestamp=False)
+
+        self.assertEqual(paths, ['testdomain.lan/t/e/s/testuser/',
+                                 'testdomain.lan/t/e/s/testuser-2/',
+                                 'testdomain.lan/t/e/s/testuser-3/'])
+
+    def test_unique_against_existing(self):
+        existing = {'testdomain.lan/t/e/s/testuser/',
+                    'testdomain.lan/t/e/s/testuser-2/'}
+
+        paths = generate_maildir_paths(['testuser@testdomain.lan'],
+                                       append_timestamp=False,
+                                       existing=existing)
+
+        self.assertEqual(paths, ['testdomain.lan/t/e/s/testuser-3/'])
+
+    def test_unused_asks_for_exact_paths(self):
+        existing = {'testdomain.lan/t/e/s/testuser/',
+                    'testdomain.lan/t/e/s/testuser-2/'}
+        asked = []
+
+        def in_use(paths):
+            asked.append(paths)
+            return existing.intersection(paths)
+
+        paths = generate_unused_maildir_paths(['testuser@testdomain.lan'],
+                                              in_use, append_timestamp=False)
+
+        self.assertEqual(paths, ['testdomain.lan/t/e/s/testuser-3/'])
+        self.assertEqual(asked, [['testdomain.lan/t/e/s/testuser/'],
+                                 ['testdomain.lan/t/e/s/testuser-2/'],
+                                 ['testdomain.lan/t/e/s/testuser-3/']])
+
+    def test_timestamped_paths_are_unique(self):
+        # All in the same second, most likely
+        paths = generate_maildir_paths(['testuser@testdomain.lan'] * 3)
+
+        self.assertEqual(len(set(paths)), 3)
+
+    def test_invalid_email(self):
+        self.assertRaises(ValueError,
+                          generate_maildir_paths,
+                          ['testuser@testdomain.lan', 'not an address'])
+
+    def test_dedupe_keeps_order(self):
+        self.assertEqual(dedupe_maildir_paths(['b/', 'a/', 'b/']),
+                         ['b/', 'a/', 'b-2/'])
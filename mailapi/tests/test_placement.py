@@ -0,0 +1,125 @@
+from unittest import TestCase
+
+from ..placement import PlacementEngine, set_placement_engine
+from ..mailbox import create_mailbox, create_mailboxes
+from ..domain import create_domain, delete_domain
+from ..storage import set_storage_backend
+
+GB = 1024 ** 3
+
+
+class FailingStorage(object):
+    def provision(self, mailboxes):
+        raise OSError('No space left on device')
+
+
+class PlacementEngineTests(TestCase):
+    def setUp(self):
+        self.domain_name = 'testdomain.lan'
+        create_domain(self.domain_name, 'A Test Domain')
+
+    def tearDown(self):
+        set_placement_engine(None)
+        delete_domain(self.domain_name)
+
+    def test_assign_by_capacity(self):
+        engine = PlacementEngine({'testnode1': 1 * GB, 'testnode2': 3 * GB},
+                                 mailbox_bytes=1024 * 1024)
+
+        assigned = engine.assign([0] * 400)
+
+        # The bigger node gets three times as many mailboxes
+        self.assertEqual(assigned.count('testnode1'), 100)
+        self.assertEqual(assigned.count('testnode2'), 300)
+
+    def test_assign_skips_full_nodes(self):
+        engine = PlacementEngine({'testnode1': 10 * GB, 'testnode2': 10 * GB},
+                                 max_mailboxes={'testnode1': 0})
+
+        self.assertEqual(set(engine.assign([0] * 10)), {'testnode2'})
+
+    def test_all_nodes_full(self):
+        engine = PlacementEngine({'testnode1': 10 * GB},
+                                 max_mailboxes={'testnode1': 1})
+
+        self.assertRaises(RuntimeError, engine.assign, [0, 0])
+
+        # Nothing was accounted for
+        self.assertEqual(engine.stats()['testnode1'].mailboxes, 0)
+
+    def test_assign_publishes_copies(self):
+        engine = PlacementEngine({'testnode1': 10 * GB})
+        stats = engine.stats()
+
+        engine.assign([0, 0])
+
+        self.assertEqual(stats['testnode1'].mailboxes, 0)
+        self.assertEqual(engine.stats()['testnode1'].mailboxes, 2)
+
+    def test_release(self):
+        engine = PlacementEngine({'testnode1': 10 * GB},
+                                 mailbox_bytes=1024 * 1024)
+
+        nodes = engine.assign([0, 10])
+        engine.release(nodes, [0, 10])
+
+        stats = engine.stats()['testnode1']
+        self.assertEqual((stats.mailboxes, stats.used_bytes), (0, 0))
+
+    def test_failed_create_releases_node(self):
+        engine = PlacementEngine({'testnode1': 1 * GB})
+        set_placement_engine(engine)
+        set_storage_backend(FailingStorage())
+
+        try:
+            self.assertRaises(OSError, create_mailbox,
+                              'testusr1@' + self.domain_name,
+                              'Test User', 'password123')
+            self.assertRaises(OSError, create_mailboxes, [
+                {'email_address': 'testusr%d@%s' % (i, self.domain_name),
+                 'full_name': 'Test User',
+                 'plain_password': 'password123'} for i in range(2, 4)
+            ])
+        finally:
+            set_storage_backend(None)
+
+        self.assertEqual(engine.stats()['testnode1'].mailboxes, 0)
+
+    def test_stats_count_existing_mailboxes(self):
+        engine = PlacementEngine({'testnode1': 10 * GB})
+        create_mailbox('testusr@' + self.domain_name,
+                       'Test User',
+                       'password123',
+                       storage_node='testnode1')
+
+        self.assertEqual(engine.refresh()['testnode1'].mailboxes, 1)
+
+    def test_create_mailbox_uses_placement_engine(self):
+        set_placement_engine(PlacementEngine({'testnode1': 1 * GB}))
+
+        mailbox = create_mailbox('testusr@' + self.domain_name,
+                                 'Test User',
+                                 'password123')
+
+        self.assertEqual(mailbox.storagenode, 'testnode1')
+
+    def test_create_mailboxes_spread_over_nodes(self):
+        set_placement_engine(PlacementEngine(
+            {'testnode1': 1 * GB, 'testnode2': 1 * GB}, mailbox_bytes=1))
+
+        mailboxes = create_mailboxes([
+            {'email_address': 'testusr%d@%s' % (i, self.domain_name),
+             'full_name': 'Test User',
+             'plain_password': 'password123'} for i in range(4)
+        ] + [
+            # Explicit storage nodes are left alone
+            {'email_address': 'testusr4@' + self.domain_name,
+             'full_name': 'Test User',
+             'plain_password': 'password123',
+             'storage_node': 'vmail9'},
+        ])
+
+        nodes = [m.storagenode for m in mailboxes]
+        self.assertEqual(nodes.count('testnode1'), 2)
+        self.assertEqual(nodes.count('testnode2'), 2)
+        self.assertEqual(nodes[-1], 'vmail9')
@@ -0,0 +1,177 @@
+import io
+from unittest import TestCase
+
+from sqlalchemy.exc import IntegrityError
+
+from .. import testing
+from ..budget import query_budget
+from ..client import MailApi
+from ..reconciler import plan, reconcile
+
+
+def desired():
+    return {
+        'one.lan': {
+            'description': 'One',
+            'mailboxes': {
+                'jdoe@one.lan': {'name': 'John Doe', 'quota': 1024,
+                                 'password': 'pw123456'},
+                'jane@one.lan': {'name': 'Jane', 'password': 'pw123456',
+                                 'active': False},
+            },
+            'aliases': {
+                'info@one.lan': ['jdoe@one.lan', 'jane@one.lan'],
+                'sales@one.lan': 'jane@one.lan',
+            },
+        },
+        'two.lan': {
+            'mailboxes': {
+                'admin@two.lan': {'name': 'Admin', 'password': 'pw123456'},
+            },
+        },
+    }
+
+
+class ReconcileTests(TestCase):
+    def setUp(self):
+        self.client = MailApi(testing.create_test_db(testing.temp_file_url()),
+                              schema='static')
+        self.activation = self.client.activate()
+        self.activation.__enter__()
+
+    def tearDown(self):
+        self.activation.__exit__(None, None, None)
+        self.client.close()
+
+    def test_dry_run(self):
+        out = io.StringIO()
+        result = reconcile(desired(), out=out)
+
+        self.assertEqual(result.summary(), {
+            'create domain': 2, 'create mailbox': 3, 'create alias': 2})
+        self.assertIn('+ mailbox jdoe@one.lan', out.getvalue())
+        self.assertNotIn('pw123456', out.getvalue())
+        self.assertFalse(self.client.domain.domain_exists('one.lan'))
+
+    def test_apply(self):
+        reconcile(desired(), dry_run=False)
+
+        mailbox = self.client.mailbox.get_mailbox('jdoe@one.lan')
+        self.assertEqual((mailbox.name, mailbox.quota), ('John Doe', 1024))
+        self.assertEqual(self.client.mailbox.get_mailbox('jane@one.lan').
+                         active, 0)
+        self.assertEqual(self.client.domain.get_domain('one.lan').description,
+                         'One')
+        self.assertEqual(
+            sorted(a.address for a in
+                   self.client.alias.get_aliases('jane@one.lan')),
+            ['jane@one.lan', 'sales@one.lan'])
+
+        # Applying again has nothing left to do
+        self.assertEqual(len(plan(desired())), 0)
+
+    def test_changes(self):
+        reconcile(desired(), dry_run=False)
+
+        state = desired()
+        state['one.lan']['mailboxes']['jdoe@one.lan']['quota'] = 2048
+        del state['one.lan']['mailboxes']['jane@one.lan']
+        state['one.lan']['aliases'] = {'info@one.lan': 'jdoe@one.lan'}
+        state['two.lan'] = None
+
+        result = reconcile(state, dry_run=False)
+
+        self.assertEqual(result.summary(), {
+            'update mailbox': 1, 'delete mailbox': 1, 'update alias': 1,
+            'delete alias': 1, 'delete domain': 1})
+        self.assertEqual(
+            str(result.get('update', 'mailbox')[0]),
+            '~ mailbox jdoe@one.lan: quota 1024 -> 2048')
+
+        self.assertEqual(self.client.mailbox.get_mailbox('jdoe@one.lan').quota,
+                         2048)
+        self.assertFalse(self.client.mailbox.mailbox_exists('jane@one.lan'))
+        self.assertFalse(self.client.domain.domain_exists('two.lan'))
+        self.assertEqual(
+            sorted(a.address for a in
+                   self.client.alias.get_aliases('jdoe@one.lan')),
+            ['info@one.lan', 'jdoe@one.lan'])
+        self.assertEqual(len(plan(state)), 0)
+
+    def test_unlisted_is_left_alone(self):
+        reconcile(desired(), dry_run=False)
+
+        # No 'mailboxes' or 'aliases': the domain's are kept
+        self.assertEqual(len(plan({'one.lan': {'description': 'One'}})), 0)
+        self.assertEqual(len(plan({'other.lan': {}})), 1)
+
+    def test_forwarding_mailbox(self):
+        state = desired()
+        state['one.lan']['aliases']['jdoe@one.lan'] = ['jdoe@one.lan',
+                                                       'jdoe@example.com']
+        reconcile(state, dry_run=False)
+
+        self.assertEqual(
+            [a.address for a in
+             self.client.alias.get_aliases('jdoe@example.com,jdoe@one.lan')],
+            ['jdoe@one.lan'])
+        self.assertEqual(len(plan(state)), 0)
+
+    def test_failure_rolls_back(self):
+        # An alias taking the address of a mailbox to create: the mailbox's
+        # self-referential alias can't be inserted
+        self.client.domain.create_domain('three.lan')
+        self.client.alias.add_alias('jdoe@one.lan', 'admin@three.lan')
+        self.client.get_db_session().commit()
+
+        self.assertRaises(IntegrityError, reconcile, desired(), dry_run=False)
+        self.assertFalse(self.client.domain.domain_exists('one.lan'))
+        self.assertFalse(self.client.mailbox.mailbox_exists('jdoe@one.lan'))
+
+        state = desired()
+        del state['two.lan']['mailboxes']['admin@two.lan']['password']
+        self.assertRaises(ValueError, reconcile, state, dry_run=False)
+
+    def test_alias_across_domains(self):
+        # add_alias files it under three.lan, the plan finds it by address
+        self.client.domain.create_domain('three.lan')
+        self.client.alias.add_alias('info@one.lan', 'admin@three.lan')
+        self.client.get_db_session().commit()
+
+        state = desired()
+        state['one.lan']['aliases']['ext@one.lan'] = 'ext@elsewhere.org'
+        result = reconcile(state, dry_run=False)
+
+        self.assertEqual(result.summary(), {
+            'create domain': 2, 'create mailbox': 3, 'create alias': 2,
+            'update alias': 1})
+        self.assertEqual(
+            [a.domain for a in
+             self.client.alias.get_aliases('ext@elsewhere.org')],
+            ['elsewhere.org'])
+
+        # Plus one lookup by address for the listed aliases
+        with query_budget(max_statements=4):
+            self.assertEqual(len(plan(state)), 0)
+
+    def test_invalid(self):
+        for state in [
+            {'not a domain': {}},
+            {'one.lan': {'colour': 'blue'}},
+            {'one.lan': {'mailboxes': {'jdoe@two.lan': {}}}},
+            {'one.lan': {'mailboxes': {'jdoe@one.lan': {'size': 1}}}},
+        ]:
+            with self.subTest(state=state):
+                self.assertRaises(ValueError, plan, state)
+
+    def test_reads_per_domain_chunk(self):
+        testing.seed(self.client.database.engine, domains=20, mailboxes=200)
+        state = dict((d.domain, {'mailboxes': {}})
+                     for d in self.client.domain.get_all_domains())
+        for m in self.client.mailbox.get_all_mailboxes():
+            state[m.domain]['mailboxes'][m.username] = {'name': m.name,
+                                                        'quota': m.quota}
+
+        # The domains, their mailboxes and their aliases
+        with query_budget(max_statements=3):
+            self.assertEqual(len(plan(state)), 0)
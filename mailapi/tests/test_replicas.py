@@ -0,0 +1,134 @@
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from . import conn_str
+from ..db import (init_db, get_db_session, get_engine, get_replica_engines,
+                  transaction)
+from ..domain import create_domain, delete_domain, domain_exists, \
+    get_all_domains, get_domain
+from ..replicas import RoundRobinPolicy, get_policy, random_policy
+
+
+class ReplicaRoutingTests(TestCase):
+    """ The "replicas" are the test database itself, what matters is which
+    engine ran the statements
+    """
+
+    domain_name = 'replicas.lan'
+
+    def setUp(self):
+        self.init(read_your_writes=0)
+
+    def init(self, **kwargs):
+        init_db(conn_str, replicas=[conn_str, conn_str], **kwargs)
+
+        # Statements per engine, the primary first
+        self.engines = [get_engine()] + get_replica_engines()
+        self.statements = [[] for _ in self.engines]
+        for engine, statements in zip(self.engines, self.statements):
+            event.listen(engine, 'before_cursor_execute',
+                         self._recorder(statements))
+
+    def _recorder(self, statements):
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        return record
+
+    def tearDown(self):
+        db_session = get_db_session()
+        db_session.rollback()
+        if domain_exists(self.domain_name):
+            delete_domain(self.domain_name)
+        db_session.commit()
+
+        # Back to the engine the rest of the suite uses
+        init_db(conn_str)
+
+    def counts(self):
+        counts = [len(statements) for statements in self.statements]
+        for statements in self.statements:
+            del statements[:]
+        return counts
+
+    def test_reads_go_to_replicas_in_turn(self):
+        get_all_domains()
+        self.assertEqual(self.counts(), [0, 1, 0])
+
+        get_all_domains()
+        self.assertEqual(self.counts(), [0, 0, 1])
+
+    def test_writes_and_their_reads_stay_on_primary(self):
+        # The existence check within create_domain included
+        create_domain(self.domain_name, 'Replica Test')
+        counts = self.counts()
+
+        self.assertGreaterEqual(counts[0], 2)
+        self.assertEqual(counts[1:], [0, 0])
+
+    def test_reads_after_uncommitted_write_use_primary(self):
+        create_domain(self.domain_name, 'Replica Test')
+        self.counts()
+
+        # A replica couldn't see the uncommitted domain
+        self.assertIsNotNone(get_domain(self.domain_name))
+        self.assertEqual(self.counts()[1:], [0, 0])
+
+        # Once committed the replicas are back in use
+        get_db_session().commit()
+        self.counts()
+
+        self.assertIsNotNone(get_domain(self.domain_name))
+        self.assertEqual(self.counts()[0], 0)
+
+    def test_read_your_writes_window(self):
+        self.init(read_your_writes=60)
+
+        create_domain(self.domain_name, 'Replica Test')
+        get_db_session().commit()
+        self.counts()
+
+        get_all_domains()
+        self.assertEqual(self.counts()[1:], [0, 0])
+
+    def test_reads_within_transaction_use_primary(self):
+        with transaction():
+            get_all_domains()
+            self.assertEqual(self.counts()[1:], [0, 0])
+
+    def test_replica_objects_are_detached(self):
+        create_domain(self.domain_name, 'Replica Test')
+        get_db_session().commit()
+
+        domain = get_domain(self.domain_name)
+
+        # Loaded attributes stay readable
+        self.assertEqual(domain.description, 'Replica Test')
+        self.assertNotIn(domain, get_db_session())
+
+    def test_custom_policy(self):
+        picked = []
+
+        def last_replica(engines):
+            picked.append(engines[-1])
+            return engines[-1]
+
+        self.init(replica_policy=last_replica)
+        get_all_domains()
+
+        self.assertEqual(picked, [self.engines[2]])
+        self.assertEqual(self.counts(), [0, 0, 1])
+
+
+class PolicyTests(TestCase):
+    def test_round_robin(self):
+        policy = RoundRobinPolicy()
+
+        self.assertEqual([policy('abc') for _ in range(4)],
+                         ['a', 'b', 'c', 'a'])
+
+    def test_named_policies(self):
+        self.assertIsInstance(get_policy('round_robin'), RoundRobinPolicy)
+        self.assertIs(get_policy('random'), random_policy)
+        self.assertIs(get_policy(len), len)
+        self.assertRaises(ValueError, get_policy, 'fastest')
@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+
+from . import conn_str
+from ..schema import (SCHEMA_STATIC, TABLE_NAMES, fingerprint, load_cache,
+                      load_metadata, metadata, reflect)
+
+
+class SchemaCacheTests(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = os.path.join(self.tmp_dir, 'schema.cache')
+
+        self.url = make_url(conn_str)
+        self.engine = create_engine(self.url)
+
+        # Counts every statement the engine runs
+        self.statements = []
+        event.listen(self.engine, 'before_cursor_execute',
+                     self._count_statement)
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.tmp_dir)
+
+    def _count_statement(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def test_static_needs_no_database(self):
+        tables = load_metadata(self.url, SCHEMA_STATIC)
+
+        self.assertIs(tables, metadata)
+        self.assertEqual(sorted(tables.tables), sorted(TABLE_NAMES))
+
+    def test_unknown_schema_source(self):
+        self.assertRaises(ValueError, load_metadata, self.url, 'guess')
+
+    def test_reflect_without_cache(self):
+        # Nothing to load, the caller has to reflect
+        self.assertIsNone(load_metadata(self.url))
+        self.assertIsNone(load_metadata(self.url, schema_cache=self.cache))
+
+    def test_cache_round_trip(self):
+        reflect(self.engine, self.url, self.cache, '1.0')
+        self.assertTrue(self.statements)
+        self.assertTrue(os.path.exists(self.cache))
+
+        # A later start loads it without asking the database
+        del self.statements[:]
+        tables = load_metadata(self.url, schema_cache=self.cache,
+                               schema_version='1.0')
+
+        self.assertEqual(self.statements, [])
+        self.assertEqual(sorted(tables.tables), sorted(TABLE_NAMES))
+        self.assertIn('username', tables.tables['mailbox'].c)
+
+    def test_cache_fingerprint_mismatch(self):
+        reflect(self.engine, self.url, self.cache, '1.0')
+
+        # A new schema version invalidates the cache
+        self.assertIsNone(load_metadata(self.url, schema_cache=self.cache,
+                                        schema_version='2.0'))
+
+        # So does another database
+        other = make_url('mysql://localhost/other')
+        self.assertNotEqual(fingerprint(self.url, '1.0'),
+                            fingerprint(other, '1.0'))
+
+    def test_corrupt_cache_is_ignored(self):
+        with open(self.cache, 'wb') as f:
+            f.write(b'not a pickle')
+
+        self.assertIsNone(load_cache(self.cache, fingerprint(self.url)))
+
+    def test_cache_writable_by_others_is_ignored(self):
+        reflect(self.engine, self.url, self.cache, '1.0')
+        self.assertEqual(os.stat(self.cache).st_mode & 0o777, 0o600)
+
+        os.chmod(self.cache, 0o666)
+        self.assertIsNone(load_metadata(self.url, schema_cache=self.cache,
+                                        schema_version='1.0'))
@@ -0,0 +1,111 @@
+from unittest import TestCase
+
+from sqlalchemy import inspect
+
+from .. import testing
+from ..client import MailApi
+from ..db import Database
+from ..domain import create_domain, domain_exists, get_all_domains, get_domain
+
+
+class OperationScopeTests(TestCase):
+    def setUp(self):
+        self.conn_str = testing.create_test_db(testing.temp_file_url())
+        testing.seed(self.conn_str, domains=3, mailboxes=30)
+
+        self.client = MailApi(self.conn_str, schema='static',
+                              session_scope='operation')
+        self.domain_name = self.client.domain.get_all_domains()[0].domain
+
+    def tearDown(self):
+        self.client.close()
+
+    def has_session(self):
+        return self.client.database.session.registry.has()
+
+    def test_reads_close_the_session(self):
+        self.assertTrue(self.client.domain.domain_exists(self.domain_name))
+        self.assertFalse(self.has_session())
+
+        # Nested API calls (get_all_mailboxes checks the domain) end with the
+        # outermost one
+        mailboxes = self.client.domain.get_all_mailboxes(self.domain_name)
+        self.assertEqual(len(mailboxes), 10)
+        self.assertFalse(self.has_session())
+
+    def test_objects_stay_usable(self):
+        domain = self.client.domain.get_domain(self.domain_name)
+
+        self.assertTrue(inspect(domain).detached)
+        self.assertEqual(domain.domain, self.domain_name)
+
+    def test_uncommitted_writes_keep_the_session(self):
+        self.client.domain.create_domain('new.lan')
+        self.assertTrue(self.has_session())
+
+        # Still the same session, so the write is visible
+        self.assertTrue(self.client.domain.domain_exists('new.lan'))
+        self.client.get_db_session().rollback()
+
+        self.assertFalse(self.client.domain.domain_exists('new.lan'))
+        self.assertFalse(self.has_session())
+
+    def test_transaction(self):
+        with self.client.transaction():
+            domain = self.client.domain.create_domain('new.lan')
+            self.assertTrue(self.has_session())
+
+        self.assertFalse(self.has_session())
+        self.assertEqual(domain.domain, 'new.lan')
+        self.assertTrue(self.client.domain.domain_exists('new.lan'))
+
+    def test_activate(self):
+        with self.client.activate():
+            self.assertIsNotNone(get_domain(self.domain_name))
+            create_domain('new.lan')
+            self.client.get_db_session().commit()
+            self.assertTrue(domain_exists('new.lan'))
+
+        self.assertFalse(self.has_session())
+
+    def test_unknown_scope(self):
+        self.assertRaises(ValueError, Database().configure, self.conn_str,
+                          session_scope='request')
+
+
+class ExpungeListingsTests(TestCase):
+    def setUp(self):
+        self.conn_str = testing.create_test_db(testing.temp_file_url())
+        testing.seed(self.conn_str, domains=3, mailboxes=30)
+
+    def test_expunged(self):
+        with MailApi(self.conn_str, schema='static',
+                     expunge_listings=True) as client:
+            with client.activate():
+                domains = get_all_domains()
+                session = client.get_db_session()
+
+                self.assertEqual(len(domains), 3)
+                self.assertFalse(any(d in session for d in domains))
+                self.assertEqual(len(session.identity_map), 0)
+
+                # Single object lookups aren't listings
+                domain = get_domain(domains[0].domain)
+                self.assertIn(domain, session)
+
+    def test_not_while_writing(self):
+        with MailApi(self.conn_str, schema='static',
+                     expunge_listings=True) as client:
+            with client.activate():
+                domain = get_domain(get_all_domains()[0].domain)
+                domain.description = 'Changed'
+
+                self.assertIn(domain, get_all_domains())
+                self.assertIn(domain, client.get_db_session())
+
+    def test_off_by_default(self):
+        with MailApi(self.conn_str, schema='static') as client:
+            with client.activate():
+                domains = get_all_domains()
+                self.assertTrue(all(d in client.get_db_session()
+                                    for d in domains))
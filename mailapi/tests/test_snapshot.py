@@ -0,0 +1,109 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+
+from .. import snapshot, testing
+from ..client import MailApi
+from ..exc import SnapshotError
+from ..schema import TABLE_NAMES, metadata
+
+
+class SnapshotTests(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'vmail.snapshot.gz')
+
+        self.source = MailApi(
+            testing.create_test_db(testing.temp_file_url()), schema='static')
+        testing.seed(self.source.database.engine, domains=4, mailboxes=200)
+
+        self.target = MailApi(
+            testing.create_test_db(testing.temp_file_url()), schema='static')
+
+    def tearDown(self):
+        self.source.close()
+        self.target.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def rows(self, client, domains=None):
+        result = {}
+        with client.database.engine.connect() as connection:
+            for name in TABLE_NAMES:
+                table = metadata.tables[name]
+                query = select(table).order_by(*table.primary_key)
+                if domains is not None:
+                    query = query.where(table.c.domain.in_(domains))
+                result[name] = connection.execute(query).all()
+        return result
+
+    def test_round_trip(self):
+        with self.source.activate():
+            counts = snapshot.export(self.path, chunk_size=64)
+        with self.target.activate():
+            self.assertEqual(snapshot.import_(self.path, chunk_size=64),
+                             counts)
+
+        self.assertEqual(counts['mailbox'], 200)
+        self.assertEqual(self.rows(self.target), self.rows(self.source))
+
+    def test_domains(self):
+        with self.source.database.engine.connect() as connection:
+            domains = connection.execute(
+                select(metadata.tables['domain'].c.domain).limit(2)).\
+                scalars().all()
+
+        with self.source.activate():
+            snapshot.export(self.path, domains=domains)
+        with self.target.activate():
+            snapshot.import_(self.path)
+
+        self.assertEqual(snapshot.read_header(self.path)['domains'],
+                         sorted(domains))
+        self.assertEqual(self.rows(self.target),
+                         self.rows(self.source, domains))
+
+    def test_all_or_nothing(self):
+        with self.source.activate():
+            snapshot.export(self.path)
+
+        with self.target.activate():
+            snapshot.import_(self.path)
+            self.assertRaises(IntegrityError, snapshot.import_, self.path)
+
+        with self.target.database.engine.connect() as connection:
+            count = connection.execute(
+                select(func.count()).select_from(metadata.tables['mailbox'])
+            ).scalar()
+        self.assertEqual(count, 200)
+
+    def write_header(self, header):
+        with gzip.open(self.path, 'wt') as f:
+            f.write(json.dumps(header) + '\n')
+
+    def test_not_a_snapshot(self):
+        with open(self.path, 'w') as f:
+            f.write('domain,mailbox\n')
+
+        with self.target.activate():
+            self.assertRaises(SnapshotError, snapshot.import_, self.path)
+
+    def test_newer_version(self):
+        self.write_header({'format': snapshot.FORMAT,
+                           'version': snapshot.VERSION + 1, 'tables': {}})
+
+        with self.target.activate():
+            self.assertRaises(SnapshotError, snapshot.import_, self.path)
+
+    def test_unknown_column(self):
+        self.write_header({'format': snapshot.FORMAT,
+                           'version': snapshot.VERSION,
+                           'tables': {'domain': ['domain', 'color']}})
+
+        with self.target.activate():
+            self.assertRaises(SnapshotError, snapshot.import_, self.path)
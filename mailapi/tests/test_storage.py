@@ -0,0 +1,136 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from ..storage import (
+    MaildirStorage,
+    MAILDIR_SUBDIRS,
+    TRASH_DIRNAME,
+    set_storage_backend,
+)
+from ..mailbox import (
+    create_mailbox,
+    create_mailboxes,
+    delete_mailbox,
+    delete_mailboxes,
+    mailbox_exists,
+)
+from ..domain import create_domain, delete_domain
+from ..db import get_db_session, transaction
+
+
+class MaildirStorageTests(TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.storage = MaildirStorage(workers=4, batch_size=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def test_create_maildirs(self):
+        paths = [os.path.join(self.base_dir, 'vmail1', 'testdomain.lan',
+                              't', 'e', 's', 'test%d/' % i) for i in range(9)]
+
+        # Spread over several batches / workers
+        self.storage.create_maildirs(paths)
+
+        for path in paths:
+            for subdir in MAILDIR_SUBDIRS:
+                self.assertTrue(os.path.isdir(os.path.join(path, subdir)))
+
+        # Creating them again is a no-op
+        self.storage.create_maildirs(paths)
+
+    def test_trash_path(self):
+        node_dir = os.path.join(self.base_dir, 'vmail1')
+        path = os.path.join(node_dir, 'testdomain.lan', 'testuser')
+        self.storage.create_maildirs([path])
+
+        trashed = self.storage.trash_path(path, node_dir)
+
+        # The maildir was moved into the trash of the same storage node
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(os.path.dirname(trashed),
+                         os.path.join(node_dir, TRASH_DIRNAME))
+        self.assertTrue(os.path.isdir(os.path.join(trashed, 'cur')))
+
+    def test_trash_missing_path(self):
+        node_dir = os.path.join(self.base_dir, 'vmail1')
+
+        self.assertIsNone(self.storage.trash_path(
+            os.path.join(node_dir, 'not', 'there'), node_dir))
+
+
+class MailboxStorageTests(TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        set_storage_backend(MaildirStorage())
+
+        self.domain_name = 'testdomain.lan'
+        create_domain(self.domain_name, 'A Test Domain')
+
+    def tearDown(self):
+        set_storage_backend(None)
+        delete_domain(self.domain_name)
+        shutil.rmtree(self.base_dir)
+
+    def maildir(self, mailbox):
+        return os.path.join(self.base_dir, 'vmail1', mailbox.maildir)
+
+    def test_create_and_delete_mailbox(self):
+        email_address = ''.join(['testusr', '@', self.domain_name])
+        mailbox = create_mailbox(email_address, 'Test User', 'password123',
+                                 storage_base_dir=self.base_dir)
+
+        # The maildir exists as soon as the mailbox does
+        self.assertTrue(os.path.isdir(os.path.join(self.maildir(mailbox),
+                                                   'new')))
+
+        # Deleting the mailbox moves it into the trash once that commits
+        self.assertTrue(delete_mailbox(email_address))
+        self.assertTrue(os.path.exists(self.maildir(mailbox)))
+        get_db_session().commit()
+        self.assertFalse(os.path.exists(self.maildir(mailbox)))
+        self.assertEqual(len(os.listdir(os.path.join(
+            self.base_dir, 'vmail1', TRASH_DIRNAME))), 1)
+
+    def test_create_mailboxes(self):
+        records = [{'email_address': 'testusr%d@%s' % (i, self.domain_name),
+                    'full_name': 'Test User %d' % i,
+                    'plain_password': 'password123'} for i in range(5)]
+
+        mailboxes = create_mailboxes(records, storage_base_dir=self.base_dir)
+
+        self.assertEqual(len(mailboxes), 5)
+        for mailbox in mailboxes:
+            self.assertTrue(os.path.isdir(os.path.join(self.maildir(mailbox),
+                                                       'tmp')))
+
+    def test_rollback_keeps_maildirs(self):
+        mailboxes = create_mailboxes([
+            {'email_address': 'testusr%d@%s' % (i, self.domain_name),
+             'full_name': 'Test User %d' % i,
+             'plain_password': 'password123'} for i in range(3)
+        ], storage_base_dir=self.base_dir)
+        get_db_session().commit()
+
+        delete_mailbox(mailboxes[0].username)
+        get_db_session().rollback()
+
+        # A savepoint rolled back takes its deletes along, the others stay
+        with transaction():
+            delete_mailboxes([mailboxes[1].username])
+            try:
+                with transaction():
+                    delete_mailboxes([mailboxes[2].username])
+                    raise RuntimeError()
+            except RuntimeError:
+                pass
+
+        self.assertTrue(mailbox_exists(mailboxes[0].username))
+        self.assertTrue(os.path.isdir(self.maildir(mailboxes[0])))
+        self.assertFalse(mailbox_exists(mailboxes[1].username))
+        self.assertFalse(os.path.exists(self.maildir(mailboxes[1])))
+        self.assertTrue(mailbox_exists(mailboxes[2].username))
+        self.assertTrue(os.path.isdir(self.maildir(mailboxes[2])))
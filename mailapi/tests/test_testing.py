@@ -0,0 +1,83 @@
+from unittest import TestCase
+
+from sqlalchemy import func, inspect, select
+
+from ..md5crypt import unix_md5_crypt
+from ..schema import TABLE_NAMES, mailbox, alias, used_quota
+from ..testing import (SEED_PASSWORD_HASH, create_test_db, drop_test_db,
+                       memory_url, seed, engine_for)
+
+
+class TestDbTests(TestCase):
+    def setUp(self):
+        self.conn_str = create_test_db(memory_url())
+        self.engine = engine_for(self.conn_str)
+
+    def tearDown(self):
+        self.engine.dispose()
+        drop_test_db(self.conn_str)
+
+    def test_schema(self):
+        inspector = inspect(self.engine)
+
+        self.assertEqual(sorted(inspector.get_table_names()),
+                         sorted(TABLE_NAMES))
+        self.assertEqual(inspector.get_pk_constraint('mailbox')
+                         ['constrained_columns'], ['username'])
+        self.assertIn('mailbox_domain',
+                      [i['name'] for i in inspector.get_indexes('mailbox')])
+
+    def test_seed(self):
+        counts = seed(self.engine, domains=5, mailboxes=250,
+                      aliases_per_mailbox=2, batch_size=100)
+
+        self.assertEqual(counts, {'domain': 5, 'mailbox': 250,
+                                  'alias': 750, 'used_quota': 250})
+
+        with self.engine.connect() as connection:
+            # Every mailbox has its self-referrential alias
+            self_aliases = connection.execute(
+                select(func.count()).select_from(alias).
+                where(alias.c.address == alias.c.goto)).scalar()
+            self.assertEqual(self_aliases, 250)
+
+            # Mailboxes are spread over all the domains
+            domains = connection.execute(
+                select(func.count(mailbox.c.domain.distinct()))).scalar()
+            self.assertEqual(domains, 5)
+
+            quota = connection.execute(
+                select(func.count()).select_from(used_quota)).scalar()
+            self.assertEqual(quota, 250)
+
+    def test_seed_keeps_engine_settings(self):
+        with self.engine.connect() as connection:
+            synchronous = connection.exec_driver_sql(
+                'PRAGMA synchronous').scalar()
+
+        seed(self.engine, domains=2, mailboxes=10)
+
+        with self.engine.connect() as connection:
+            self.assertEqual(connection.exec_driver_sql(
+                'PRAGMA synchronous').scalar(), synchronous)
+
+    def test_seed_is_deterministic(self):
+        seed(self.engine, domains=3, mailboxes=20, random_seed=7)
+        other_conn_str = create_test_db(memory_url())
+        try:
+            seed(other_conn_str, domains=3, mailboxes=20, random_seed=7)
+
+            query = select(mailbox.c.username, mailbox.c.quota).\
+                order_by(mailbox.c.username)
+            other_engine = engine_for(other_conn_str)
+            with self.engine.connect() as a, other_engine.connect() as b:
+                self.assertEqual(a.execute(query).all(),
+                                 b.execute(query).all())
+            other_engine.dispose()
+        finally:
+            drop_test_db(other_conn_str)
+
+    def test_seed_password(self):
+        # Seeded mailboxes can log in with password1234
+        self.assertEqual(unix_md5_crypt('password1234', 'mLtMBOTu'),
+                         SEED_PASSWORD_HASH)
@@ -0,0 +1,111 @@
+from unittest import TestCase
+
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+
+from ..db import get_db_session, in_transaction, transaction
+from ..alias import add_alias, get_aliases
+from ..domain import create_domain, delete_domain, domain_exists
+from ..mailbox import create_mailbox, mailbox_exists
+
+
+class TransactionTests(TestCase):
+    domain_name = 'transaction.lan'
+
+    def setUp(self):
+        # Starts from a clean session, commits below are real
+        self.db_session = get_db_session()
+        self.db_session.rollback()
+
+        self.flushes = []
+        event.listen(self.db_session, 'after_flush', self._count_flush)
+
+    def tearDown(self):
+        event.remove(self.db_session, 'after_flush', self._count_flush)
+
+        self.db_session.rollback()
+        if domain_exists(self.domain_name):
+            delete_domain(self.domain_name)
+        self.db_session.commit()
+
+    def _count_flush(self, session, flush_context):
+        self.flushes.append(session)
+
+    def test_commits_on_exit(self):
+        with transaction() as tx:
+            # The block's session is the thread's session
+            self.assertIs(tx.session, self.db_session)
+            self.assertEqual(tx.depth, 0)
+            self.assertTrue(in_transaction())
+
+            create_domain(self.domain_name, 'Transaction Test')
+
+        self.assertFalse(in_transaction())
+
+        # Survives a rollback since it was committed
+        self.db_session.rollback()
+        self.assertTrue(domain_exists(self.domain_name))
+
+    def test_rolls_back_on_error(self):
+        with self.assertRaises(RuntimeError):
+            with transaction():
+                create_domain(self.domain_name, 'Transaction Test')
+                raise RuntimeError('boom')
+
+        self.assertFalse(in_transaction())
+        self.assertFalse(domain_exists(self.domain_name))
+
+    def test_batches_flushes(self):
+        with transaction():
+            create_domain(self.domain_name, 'Transaction Test')
+            self.flushes[:] = []
+
+            for i in range(50):
+                add_alias('alias%d@%s' % (i, self.domain_name),
+                          'dest@%s' % self.domain_name)
+
+            # Nothing went to the db yet
+            self.assertEqual(self.flushes, [])
+
+        # All 50 aliases went out with the commit's single flush
+        self.assertEqual(len(self.flushes), 1)
+        self.assertEqual(len(get_aliases('dest@%s' % self.domain_name)), 50)
+
+    def test_flush_on_demand(self):
+        with transaction() as tx:
+            create_domain(self.domain_name, 'Transaction Test')
+            self.flushes[:] = []
+
+            tx.flush()
+            self.assertEqual(len(self.flushes), 1)
+
+    def test_nested_rolls_back_to_savepoint(self):
+        email_address = 'user@%s' % self.domain_name
+
+        with transaction():
+            create_domain(self.domain_name, 'Transaction Test')
+
+            with self.assertRaises(RuntimeError):
+                with transaction() as tx:
+                    self.assertEqual(tx.depth, 1)
+                    create_mailbox(email_address, 'User', 'password1234')
+                    raise RuntimeError('boom')
+
+            # Only the inner block was undone
+            self.assertTrue(in_transaction())
+            self.assertFalse(mailbox_exists(email_address))
+
+        self.assertTrue(domain_exists(self.domain_name))
+
+    def test_duplicate_surfaces_on_flush(self):
+        source = 'alias@%s' % self.domain_name
+        dest = 'dest@%s' % self.domain_name
+
+        with self.assertRaises(IntegrityError):
+            with transaction():
+                create_domain(self.domain_name, 'Transaction Test')
+                add_alias(source, dest)
+                add_alias(source, dest)
+
+        # Everything in the block is gone
+        self.assertFalse(domain_exists(self.domain_name))
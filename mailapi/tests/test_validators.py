@@ -0,0 +1,69 @@
+from unittest import TestCase
+
+from ..validators import (
+    is_email,
+    is_domain,
+    validate_emails,
+    validate_domains,
+    INVALID_CHARS,
+    MISSING_DOT,
+    NOT_ONE_AT,
+    MALFORMED,
+)
+
+
+class IsEmailTests(TestCase):
+    def test_is_email(self):
+        self.assertTrue(is_email('testuser@testdomain.lan'))
+        self.assertTrue(is_email('test.user-1@sub.testdomain.lan'))
+
+    def test_not_email(self):
+        for s in ('testuser', 'test user@testdomain.lan',
+                  'testuser@@testdomain.lan', 'testuser@testdomain.l4n',
+                  'test\\user@testdomain.lan', None):
+            self.assertFalse(is_email(s), s)
+
+
+class IsDomainTests(TestCase):
+    def test_is_domain(self):
+        self.assertTrue(is_domain('testdomain.lan'))
+
+    def test_not_domain(self):
+        for s in ('testdomain', 'test+domain.lan', 'testdomain.l4n'):
+            self.assertFalse(is_domain(s), s)
+
+
+class ValidateEmailsTests(TestCase):
+    def test_all_valid(self):
+        result = validate_emails(['testuser%d@testdomain.lan' % i
+                                  for i in range(10)])
+
+        self.assertTrue(result)
+        self.assertEqual(result.count, 10)
+        self.assertEqual(result.valid_count, 10)
+        self.assertIsNone(result.first_error())
+
+    def test_reasons(self):
+        result = validate_emails(['testuser@testdomain.lan',
+                                  'test user@testdomain.lan',
+                                  'testuser',
+                                  'test@user@testdomain.lan',
+                                  'testuser@testdomain.l4n'])
+
+        self.assertFalse(result)
+        self.assertEqual(result.valid_count, 1)
+        self.assertEqual(result.errors, {1: INVALID_CHARS,
+                                         2: MISSING_DOT,
+                                         3: NOT_ONE_AT,
+                                         4: MALFORMED})
+        self.assertEqual(result.first_error(), (1, INVALID_CHARS))
+
+    def test_generator(self):
+        result = validate_emails(s for s in ['testuser@testdomain.lan'])
+
+        self.assertEqual(result.count, 1)
+
+    def test_validate_domains(self):
+        result = validate_domains(['testdomain.lan', 'testdomain'])
+
+        self.assertEqual(result.errors, {1: MISSING_DOT})
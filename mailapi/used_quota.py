@@ -10,10 +10,19 @@ from .models import Mailbox, UsedQuota
 from .helpers import parse_email_domain
 from .alias import add_alias, delete_aliases, delete_alias
 from .mailbox import mailbox_exists
-from .db import get_db_session
+from .db import get_db_session, flush, listing, read_only, writes
 from .exc import NoSuchDomain, MailboxExists, NoSuchMailbox
+from . import changes
 
 
+@read_only
+def get_sum_used_quota():
+    return get_db_session().query(
+        func.sum(UsedQuota.bytes).label('bytes'), func.sum(UsedQuota.messages).label('messages'),
+    ).one()
+
+
+@read_only
 def get_domain_sum_used_quota(domain: str):
     if not domain_exists(domain):
         raise NoSuchDomain(domain)
@@ -23,6 +32,7 @@ def get_domain_sum_used_quota(domain: str):
     ).filter_by(domain=domain).one()
 
 
+@read_only
 def get_mailbox_sum_used_quota(email_address: str):
     if not mailbox_exists(email_address):
         raise NoSuchMailbox(email_address)
@@ -32,18 +42,22 @@ def get_mailbox_sum_used_quota(email_address: str):
     ).filter_by(username=email_address).one()
 
 
+@read_only
+@listing
 def get_domain_used_quota(domain: str):
     if not domain_exists(domain):
         raise NoSuchDomain(domain)
     return get_db_session().query(UsedQuota).filter_by(domain=domain).all()
 
 
+@read_only
 def get_mailbox_used_quota(email_address: str):
     if not mailbox_exists(email_address):
         raise NoSuchMailbox(email_address)
     return get_db_session().query(UsedQuota).filter_by(username=email_address).one()
 
 
+@writes
 def delete_used_quota_mailbox(email_address):
     """ Deletes the mailbox from the database by the given email address.
 
@@ -56,9 +70,12 @@ def delete_used_quota_mailbox(email_address):
 
     num_deleted = get_db_session().query(UsedQuota).filter_by(username=email_address).delete()
 
+    if num_deleted:
+        changes.record(changes.USED_QUOTA, changes.DELETE, [email_address])
     return num_deleted == 1
 
 
+@writes
 def reset_mailbox_used_quota(email_address):
     """ Sets the password for the given email address to the given password
 
@@ -68,15 +85,14 @@ def reset_mailbox_used_quota(email_address):
     :raises NoSuchMailbox: If the given email address does not exist
     """
 
-    if not mailbox_exists(email_address):
-        raise NoSuchMailbox(email_address)
-
+    # Raises NoSuchMailbox itself
     used_quota = get_mailbox_used_quota(email_address)
     used_quota.bytes = 0
     used_quota.messages = 0
 
     db_session = get_db_session()
     db_session.add(used_quota)
-    db_session.flush()
+    flush(db_session)
 
+    changes.record(changes.USED_QUOTA, changes.UPDATE, [email_address])
     return True
@@ -12,34 +12,142 @@ email_re = r'''[\w\-][\w\-\.]*@[\w\-][\w\-\.]+[a-zA-Z]{2,15}'''
 # Domain.
 domain_re = r'''[\w\-][\w\-\.]*\.[a-z]{2,15}'''
 
-INVALID_EMAIL_CHARS = '~!#$%^&*()\\/\ '
-INVALID_DOMAIN_CHARS = '~!#$%^&*()+\\/\ '
+INVALID_EMAIL_CHARS = '~!#$%^&*()\\/\\ '
+INVALID_DOMAIN_CHARS = '~!#$%^&*()+\\/\\ '
 
+# Compiled once instead of on every call
+_email_match = re.compile(email_re + '$', re.IGNORECASE).match
+_domain_match = re.compile(domain_re + '$', re.IGNORECASE).match
+_invalid_email_chars = frozenset(INVALID_EMAIL_CHARS)
+_invalid_domain_chars = frozenset(INVALID_DOMAIN_CHARS)
 
-def is_email(s):
+# Reasons reported by validate_emails / validate_domains
+INVALID_CHARS = 'contains invalid characters'
+MISSING_DOT = 'does not contain a dot'
+NOT_ONE_AT = 'does not contain exactly one @'
+MALFORMED = 'is malformed'
+
+
+def email_error(s):
+    """ Why the given string is not an email address
+
+    :param s: String
+    :return: One of the reasons above or None if it's a valid email address
+    """
     s = str(s)
-    if len(set(s) & set(INVALID_EMAIL_CHARS)) > 0 \
-       or '.' not in s \
-       or s.count('@') != 1:
-        return False
+    if not _invalid_email_chars.isdisjoint(s):
+        return INVALID_CHARS
+    if '.' not in s:
+        return MISSING_DOT
+    if s.count('@') != 1:
+        return NOT_ONE_AT
+    if not _email_match(s):
+        return MALFORMED
+    return None
 
-    re_comp_email = re.compile(email_re + '$', re.IGNORECASE)
-    if re_comp_email.match(s):
-        return True
-    else:
-        return False
 
+def domain_error(s):
+    """ Why the given string is not a domain name
 
-def is_domain(s):
+    :param s: String
+    :return: One of the reasons above or None if it's a valid domain name
+    """
     s = str(s)
-    if len(set(s) & set(INVALID_DOMAIN_CHARS)) > 0 or '.' not in s:
-        return False
+    if not _invalid_domain_chars.isdisjoint(s):
+        return INVALID_CHARS
+    if '.' not in s:
+        return MISSING_DOT
+    if not _domain_match(s):
+        return MALFORMED
+    return None
 
-    re_comp_domain = re.compile(domain_re + '$', re.IGNORECASE)
-    if re_comp_domain.match(s):
-        return True
-    else:
-        return False
+
+def is_email(s):
+    return email_error(s) is None
+
+
+def is_domain(s):
+    return domain_error(s) is None
+
+
+class ValidationResult(object):
+    """ Outcome of validating many values at once
+
+    Only the failures are stored: errors maps the index of each invalid value
+    to the reason it was rejected.
+    """
+
+    __slots__ = ('count', 'errors')
+
+    def __init__(self, count, errors):
+        self.count = count
+        self.errors = errors
+
+    def __bool__(self):
+        return not self.errors
+
+    __nonzero__ = __bool__
+
+    @property
+    def valid_count(self):
+        return self.count - len(self.errors)
+
+    def first_error(self):
+        """ (index, reason) of the first invalid value or None """
+        if not self.errors:
+            return None
+        index = min(self.errors)
+        return index, self.errors[index]
+
+    def __repr__(self):
+        return '<ValidationResult %d/%d valid>' % (self.valid_count,
+                                                   self.count)
+
+
+def validate_emails(values):
+    """ Validates many email addresses in one pass
+
+    :param values: Iterable of strings
+    :return: ValidationResult
+    """
+    is_valid_chars = _invalid_email_chars.isdisjoint
+    match = _email_match
+
+    errors = {}
+    count = 0
+    for count, s in enumerate(values, 1):
+        if type(s) is not str:
+            s = str(s)
+
+        # Same checks as email_error, which only runs to find out why
+        if is_valid_chars(s) and '.' in s and s.count('@') == 1 and match(s):
+            continue
+        errors[count - 1] = email_error(s)
+
+    return ValidationResult(count, errors)
+
+
+def validate_domains(values):
+    """ Validates many domain names in one pass
+
+    :param values: Iterable of strings
+    :return: ValidationResult
+    """
+    is_valid_chars = _invalid_domain_chars.isdisjoint
+    match = _domain_match
+
+    errors = {}
+    count = 0
+    for count, s in enumerate(values, 1):
+        if type(s) is not str:
+            s = str(s)
+
+        # Same checks as domain_error, which only runs to find out why
+        if is_valid_chars(s) and '.' in s and match(s):
+            continue
+        errors[count - 1] = domain_error(s)
+
+    return ValidationResult(count, errors)
 
 
 def is_strict_ip(s):
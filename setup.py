@@ -9,11 +9,16 @@ with open(os.path.join(here, 'CHANGES.txt')) as f:
     CHANGES = f.read()
 
 requires = [
-    'SQLAlchemy',
+    'SQLAlchemy>=2.0',
     'pymysql',
     'pep8',
 ]
 
+extras = {
+    # pip install MailApi[aio]; aiosqlite is only needed for the test suite
+    'aio': ['greenlet', 'aiomysql', 'aiosqlite'],
+}
+
 setup(
     name='MailApi',
     version='0.2.0',
@@ -27,9 +32,11 @@ setup(
     url='https://github.com/paszabo/mailapi',
     keywords='iredadmin iredmail email api',
     packages=find_packages(),
+    python_requires='>=3.8',
     include_package_data=True,
     zip_safe=False,
     test_suite='mailapi.tests',
     install_requires=requires,
+    extras_require=extras,
     entry_points='',
 )